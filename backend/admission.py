@@ -0,0 +1,282 @@
+"""
+Admission control: per-client rate limits and load shedding, applied
+before a request reaches a route or the database.
+
+``AdmissionMiddleware`` asks ``limiter`` about every request, which checks:
+
+- Rate: a token bucket per client and route budget. Clients are the
+  authenticated user (the bearer token's subject) or, for /auth/* routes
+  and requests without a valid token, the client IP. Routes listed in
+  ``ROUTE_BUDGETS`` get their own bucket; all other routes share the
+  client's default one. Over budget: 429 with Retry-After set to when the
+  next token arrives.
+- Concurrency: at most ADMISSION_MAX_IN_FLIGHT requests per worker run at
+  once, so queued requests don't pile up on the MongoDB pool (sized per
+  worker too, see database.py). Beyond that: 503 with Retry-After.
+
+Budgets are ``(rate per second, burst)``; ADMISSION_BUDGETS (JSON, route
+template to ``[rate, burst]``, "default" for the rest) overrides them.
+
+Bucket backends, chosen with ADMISSION_BACKEND:
+
+- ``shared`` (default): buckets live in a memory-mapped file at
+  ADMISSION_FILE, shared by every gunicorn worker on the host and updated
+  under a byte-range lock. Clients are hashed to a group of
+  ``SharedBuckets.WAYS`` slots within ADMISSION_SLOTS. When a group is
+  full, a new client takes over its least recently used slot along with
+  the tokens left in it, so colliding clients share a budget instead of
+  getting fresh ones.
+- ``memory``: per process, for a single worker and tests.
+- ``off``: no rate limits; the concurrency cap still applies.
+
+``limiter.configure`` swaps the backend in place, e.g. for tests.
+
+Behind a proxy, set ADMISSION_TRUST_FORWARDED=true to key anonymous
+clients by the first X-Forwarded-For address instead of the proxy's.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from jose import JWTError, jwt
+
+from metrics import route_template
+from security import ALGORITHM, SECRET_KEY
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_BACKEND = os.getenv("ADMISSION_BACKEND", "shared")
+ADMISSION_FILE = os.getenv("ADMISSION_FILE", os.path.join(tempfile.gettempdir(), "hlb-admission"))
+ADMISSION_SLOTS = int(os.getenv("ADMISSION_SLOTS", 65536))
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", 64))
+ADMISSION_RETRY_AFTER_SECONDS = int(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", 1))
+ADMISSION_TRUST_FORWARDED = os.getenv("ADMISSION_TRUST_FORWARDED", "false").lower() == "true"
+
+Budget = tuple[float, float]
+
+# Keyed by route template (see metrics.route_template)
+ROUTE_BUDGETS: dict[str, Budget] = {
+    "default": (20, 60),
+    # Every page is a timeline query; clients revalidate with If-None-Match
+    "/api/v1/reflections/feed": (5, 20),
+    # Each toggle rewrites every timeline copy of the reflection
+    "/api/v1/reflections/{id}/react": (2, 10),
+    "/api/v1/reflections/feed/events": (0.2, 5),
+    # Per IP; password hashing is deliberately slow
+    "/api/v1/auth/token": (0.2, 10),
+    "/api/v1/auth/signup": (0.05, 5),
+}
+ROUTE_BUDGETS.update({route: tuple(budget) for route, budget in json.loads(os.getenv("ADMISSION_BUDGETS", "{}")).items()})
+
+# Answered whatever the load: probes and scrapes must see an overloaded worker
+EXEMPT_ROUTES = {"/", "/healthz", "/metrics"}
+# Long-lived streams would hold an in-flight slot for as long as they stay open
+UNCAPPED_ROUTES = {"/api/v1/reflections/feed/events"}
+AUTH_PREFIX = "/api/v1/auth/"
+
+
+class MemoryBuckets:
+    """
+    Token buckets in a dict, least recently used evicted first.
+    """
+
+    def __init__(self, max_entries: int = ADMISSION_SLOTS):
+        self.max_entries = max_entries
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    def take(self, key: str, rate: float, burst: float, now: Optional[float] = None) -> float:
+        """
+        Takes a token from ``key``'s bucket. Returns 0 when one was
+        available, otherwise the seconds until there is one.
+        """
+        now = time.time() if now is None else now
+        tokens, updated = self._buckets.pop(key, (burst, now))
+        tokens, wait = refill_and_take(tokens, updated, rate, burst, now)
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_entries:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class SharedBuckets:
+    """
+    Token buckets in a memory-mapped file, so every worker on the host
+    draws from the same ones. Each slot holds the key's hash (0 when
+    unused), its tokens and when they were last counted.
+    """
+    SLOT = struct.Struct("<Qdd")
+    # Slots a key may occupy, adjacent so one lock covers them
+    WAYS = 4
+
+    def __init__(self, path: str = ADMISSION_FILE, slots: int = ADMISSION_SLOTS):
+        self.groups = max(slots // self.WAYS, 1)
+        size = self.groups * self.WAYS * self.SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+    def take(self, key: str, rate: float, burst: float, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+        start = (digest % self.groups) * self.WAYS * self.SLOT.size
+        length = self.WAYS * self.SLOT.size
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, length, start)
+        try:
+            slots = [
+                (offset, *self.SLOT.unpack_from(self._map, offset))
+                for offset in range(start, start + length, self.SLOT.size)
+            ]
+            mine = [slot for slot in slots if slot[1] == digest]
+            free = [slot for slot in slots if slot[1] == 0]
+            if mine:
+                offset, _, tokens, updated = mine[0]
+            elif free:
+                offset, tokens, updated = free[0][0], burst, now
+            else:
+                # Take over the stalest slot, tokens included
+                offset, _, tokens, updated = min(slots, key=lambda slot: slot[3])
+            tokens, wait = refill_and_take(tokens, updated, rate, burst, now)
+            self.SLOT.pack_into(self._map, offset, digest, tokens, now)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+        return wait
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+def refill_and_take(tokens: float, updated: float, rate: float, burst: float, now: float) -> tuple[float, float]:
+    """
+    The bucket's tokens after refilling since ``updated`` and taking one
+    if there is one, and the seconds to wait when there wasn't.
+    """
+    tokens = min(burst, tokens + max(now - updated, 0.0) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class Limiter:
+    """
+    The configured buckets, plus this worker's in-flight count.
+    """
+
+    def __init__(self, backend: str = ADMISSION_BACKEND, max_in_flight: int = ADMISSION_MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.buckets = None
+        self.configure(backend)
+
+    def configure(self, backend: str):
+        if backend == "off":
+            buckets = None
+        elif backend == "memory":
+            buckets = MemoryBuckets()
+        elif backend == "shared":
+            buckets = SharedBuckets()
+        else:
+            raise ValueError(f"Unknown ADMISSION_BACKEND: {backend}")
+        if isinstance(self.buckets, SharedBuckets):
+            self.buckets.close()
+        self.backend = backend
+        self.buckets = buckets
+
+    def wait(self, client: str, route: str) -> float:
+        """
+        Takes a token for ``client`` from ``route``'s budget: 0 if admitted,
+        otherwise the seconds until the next token.
+        """
+        if self.buckets is None:
+            return 0.0
+        budget = route if route in ROUTE_BUDGETS else "default"
+        rate, burst = ROUTE_BUDGETS[budget]
+        return self.buckets.take(f"{client}|{budget}", rate, burst)
+
+
+limiter = Limiter()
+
+
+def client_key(scope, route: str) -> str:
+    """
+    ``user:<email>`` for requests with a valid bearer token outside
+    /auth/*, ``ip:<address>`` otherwise.
+    """
+    headers = dict(scope.get("headers") or ())
+    if not route.startswith(AUTH_PREFIX):
+        scheme, _, token = headers.get(b"authorization", b"").decode("latin-1").partition(" ")
+        if scheme.lower() == "bearer" and token:
+            try:
+                subject = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+            except JWTError:
+                subject = None
+            if subject:
+                return f"user:{subject}"
+    forwarded = headers.get(b"x-forwarded-for")
+    if ADMISSION_TRUST_FORWARDED and forwarded:
+        return "ip:" + forwarded.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}"
+
+
+async def _reject(send, status_code: int, detail: str, retry_after: float):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class AdmissionMiddleware:
+    """
+    Pure ASGI middleware, so streaming responses aren't buffered. Goes
+    inside MetricsMiddleware, so rejected requests are counted.
+    """
+
+    def __init__(self, app, limiter: Limiter = limiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route = route_template(scope)
+        if route in EXEMPT_ROUTES or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        limiter = self.limiter
+        wait = limiter.wait(client_key(scope, route), route) if limiter.buckets is not None else 0.0
+        if wait:
+            await _reject(send, 429, "Too many requests", wait)
+            return
+
+        if route in UNCAPPED_ROUTES:
+            await self.app(scope, receive, send)
+            return
+        if limiter.in_flight >= limiter.max_in_flight:
+            logger.warning("Shedding %s %s: %d requests in flight", scope["method"], route, limiter.in_flight)
+            await _reject(send, 503, "Server busy, retry shortly", ADMISSION_RETRY_AFTER_SECONDS)
+            return
+        limiter.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.in_flight -= 1
@@ -0,0 +1,86 @@
+"""
+Author snapshots on reflections.
+
+create_reflection stores ``author_name`` on the reflection, so the copy in
+every timeline entry carries it and the feed never joins users. When a user
+changes their name, ``propagate_author`` rewrites the snapshots in bulk:
+
+    python authors.py propagate              # every user (also migration 8)
+    python authors.py propagate --user <id>  # one user
+"""
+import argparse
+import asyncio
+from typing import Optional
+
+from bson import ObjectId
+
+from database import db
+import versions
+
+BATCH_SIZE = 1000
+
+
+def author_name(user) -> str:
+    """
+    Display name for a user document or User model: full name, else email.
+    """
+    if isinstance(user, dict):
+        return user.get("full_name") or user["email"]
+    return user.full_name or user.email
+
+
+async def propagate_author(user_id: str, name: str, database=db) -> int:
+    """
+    Rewrites the author snapshot on all of a user's reflections and their
+    timeline copies. Returns the number of reflections updated.
+    """
+    result = await database.reflections.update_many(
+        {"user_id": user_id, "author_name": {"$ne": name}}, {"$set": {"author_name": name}}
+    )
+    # Timeline entries are found through their reflection ids, which keeps
+    # every update on an existing index. Not skipped when no reflection
+    # changed, so a rerun finishes a propagation that was interrupted.
+    batch = []
+    async for reflection in database.reflections.find({"user_id": user_id}, {"_id": 1}):
+        batch.append(reflection["_id"])
+        if len(batch) >= BATCH_SIZE:
+            await _rewrite_timelines(database, batch, name)
+            batch = []
+    if batch:
+        await _rewrite_timelines(database, batch, name)
+    return result.modified_count
+
+
+async def _rewrite_timelines(database, reflection_ids: list, name: str):
+    result = await database.timelines.update_many(
+        {"reflection_id": {"$in": reflection_ids}, "item.author_name": {"$ne": name}},
+        {"$set": {"item.author_name": name}},
+    )
+    if result.modified_count:
+        await versions.bump_matching(
+            database.timelines, {"reflection_id": {"$in": reflection_ids}}, "recipient_id", "feed", database=database
+        )
+
+
+async def propagate_all(database=db, user_id: Optional[str] = None) -> int:
+    query = {"_id": ObjectId(user_id)} if user_id else {}
+    updated = 0
+    async for user in database.users.find(query, {"full_name": 1, "email": 1}):
+        updated += await propagate_author(str(user["_id"]), author_name(user), database)
+    return updated
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Manage author snapshots on reflections.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    propagate = subparsers.add_parser("propagate", help="Rewrite author snapshots from the users collection")
+    propagate.add_argument("--user", help="Only propagate this user id")
+    args = parser.parse_args()
+
+    if args.command == "propagate":
+        updated = await propagate_all(user_id=args.user)
+        print(f"Updated the author snapshot of {updated} reflections")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,352 @@
+"""
+Deterministic synthetic dataset at production scale, bulk-loaded into a
+local mongod.
+
+    MONGODB_URL=mongodb://localhost:27017 python -m benchmarks.dataset
+    python -m benchmarks.dataset --users 10000 --herds 1000 --reflections 100000 --database hlb_small
+
+Writes every collection the API reads, in its current shape, with
+``insert_many``: users (friends, herd index and reflection stats filled
+in), herds, herd_memberships, reflections, reactions and the timelines
+they fan out to. Then it creates the indexes in migrations.INDEXES and
+records every migration as applied, so the app and
+test_query_plans.py can run against it (point the app at it with
+MONGODB_DB).
+
+The same arguments and ``--seed`` always produce the same documents, ids
+included. Skew is Zipf-like throughout (see benchmarks.load.skewed):
+
+- ``--friend-skew``: friends per user, and how much popular users are
+  picked as friends
+- ``--herd-skew``: herd sizes
+- ``--share-skew``: users a reflection is shared with directly, and how
+  much active authors write
+- ``--herd-share-rate``: share of reflections also shared with one of the
+  author's herds, which is what makes timelines big
+
+The ``dataset_info`` collection records the arguments, the counts and
+probes for the heaviest cases (busiest feed, most prolific author,
+biggest herd, most shared reflection), which the plan tests query with.
+The database is dropped first.
+"""
+import argparse
+import asyncio
+import bisect
+import itertools
+import random
+import struct
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import migrations
+from benchmarks.load import skewed
+from database import MONGODB_URL
+
+REACTION_TYPES = ("curious", "love", "hug", "laugh")
+CADENCES = ("daily", "daily", "weekly", "paused")
+# Not a valid bcrypt hash: generated accounts can't log in
+PASSWORD_HASH = "!dataset"
+# Ids embed their creation time; keep them clear of real ones
+KIND_USER, KIND_HERD, KIND_MEMBERSHIP, KIND_REFLECTION, KIND_TIMELINE, KIND_REACTION = range(1, 7)
+
+
+@dataclass
+class DatasetSpec:
+    users: int = 100_000
+    herds: int = 10_000
+    reflections: int = 1_000_000
+    seed: int = 1
+    friend_skew: float = 1.2
+    max_friends: int = 500
+    herd_skew: float = 1.3
+    max_herd_size: int = 500
+    share_skew: float = 1.5
+    max_shared_with: int = 50
+    herd_share_rate: float = 0.2
+    reaction_rate: float = 0.2
+    days: int = 365
+    end: str = "2026-01-01T00:00:00+00:00"
+    batch_size: int = 10_000
+
+
+def object_id(kind: int, seq: int, at: datetime) -> ObjectId:
+    # 4-byte timestamp, then kind and sequence instead of the random and counter bytes
+    return ObjectId(struct.pack(">IB", int(at.timestamp()), kind) + seq.to_bytes(7, "big"))
+
+
+def zipf_cum_weights(n: int, s: float) -> list[float]:
+    return list(itertools.accumulate(1 / (rank + 1) ** s for rank in range(n)))
+
+
+class Popularity:
+    """
+    Draws indexes in ``range(n)`` with Zipf weights over a shuffled order,
+    so the favourites are spread over the id space.
+    """
+
+    def __init__(self, rng: random.Random, n: int, s: float):
+        self.rng = rng
+        self.order = list(range(n))
+        rng.shuffle(self.order)
+        self.cum_weights = zipf_cum_weights(n, s)
+        self.total = self.cum_weights[-1]
+
+    def draw(self) -> int:
+        rank = bisect.bisect(self.cum_weights, self.rng.random() * self.total)
+        return self.order[min(rank, len(self.order) - 1)]
+
+    def sample(self, k: int) -> set[int]:
+        picked: set[int] = set()
+        for _ in range(k * 2):
+            if len(picked) >= k:
+                break
+            picked.add(self.draw())
+        return picked
+
+
+class Writer:
+    """
+    Buffers documents per collection and flushes them with insert_many.
+    """
+
+    def __init__(self, database, batch_size: int):
+        self.database = database
+        self.batch_size = batch_size
+        self.buffers: dict[str, list[dict]] = {}
+        self.counts: dict[str, int] = {}
+
+    async def add(self, collection: str, doc: dict):
+        buffer = self.buffers.setdefault(collection, [])
+        buffer.append(doc)
+        if len(buffer) >= self.batch_size:
+            await self.flush(collection)
+
+    async def flush(self, collection: str = None):
+        for name in [collection] if collection else list(self.buffers):
+            buffer = self.buffers.get(name)
+            if buffer:
+                await self.database[name].insert_many(buffer, ordered=False)
+                self.counts[name] = self.counts.get(name, 0) + len(buffer)
+                self.buffers[name] = []
+
+
+async def generate(database, spec: DatasetSpec, log=print) -> dict:
+    """
+    Loads the dataset described by ``spec`` into ``database`` and returns
+    the dataset_info document.
+    """
+    rng = random.Random(spec.seed)
+    end = datetime.fromisoformat(spec.end)
+    start = end - timedelta(days=spec.days)
+    writer = Writer(database, spec.batch_size)
+
+    user_ids = [object_id(KIND_USER, i, start) for i in range(spec.users)]
+    user_keys = [str(u) for u in user_ids]
+    emails = [f"user{i}@dataset.example" for i in range(spec.users)]
+
+    # Friends: mostly a handful, popular users on many lists
+    popular = Popularity(rng, spec.users, spec.friend_skew)
+    friends: list[list[int]] = []
+    for i in range(spec.users):
+        picked = popular.sample(skewed(rng, spec.users, spec.max_friends, spec.friend_skew)) - {i}
+        friends.append(sorted(picked))
+    log(f"friends: {sum(map(len, friends))} edges")
+
+    # Herds and memberships
+    user_herds: list[list[str]] = [[] for _ in range(spec.users)]
+    herd_members: dict[str, list[int]] = {}
+    membership_seq = itertools.count()
+    for h in range(spec.herds):
+        created = start + timedelta(seconds=rng.uniform(0, spec.days * 86400 / 4))
+        herd_id = object_id(KIND_HERD, h, created)
+        owner = popular.draw()
+        members = [owner] + sorted(popular.sample(skewed(rng, spec.users, spec.max_herd_size, spec.herd_skew) - 1) - {owner})
+        herd_members[str(herd_id)] = members
+        await writer.add("herds", {
+            "_id": herd_id,
+            "name": f"Herd {h}",
+            "description": None,
+            "owner_id": user_keys[owner],
+            "member_count": len(members),
+            "created_at": created.isoformat(),
+            "updated_at": created.isoformat(),
+        })
+        for member in members:
+            user_herds[member].append(str(herd_id))
+            await writer.add("herd_memberships", {
+                "_id": object_id(KIND_MEMBERSHIP, next(membership_seq), created),
+                "herd_id": str(herd_id),
+                "user_id": user_keys[member],
+                "email": emails[member],
+                "joined_at": created,
+                "role": "owner" if member == owner else "member",
+            })
+    await writer.flush()
+    log(f"herds: {spec.herds}, memberships: {writer.counts.get('herd_memberships', 0)}")
+
+    # Reflections in time order, fanned out to timelines as they are written
+    activity = Popularity(rng, spec.users, spec.share_skew)
+    last_reflection_at: list = [None] * spec.users
+    streaks = [0] * spec.users
+    reflections_by_author = [0] * spec.users
+    timeline_sizes = [0] * spec.users
+    timeline_seq, reaction_seq = itertools.count(), itertools.count()
+    hot_reflection, hot_recipients = None, 0
+    step = spec.days * 86400 / max(spec.reflections, 1)
+    for r in range(spec.reflections):
+        at = start + timedelta(seconds=r * step + rng.uniform(0, step))
+        author = activity.draw()
+        reflection_id = object_id(KIND_REFLECTION, r, at)
+        shares = skewed(rng, spec.max_shared_with, spec.max_shared_with, spec.share_skew) - 1
+        shared_with = rng.sample(friends[author], min(len(friends[author]), shares))
+        shared_herds = []
+        if user_herds[author] and rng.random() < spec.herd_share_rate:
+            shared_herds = [rng.choice(user_herds[author])]
+
+        # As timelines.get_recipient_ids computes them
+        recipients = set(shared_with)
+        for herd_id in shared_herds:
+            recipients.update(herd_members[herd_id])
+        recipients = sorted(recipients)
+
+        reactions: dict[int, str] = {}
+        for recipient in recipients:
+            if rng.random() < spec.reaction_rate:
+                reactions[recipient] = rng.choice(REACTION_TYPES)
+        counts: dict[str, int] = {}
+        for reaction_type in reactions.values():
+            counts[reaction_type] = counts.get(reaction_type, 0) + 1
+
+        timestamp = at.isoformat()
+        reflection = {
+            "_id": reflection_id,
+            "high": f"high {r}", "low": f"low {r}", "buffalo": f"buffalo {r}",
+            "sharedWith": [user_keys[f] for f in shared_with],
+            "sharedHerds": shared_herds,
+            "isFlaggedForFollowUp": rng.random() < 0.05,
+            "image_id": None,
+            "user_id": user_keys[author],
+            "author_name": f"User {author}",
+            "timestamp": timestamp,
+            "reaction_counts": counts,
+        }
+        await writer.add("reflections", reflection)
+        for recipient in recipients:
+            await writer.add("timelines", {
+                "_id": object_id(KIND_TIMELINE, next(timeline_seq), at),
+                "recipient_id": user_keys[recipient],
+                "reflection_id": reflection_id,
+                "timestamp": timestamp,
+                "item": reflection,
+                "my_reactions": [reactions[recipient]] if recipient in reactions else [],
+            })
+            timeline_sizes[recipient] += 1
+        for recipient, reaction_type in reactions.items():
+            await writer.add("reactions", {
+                "_id": object_id(KIND_REACTION, next(reaction_seq), at),
+                "reflection_id": reflection_id,
+                "user_id": user_keys[recipient],
+                "type": reaction_type,
+                "created_at": at,
+            })
+        if len(recipients) > hot_recipients:
+            hot_reflection, hot_recipients = reflection_id, len(recipients)
+
+        # reflection_stats, folded in as record_reflection does
+        day = at.date()
+        last = last_reflection_at[author]
+        if last is None or (day - last.date()).days > 1:
+            streaks[author] = 1
+        elif (day - last.date()).days == 1:
+            streaks[author] += 1
+        last_reflection_at[author] = at
+        reflections_by_author[author] += 1
+        if r and r % 100_000 == 0:
+            log(f"reflections: {r}")
+    await writer.flush()
+
+    for i in range(spec.users):
+        await writer.add("users", {
+            "_id": user_ids[i],
+            "email": emails[i],
+            "full_name": f"User {i}",
+            "hashed_password": PASSWORD_HASH,
+            "is_active": True,
+            "settings": {
+                "notificationCadence": CADENCES[i % len(CADENCES)],
+                "friends": [user_keys[f] for f in friends[i]],
+                "herds": user_herds[i],
+            },
+            "last_reflection_at": last_reflection_at[i].isoformat() if last_reflection_at[i] else None,
+            "reflection_streak": streaks[i],
+        })
+    await writer.flush()
+
+    followers = [0] * spec.users
+    for i in range(spec.users):
+        for f in friends[i]:
+            followers[f] += 1
+    argmax = lambda values: max(range(len(values)), key=values.__getitem__)
+    info = {
+        "_id": "dataset",
+        "spec": asdict(spec),
+        "counts": writer.counts,
+        "probes": {
+            "busiest_feed": user_keys[argmax(timeline_sizes)],
+            "most_friends": user_keys[argmax([len(f) for f in friends])],
+            "most_followed": user_keys[argmax(followers)],
+            "most_reflections": user_keys[argmax(reflections_by_author)],
+            "most_herds": user_keys[argmax([len(h) for h in user_herds])],
+            "biggest_herd": max(herd_members, key=lambda h: len(herd_members[h]), default=None),
+            "most_shared_reflection": hot_reflection,
+        },
+    }
+    await database.dataset_info.replace_one({"_id": "dataset"}, info, upsert=True)
+    return info
+
+
+async def prepare_schema(database):
+    """
+    Indexes, plus every migration recorded as applied: the generated data
+    is already in the current shape, so none of them has anything to do.
+    """
+    await migrations.ensure_indexes(database)
+    for m in migrations.MIGRATIONS:
+        await database.schema_migrations.update_one(
+            {"_id": m.version},
+            {"$setOnInsert": {"description": m.description, "applied_at": datetime.now(timezone.utc).isoformat()}},
+            upsert=True,
+        )
+
+
+async def run(args):
+    spec = DatasetSpec(**{k: v for k, v in vars(args).items() if k in DatasetSpec.__dataclass_fields__})
+    client = AsyncIOMotorClient(MONGODB_URL)
+    await client.drop_database(args.database)
+    database = client[args.database]
+
+    started = time.perf_counter()
+    info = await generate(database, spec)
+    loaded = time.perf_counter()
+    # Building indexes once over the loaded data is much faster than maintaining them per insert
+    await prepare_schema(database)
+    print(f"Loaded {info['counts']} in {loaded - started:.1f}s, indexed in {time.perf_counter() - loaded:.1f}s")
+    print(f"Probes: {info['probes']}")
+    client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    defaults = DatasetSpec()
+    parser.add_argument("--database", default="hlb_dataset")
+    for name, value in asdict(defaults).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
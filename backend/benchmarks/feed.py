@@ -0,0 +1,151 @@
+"""
+Feed page latency with and without the author $lookup, against a local mongod.
+
+    MONGODB_URL=mongodb://localhost:27017 python -m benchmarks.feed --reflections 1000000
+
+Seeds a throwaway database with users and timeline entries (each carrying
+a reflection with its author_name snapshot) spread over a set of
+recipients. Then times first-page feed reads for random recipients in two
+ways:
+
+- ``lookup``: the old shape. Range scan the timeline, then $toObjectId and
+  $lookup into users for every row to compute author_name.
+- ``snapshot``: what GET /reflections/feed does now. The same range scan,
+  with author_name read from the stored item.
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import migrations
+from database import MONGODB_URL
+
+
+async def seed(database, reflections: int, users: int, recipients: int, seed: int):
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    await database.users.delete_many({})
+    await database.timelines.delete_many({})
+
+    user_ids = [ObjectId() for _ in range(users)]
+    await database.users.insert_many(
+        [{"_id": u, "email": f"bench{i}@example.com", "full_name": f"Bench User {i}"} for i, u in enumerate(user_ids)],
+        ordered=False,
+    )
+    names = {str(u): f"Bench User {i}" for i, u in enumerate(user_ids)}
+    recipient_ids = [str(u) for u in user_ids[:recipients]]
+
+    batch = []
+    for i in range(reflections):
+        author = str(rng.choice(user_ids))
+        timestamp = (now - timedelta(seconds=rng.uniform(0, 365 * 24 * 3600))).isoformat()
+        reflection_id = ObjectId()
+        batch.append({
+            "recipient_id": recipient_ids[i % recipients],
+            "reflection_id": reflection_id,
+            "timestamp": timestamp,
+            "item": {
+                "_id": reflection_id, "user_id": author, "author_name": names[author],
+                "high": "h" * 80, "low": "l" * 80, "buffalo": "b" * 80,
+                "timestamp": timestamp, "reaction_counts": {"curious": rng.randint(0, 5)},
+            },
+        })
+        if len(batch) >= 10000:
+            await database.timelines.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        await database.timelines.insert_many(batch, ordered=False)
+    return recipient_ids
+
+
+def lookup_pipeline(recipient_id: str, limit: int) -> list[dict]:
+    return [
+        {"$match": {"recipient_id": recipient_id}},
+        {"$sort": {"timestamp": -1, "reflection_id": -1}},
+        {"$limit": limit},
+        {"$set": {"author_oid": {"$toObjectId": "$item.user_id"}}},
+        {"$lookup": {
+            "from": "users",
+            "localField": "author_oid",
+            "foreignField": "_id",
+            "pipeline": [{"$project": {"full_name": 1, "email": 1}}],
+            "as": "author",
+        }},
+        {"$unwind": "$author"},
+        {"$set": {"item.author_name": {"$ifNull": ["$author.full_name", "$author.email"]}}},
+        {"$project": {"item": 1, "timestamp": 1, "reflection_id": 1}},
+    ]
+
+
+async def page_with_lookup(database, recipient_id: str, limit: int) -> list[dict]:
+    return await database.timelines.aggregate(lookup_pipeline(recipient_id, limit)).to_list(limit)
+
+
+async def page_from_snapshot(database, recipient_id: str, limit: int) -> list[dict]:
+    return await (
+        database.timelines.find({"recipient_id": recipient_id}, {"item": 1, "timestamp": 1, "reflection_id": 1})
+        .sort([("timestamp", -1), ("reflection_id", -1)])
+        .limit(limit)
+        .to_list(limit)
+    )
+
+
+async def measure(fn, database, recipient_ids: list[str], iterations: int, limit: int, seed: int) -> list[float]:
+    rng = random.Random(seed)
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        page = await fn(database, rng.choice(recipient_ids), limit)
+        samples.append((time.perf_counter() - started) * 1000)
+        assert all(entry["item"].get("author_name") for entry in page)
+    return samples
+
+
+def summary(samples: list[float]) -> str:
+    ordered = sorted(samples)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return f"p50={statistics.median(ordered):.2f}ms p95={p95:.2f}ms mean={statistics.fmean(ordered):.2f}ms"
+
+
+async def run(args):
+    client = AsyncIOMotorClient(MONGODB_URL)
+    database = client[args.database]
+    await migrations.ensure_indexes(database)
+
+    started = time.perf_counter()
+    recipient_ids = await seed(database, args.reflections, args.users, args.recipients, args.seed)
+    print(f"Seeded {args.reflections} timeline entries for {args.recipients} recipients "
+          f"in {time.perf_counter() - started:.1f}s")
+
+    # Warm the cache so both variants read from memory
+    await measure(page_from_snapshot, database, recipient_ids, args.iterations // 10 or 1, args.limit, args.seed)
+    for label, fn in (("lookup", page_with_lookup), ("snapshot", page_from_snapshot)):
+        samples = await measure(fn, database, recipient_ids, args.iterations, args.limit, args.seed)
+        print(f"{label:>8}: {summary(samples)}")
+
+    if not args.keep:
+        await client.drop_database(args.database)
+    client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reflections", type=int, default=1_000_000, help="Timeline entries to seed")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--recipients", type=int, default=1_000)
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--limit", type=int, default=20, help="Feed page size")
+    parser.add_argument("--database", default="hlb_bench_feed")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="Keep the seeded database")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+"""
+Concurrent load test of the API, in-process or against a running server.
+
+    python -m benchmarks.load --users 200 --rps 100 --duration 60
+    python -m benchmarks.load --target http://localhost:8000 --save baselines/main.json
+    python -m benchmarks.load --compare baselines/main.json --fail-over 20
+
+Seeding goes through the API, so every write path (timelines, herd index,
+versions) runs as in production:
+
+- ``--users`` sign up and log in. Friend lists follow a Zipf-like skew:
+  a few popular users are everyone's friend, most have a handful.
+- ``--herds`` are owned by random users, with sizes drawn from the same skew.
+- ``--reflections`` are written by random users and shared with some of
+  their friends and some of their herds.
+
+Then an open-loop generator starts requests at ``--rps`` for ``--duration``
+seconds, picking each one from ``--mix`` (feed reads, reactions, reflection
+creates, logins by default). Latency is measured from when a request was
+due, not when it went out, so a saturated server shows up as latency rather
+than as a lower request rate (coordinated omission). Requests that would
+exceed ``--concurrency`` are counted as dropped.
+
+The report has throughput and p50/p95/p99 per endpoint. ``--save`` writes it
+as a JSON baseline; ``--compare`` diffs this run against one and, with
+``--fail-over``, exits non-zero when any p95 regressed by more than that
+many percent.
+
+In-process runs (the default) use the app's own MongoDB at MONGODB_URL, or
+with ``--storage memory`` the in-memory storage engine (see storage/), which
+takes the database out of the numbers. Seeded users are tagged with the run id and deleted afterwards unless
+``--keep`` is given.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Optional
+
+import httpx
+
+API = "/api/v1"
+PASSWORD = "load-test-password"
+DEFAULT_MIX = "feed=60,react=20,create=10,login=10"
+
+
+@dataclass
+class Account:
+    email: str
+    id: str = ""
+    headers: dict = field(default_factory=dict)
+    friends: list[str] = field(default_factory=list)
+    herds: list[str] = field(default_factory=list)
+
+
+@dataclass
+class World:
+    run_id: str
+    accounts: list[Account]
+    reflection_ids: list[str] = field(default_factory=list)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.dropped = 0
+
+    def record(self, endpoint: str, seconds: float, ok: bool):
+        self.latencies[endpoint].append(seconds)
+        if not ok:
+            self.errors[endpoint] += 1
+
+    def report(self, elapsed: float) -> dict:
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            ordered = sorted(latencies)
+            endpoints[endpoint] = {
+                "requests": len(ordered),
+                "errors": self.errors[endpoint],
+                "rps": round(len(ordered) / elapsed, 2),
+                "p50_ms": round(percentile(ordered, 0.50) * 1000, 2),
+                "p95_ms": round(percentile(ordered, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(ordered, 0.99) * 1000, 2),
+                "max_ms": round(ordered[-1] * 1000, 2),
+                "mean_ms": round(statistics.fmean(ordered) * 1000, 2),
+            }
+        return {"elapsed_seconds": round(elapsed, 2), "dropped": self.dropped, "endpoints": endpoints}
+
+
+def percentile(ordered: list[float], p: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def skewed(rng: random.Random, n: int, limit: int, s: float = 1.2) -> int:
+    # Zipf-like: mostly small, occasionally close to ``limit``
+    return min(limit, max(1, int(n / (rng.random() * (n ** s - 1) + 1) ** (1 / s))))
+
+
+def parse_mix(spec: str) -> dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+async def _expect(response: httpx.Response, *statuses: int) -> httpx.Response:
+    if response.status_code not in statuses:
+        raise RuntimeError(f"{response.request.method} {response.request.url}: {response.status_code} {response.text}")
+    return response
+
+
+async def gather_bounded(limit: int, coroutines):
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(c) for c in coroutines))
+
+
+async def seed(client: httpx.AsyncClient, args, rng: random.Random) -> World:
+    run_id = uuid.uuid4().hex[:8]
+    accounts = [Account(email=f"load-{run_id}-{i}@example.com") for i in range(args.users)]
+
+    async def sign_up(account: Account):
+        response = await _expect(await client.post(f"{API}/auth/signup", json={
+            "email": account.email, "password": PASSWORD, "full_name": account.email.split("@")[0],
+        }), 200)
+        account.id = response.json()["id"]
+        response = await _expect(
+            await client.post(f"{API}/auth/token", data={"username": account.email, "password": PASSWORD}), 200
+        )
+        account.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    started = time.perf_counter()
+    await gather_bounded(args.seed_concurrency, (sign_up(a) for a in accounts))
+
+    # Popularity follows account order, so low indexes collect most friendships
+    popularity = [1 / (i + 1) for i in range(len(accounts))]
+    for account in accounts:
+        others = rng.choices(accounts, weights=popularity, k=skewed(rng, len(accounts), args.max_friends))
+        account.friends = sorted({a.id for a in others if a.id != account.id})
+
+    async def befriend(account: Account):
+        if account.friends:
+            await _expect(await client.put(f"{API}/users/me/settings", headers=account.headers, json={
+                "notificationCadence": "daily", "friends": account.friends,
+            }), 200)
+
+    await gather_bounded(args.seed_concurrency, (befriend(a) for a in accounts))
+
+    async def create_herd(index: int):
+        owner = rng.choice(accounts)
+        response = await _expect(
+            await client.post(f"{API}/herds/", headers=owner.headers, json={"name": f"load-{run_id}-{index}"}), 201
+        )
+        herd_id = response.json()["id"]
+        owner.herds.append(herd_id)
+        members = {m.email: m for m in rng.sample(accounts, skewed(rng, len(accounts), args.max_herd_size))}
+        members.pop(owner.email, None)
+        for member in members.values():
+            await _expect(await client.post(
+                f"{API}/herds/{herd_id}/members", headers=owner.headers, json={"email": member.email}
+            ), 200)
+            member.herds.append(herd_id)
+
+    await gather_bounded(args.seed_concurrency, (create_herd(i) for i in range(args.herds)))
+
+    world = World(run_id, accounts)
+
+    async def create_reflection(_):
+        author = rng.choice(accounts)
+        response = await _expect(await client.post(f"{API}/reflections/", headers=author.headers, json=reflection_body(rng, author)), 201)
+        world.reflection_ids.append(response.json()["id"])
+
+    await gather_bounded(args.seed_concurrency, (create_reflection(i) for i in range(args.reflections)))
+    print(f"Seeded {len(accounts)} users, {args.herds} herds and {args.reflections} reflections "
+          f"in {time.perf_counter() - started:.1f}s (run {run_id})")
+    return world
+
+
+def reflection_body(rng: random.Random, author: Account) -> dict:
+    shared_with = rng.sample(author.friends, min(len(author.friends), rng.randint(0, 5)))
+    shared_herds = rng.sample(author.herds, min(len(author.herds), rng.randint(0, 2)))
+    return {
+        "high": "h" * rng.randint(20, 200), "low": "l" * rng.randint(20, 200), "buffalo": "b" * rng.randint(20, 200),
+        "sharedWith": shared_with, "sharedHerds": shared_herds,
+    }
+
+
+# Each scenario sends one request and returns (endpoint label, ok)
+
+async def feed(client: httpx.AsyncClient, world: World, rng: random.Random):
+    account = rng.choice(world.accounts)
+    response = await client.get(f"{API}/reflections/feed", headers=account.headers)
+    return "GET /reflections/feed", response.status_code == 200
+
+
+async def react(client: httpx.AsyncClient, world: World, rng: random.Random):
+    account = rng.choice(world.accounts)
+    reflection_id = rng.choice(world.reflection_ids)
+    response = await client.post(
+        f"{API}/reflections/{reflection_id}/react", headers=account.headers, json={"type": "curious"}
+    )
+    # Reacting to a reflection that isn't shared with you is a normal 403
+    return "POST /reflections/{id}/react", response.status_code in (200, 403)
+
+
+async def create(client: httpx.AsyncClient, world: World, rng: random.Random):
+    author = rng.choice(world.accounts)
+    response = await client.post(f"{API}/reflections/", headers=author.headers, json=reflection_body(rng, author))
+    if response.status_code == 201:
+        world.reflection_ids.append(response.json()["id"])
+    return "POST /reflections/", response.status_code == 201
+
+
+async def login(client: httpx.AsyncClient, world: World, rng: random.Random):
+    account = rng.choice(world.accounts)
+    response = await client.post(f"{API}/auth/token", data={"username": account.email, "password": PASSWORD})
+    return "POST /auth/token", response.status_code == 200
+
+
+SCENARIOS = {"feed": feed, "react": react, "create": create, "login": login}
+
+
+async def drive(client: httpx.AsyncClient, world: World, args, rng: random.Random) -> dict:
+    mix = parse_mix(args.mix)
+    names, weights = list(mix), list(mix.values())
+    recorder = Recorder()
+    in_flight: set[asyncio.Task] = set()
+
+    async def one(scenario, due: float):
+        try:
+            endpoint, ok = await scenario(client, world, rng)
+        except httpx.HTTPError:
+            endpoint, ok = f"{scenario.__name__} (transport error)", False
+        recorder.record(endpoint, time.perf_counter() - due, ok)
+
+    interval = 1 / args.rps
+    started = time.perf_counter()
+    sent = 0
+    while (now := time.perf_counter()) - started < args.duration:
+        # Start every request that is due by now, keeping to the schedule even when behind
+        while started + sent * interval <= now:
+            due = started + sent * interval
+            sent += 1
+            if len(in_flight) >= args.concurrency:
+                recorder.dropped += 1
+                continue
+            scenario = SCENARIOS[rng.choices(names, weights)[0]]
+            task = asyncio.create_task(one(scenario, due))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        await asyncio.sleep(max(0.0, started + sent * interval - time.perf_counter()))
+    if in_flight:
+        await asyncio.wait(in_flight)
+    return recorder.report(time.perf_counter() - started)
+
+
+async def cleanup(run_id: str):
+    from database import db
+
+    users = [u async for u in db.users.find({"email": {"$regex": f"^load-{run_id}-"}}, {"_id": 1})]
+    user_ids = [str(u["_id"]) for u in users]
+    herd_ids = [str(h["_id"]) async for h in db.herds.find({"owner_id": {"$in": user_ids}}, {"_id": 1})]
+    reflection_ids = [r["_id"] async for r in db.reflections.find({"user_id": {"$in": user_ids}}, {"_id": 1})]
+    await db.reactions.delete_many({"reflection_id": {"$in": reflection_ids}})
+    await db.timelines.delete_many({"recipient_id": {"$in": user_ids}})
+    await db.reflections.delete_many({"user_id": {"$in": user_ids}})
+    await db.herd_memberships.delete_many({"herd_id": {"$in": herd_ids}})
+    await db.herds.delete_many({"owner_id": {"$in": user_ids}})
+    await db.user_versions.delete_many({"_id": {"$in": user_ids}})
+    await db.users.delete_many({"_id": {"$in": [u["_id"] for u in users]}})
+
+
+@asynccontextmanager
+async def api_client(target: str, concurrency: int, storage: str = "mongo"):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    if target == "inprocess":
+        from main import app
+        from admission import limiter
+        from storage import store
+
+        store.configure(storage)
+        # Seeding alone would exhaust the signup budget; measure the app, not the limiter
+        limiter.configure("off")
+        limiter.max_in_flight = max(limiter.max_in_flight, concurrency)
+
+        # ASGITransport doesn't run the lifespan; migrations and the buses need it
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://load", timeout=60) as client:
+                yield client
+    else:
+        async with httpx.AsyncClient(base_url=target, limits=limits, timeout=60) as client:
+            yield client
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report: dict):
+    print(f"\n{'endpoint':<34} {'reqs':>7} {'err':>5} {'rps':>8} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for endpoint, s in report["endpoints"].items():
+        print(f"{endpoint:<34} {s['requests']:>7} {s['errors']:>5} {s['rps']:>8.1f} "
+              f"{s['p50_ms']:>7.1f}ms {s['p95_ms']:>7.1f}ms {s['p99_ms']:>7.1f}ms")
+    if report["dropped"]:
+        print(f"dropped (over --concurrency): {report['dropped']}")
+
+
+def compare(report: dict, baseline: dict) -> dict[str, float]:
+    """
+    Prints this run against ``baseline`` and returns the p95 change of every
+    endpoint in both, in percent.
+    """
+    print(f"\nvs baseline {baseline.get('meta', {}).get('revision') or ''} ({baseline.get('meta', {}).get('created_at', '?')})")
+    print(f"{'endpoint':<34} {'p50':>16} {'p95':>16} {'p99':>16} {'rps':>14}")
+    p95_changes = {}
+    for endpoint, s in report["endpoints"].items():
+        old = baseline.get("endpoints", {}).get(endpoint)
+        if old is None:
+            print(f"{endpoint:<34} (new)")
+            continue
+        cells = []
+        for key in ("p50_ms", "p95_ms", "p99_ms", "rps"):
+            change = (s[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+            cells.append(f"{old[key]:>7.1f}->{s[key]:<7.1f}{change:+.0f}%")
+        print(f"{endpoint:<34} " + " ".join(cells))
+        if old["p95_ms"]:
+            p95_changes[endpoint] = (s["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100
+    return p95_changes
+
+
+async def run(args) -> int:
+    rng = random.Random(args.seed)
+    async with api_client(args.target, args.concurrency, args.storage) as client:
+        world = await seed(client, args, rng)
+        try:
+            report = await drive(client, world, args, rng)
+        finally:
+            # The memory engine's data goes away with the process
+            if not args.keep and not (args.target == "inprocess" and args.storage == "memory"):
+                await cleanup(world.run_id)
+
+    report["meta"] = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "revision": git_revision(),
+        "target": args.target,
+        "storage": args.storage,
+        **{k: getattr(args, k) for k in ("users", "herds", "reflections", "rps", "duration", "mix", "concurrency", "seed")},
+    }
+    print_report(report)
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        p95_changes = compare(report, baseline)
+        if args.fail_over is not None:
+            over = [f"{e}: {c:+.0f}%" for e, c in p95_changes.items() if c > args.fail_over]
+            if over:
+                print(f"\np95 regressed by more than {args.fail_over}%: " + "; ".join(over))
+                return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", default="inprocess", help='"inprocess" or a base URL such as http://localhost:8000')
+    parser.add_argument("--storage", choices=["mongo", "memory"], default="mongo", help="Storage engine for in-process runs")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--herds", type=int, default=10)
+    parser.add_argument("--reflections", type=int, default=500)
+    parser.add_argument("--max-friends", type=int, default=50)
+    parser.add_argument("--max-herd-size", type=int, default=30)
+    parser.add_argument("--rps", type=float, default=50, help="Target request rate")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of load after seeding")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Scenario weights, default {DEFAULT_MIX}")
+    parser.add_argument("--concurrency", type=int, default=200, help="Most requests in flight at once")
+    parser.add_argument("--seed-concurrency", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="Write the report as a JSON baseline")
+    parser.add_argument("--compare", help="Baseline JSON to diff this run against")
+    parser.add_argument("--fail-over", type=float, help="Exit 1 when a p95 regressed by more than this many percent")
+    parser.add_argument("--keep", action="store_true", help="Keep the seeded users and their data")
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Reminder dispatcher throughput against a local mongod.
+
+    MONGODB_URL=mongodb://localhost:27017 python -m benchmarks.reminders --users 100000
+
+Seeds a throwaway database with users (a mix of daily, weekly and paused
+cadences, some of whom already reflected today), then runs the dispatcher
+twice with a sender that only simulates network latency. The second run
+shows the cost of a re-run where every reminder is already recorded.
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import migrations
+from database import MONGODB_URL
+from reminders import dispatch_reminders
+from utils.email import EmailSender
+
+
+class SimulatedSender(EmailSender):
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def send(self, to, subject, body):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+async def seed(database, users: int, seed: int):
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    await database.users.delete_many({})
+    await database.reflections.delete_many({})
+    await database.reminder_deliveries.delete_many({})
+
+    batch_users, batch_reflections = [], []
+    for i in range(users):
+        user_id = ObjectId()
+        cadence = rng.choices(["daily", "weekly", "paused"], weights=[70, 25, 5])[0]
+        user = {
+            "_id": user_id,
+            "email": f"bench{i}@example.com",
+            "is_active": True,
+            "settings": {"notificationCadence": cadence, "herds": [], "friends": []},
+        }
+        # Roughly half of users reflected at some point in the last two weeks
+        if rng.random() < 0.5:
+            timestamp = (now - timedelta(hours=rng.uniform(0, 14 * 24))).isoformat()
+            batch_reflections.append({
+                "user_id": str(user_id),
+                "high": "h", "low": "l", "buffalo": "b",
+                "timestamp": timestamp,
+            })
+            user.update(last_reflection_at=timestamp, reflection_streak=1)
+        batch_users.append(user)
+        if len(batch_users) >= 10000:
+            await database.users.insert_many(batch_users, ordered=False)
+            if batch_reflections:
+                await database.reflections.insert_many(batch_reflections, ordered=False)
+            batch_users, batch_reflections = [], []
+    if batch_users:
+        await database.users.insert_many(batch_users, ordered=False)
+    if batch_reflections:
+        await database.reflections.insert_many(batch_reflections, ordered=False)
+
+
+async def run(args):
+    client = AsyncIOMotorClient(MONGODB_URL)
+    database = client[args.database]
+    await migrations.ensure_indexes(database)
+
+    started = time.perf_counter()
+    await seed(database, args.users, args.seed)
+    print(f"Seeded {args.users} users in {time.perf_counter() - started:.1f}s")
+
+    sender = SimulatedSender(args.latency_ms / 1000)
+    for label in ("first run", "re-run"):
+        stats = await dispatch_reminders(database, sender=sender, workers=args.workers)
+        result = stats.as_dict()
+        print(f"{label:>9}: due={result['due']} sent={result['sent']} skipped={result['skipped']} "
+              f"failed={result['failed']} in {result['seconds']}s ({result['per_second']}/s)")
+
+    if not args.keep:
+        await client.drop_database(args.database)
+    client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="Simulated time per send")
+    parser.add_argument("--database", default="hlb_bench_reminders")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="Keep the seeded database")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Per-schema serialization cost of a list page. No database needed.
+
+    python -m benchmarks.serialization --rows 100
+
+Builds pages of synthetic documents shaped like what MongoDB returns (ObjectId
+ids, nested reaction maps, datetimes) and times, for every list schema:
+
+- ``validate``: what FastAPI does with a plain return value. Validate the
+  page against the response model, then dump it to JSON.
+- ``to_json``: the fast path, encoded with pydantic-core. Reshape the
+  trusted documents (serialization.document) and encode them without
+  building models.
+- ``orjson``: the same documents encoded with orjson, which is what
+  serialization.page_response uses when orjson is installed.
+"""
+import argparse
+import random
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from pydantic_core import to_json
+
+import serialization
+from schemas import Reflection, ReflectionFeedItem, Herd, HerdMember
+from serialization import document, page_adapter
+
+
+def reflection_doc(rng: random.Random, now: datetime) -> dict:
+    timestamp = (now - timedelta(seconds=rng.uniform(0, 365 * 24 * 3600))).isoformat()
+    return {
+        "_id": ObjectId(), "user_id": str(ObjectId()), "author_name": "Bench User",
+        "high": "h" * 80, "low": "l" * 80, "buffalo": "b" * 80,
+        "sharedWith": [str(ObjectId()) for _ in range(rng.randint(0, 5))],
+        "sharedHerds": [str(ObjectId()) for _ in range(rng.randint(0, 3))],
+        "timestamp": timestamp, "isFlaggedForFollowUp": rng.random() < 0.1,
+        "reaction_counts": {t: rng.randint(0, 50) for t in ("curious", "hug", "laugh", "wow")},
+    }
+
+
+def feed_doc(rng: random.Random, now: datetime) -> dict:
+    doc = reflection_doc(rng, now)
+    doc["my_reactions"] = rng.sample(["curious", "hug", "laugh", "wow"], rng.randint(0, 2))
+    doc["image_id"] = "a" * 64
+    doc["thumbnail_url"] = f"/api/v1/images/{doc['image_id']}/thumbnail/md"
+    return doc
+
+
+def herd_doc(rng: random.Random, now: datetime) -> dict:
+    created = (now - timedelta(days=rng.uniform(0, 365))).isoformat()
+    return {
+        "_id": ObjectId(), "name": "Bench herd", "description": "d" * 60, "owner_id": str(ObjectId()),
+        "member_count": rng.randint(1, 200), "created_at": created, "updated_at": created,
+    }
+
+
+def member_doc(rng: random.Random, now: datetime) -> dict:
+    return {
+        "_id": ObjectId(), "herd_id": str(ObjectId()), "user_id": str(ObjectId()),
+        "email": f"bench{rng.randint(0, 10**6)}@example.com",
+        "joined_at": now - timedelta(days=rng.uniform(0, 365)), "role": "member",
+    }
+
+
+SCHEMAS = {
+    "Reflection": (Reflection, reflection_doc),
+    "ReflectionFeedItem": (ReflectionFeedItem, feed_doc),
+    "Herd": (Herd, herd_doc),
+    "HerdMember": (HerdMember, member_doc),
+}
+
+
+def validate_then_dump(model, docs):
+    adapter = page_adapter(model)
+    page = adapter.validate_python({"items": docs, "next_cursor": None})
+    return adapter.dump_json(page, by_alias=False)
+
+
+def reshape_then_to_json(model, docs):
+    return to_json({"items": [document(model, doc) for doc in docs], "next_cursor": None}, fallback=str)
+
+
+def reshape_then_orjson(model, docs):
+    return serialization.orjson.dumps(
+        {"items": [document(model, doc) for doc in docs], "next_cursor": None},
+        default=str, option=serialization.orjson.OPT_UTC_Z,
+    )
+
+
+def measure(fn, model, docs, iterations: int) -> list[float]:
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn(model, docs)
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def summary(samples: list[float]) -> str:
+    ordered = sorted(samples)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return f"p50={statistics.median(ordered):.3f}ms p95={p95:.3f}ms mean={statistics.fmean(ordered):.3f}ms"
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    now = datetime.now(timezone.utc)
+    variants = [("validate", validate_then_dump), ("to_json", reshape_then_to_json)]
+    if serialization.orjson is not None:
+        variants.append(("orjson", reshape_then_orjson))
+
+    for name, (model, make_doc) in SCHEMAS.items():
+        docs = [make_doc(rng, now) for _ in range(args.rows)]
+        # The fast path must not change the bytes clients receive
+        expected = validate_then_dump(model, docs)
+        assert all(fn(model, docs) == expected for _, fn in variants), name
+        print(f"{name} ({args.rows} rows)")
+        for label, fn in variants:
+            measure(fn, model, docs, args.iterations // 10 or 1)
+            print(f"  {label:>9}: {summary(measure(fn, model, docs, args.iterations))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100, help="Documents per page")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
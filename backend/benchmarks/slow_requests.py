@@ -0,0 +1,86 @@
+"""
+Per-request overhead of the metrics and slow-request middlewares. No
+database needed.
+
+    python -m benchmarks.slow_requests --requests 5000
+
+Drives a trivial endpoint in-process through httpx's ASGI transport, with:
+
+- ``bare``: no middleware.
+- ``metrics``: MetricsMiddleware only.
+- ``metrics+slow``: MetricsMiddleware and SlowRequestMiddleware, profiling
+  off. This is what main.py runs for every request.
+- ``profiled``: the same with an admin's X-Profile header, for scale. Needs
+  pyinstrument and ADMIN_TOKEN.
+
+The difference between ``bare`` and ``metrics+slow`` is what every request
+pays for being observable.
+"""
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+
+import httpx
+from fastapi import FastAPI
+
+import deps
+import metrics
+import slow_requests
+
+
+def build_app(*middlewares) -> FastAPI:
+    app = FastAPI()
+    for middleware, options in middlewares:
+        app.add_middleware(middleware, **options)
+
+    @app.get("/items/{item_id}")
+    async def read_item(item_id: str):
+        return {"id": item_id}
+
+    return app
+
+
+async def time_requests(app: FastAPI, requests: int, headers: dict) -> list[float]:
+    transport = httpx.ASGITransport(app=app)
+    timings = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for i in range(requests):
+            started = time.perf_counter()
+            await client.get(f"/items/{i}", headers=headers)
+            timings.append(time.perf_counter() - started)
+    return timings
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+
+    profile_dir = tempfile.mkdtemp(prefix="hlb-bench-profiles-")
+    slow = (slow_requests.SlowRequestMiddleware, {"profile_dir": profile_dir})
+    cases = {
+        "bare": (build_app(), {}),
+        "metrics": (build_app((metrics.MetricsMiddleware, {})), {}),
+        "metrics+slow": (build_app(slow, (metrics.MetricsMiddleware, {})), {}),
+    }
+    if slow_requests.Profiler is not None and deps.ADMIN_TOKEN:
+        headers = {"X-Profile": "speedscope", "X-Admin-Token": deps.ADMIN_TOKEN}
+        cases["profiled"] = (build_app(slow, (metrics.MetricsMiddleware, {})), headers)
+
+    medians = {}
+    print(f"{'case':<14} {'median':>10} {'p99':>10}")
+    for name, (app, headers) in cases.items():
+        # Profiling writes a file per request; fewer of them say enough
+        requests = args.requests if name != "profiled" else max(args.requests // 50, 10)
+        await time_requests(app, min(requests, 200), headers)
+        timings = sorted(await time_requests(app, requests, headers))
+        medians[name] = statistics.median(timings)
+        p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+        print(f"{name:<14} {medians[name] * 1e6:>8.1f}us {p99 * 1e6:>8.1f}us")
+    print(f"overhead with profiling off: {(medians['metrics+slow'] - medians['bare']) * 1e6:.1f}us per request")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,59 @@
+"""
+Thumbnail pipeline throughput: images per second, per core.
+
+    python -m benchmarks.thumbnails --images 40 --workers 1 2 4
+
+Renders synthetic phone-sized JPEGs through imaging.render_variants in a
+ProcessPoolExecutor, the same way thumbnails.ThumbnailPipeline does.
+"""
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+import imaging
+
+
+def make_photo(width: int, height: int, seed: int) -> bytes:
+    # Noise over a gradient compresses roughly like a real photo
+    gradient = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    noise = Image.effect_noise((width, height), 40 + seed % 20).convert("RGB")
+    img = Image.blend(gradient, noise, 0.25)
+    out = BytesIO()
+    img.save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+def run(images: list[bytes], workers: int) -> float:
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        # Warm the workers up so process start-up isn't measured
+        list(pool.map(imaging.render_variants, images[:workers]))
+        start = time.perf_counter()
+        list(pool.map(imaging.render_variants, images))
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=40)
+    parser.add_argument("--width", type=int, default=4032)
+    parser.add_argument("--height", type=int, default=3024)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    images = [make_photo(args.width, args.height, i) for i in range(args.images)]
+    avg_kb = sum(len(i) for i in images) / len(images) / 1024
+    print(f"{args.images} images, {args.width}x{args.height}, {avg_kb:.0f} KiB average, "
+          f"{len(imaging.THUMBNAIL_WIDTHS)} widths x {len(imaging.OUTPUT_FORMATS)} formats each")
+    print(f"{'workers':>8} {'seconds':>9} {'images/s':>9} {'images/s/core':>14}")
+    for workers in args.workers:
+        elapsed = run(images, workers)
+        rate = len(images) / elapsed
+        print(f"{workers:>8} {elapsed:>9.2f} {rate:>9.1f} {rate / workers:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
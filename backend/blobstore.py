@@ -0,0 +1,241 @@
+"""
+Content-addressed storage for reflection images.
+
+Blobs are keyed by the SHA-256 of their bytes, which doubles as a strong
+ETag and makes every stored blob immutable (identical uploads are stored
+once, and every user who uploaded them is recorded as an owner). Two backends share the ``BlobStore`` interface:
+
+- ``GridFSBlobStore`` keeps blobs in the ``images`` GridFS bucket (default).
+- ``LocalBlobStore`` keeps them under ``BLOB_DIR`` on the local filesystem.
+
+Select one with ``BLOB_STORE=gridfs|local``.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import os
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import AsyncIterator, BinaryIO, Optional
+
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+from database import db, resolve
+
+BLOB_STORE = os.getenv("BLOB_STORE", "gridfs")
+BLOB_DIR = os.getenv("BLOB_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "blobs"))
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", 5 * 1024 * 1024))
+CHUNK_SIZE = 255 * 1024  # GridFS default chunk size
+
+
+class BlobTooLargeError(ValueError):
+    pass
+
+
+def is_valid_blob_id(blob_id: str) -> bool:
+    return len(blob_id) == 64 and all(c in "0123456789abcdef" for c in blob_id)
+
+
+@dataclass
+class BlobInfo:
+    id: str
+    length: int
+    content_type: str
+    owner_id: Optional[str] = None
+    # Everyone who uploaded these bytes; owner_id is the first of them
+    owner_ids: list[str] = field(default_factory=list)
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.id}"'
+
+    def owned_by(self, user_id: str) -> bool:
+        return user_id in self.owner_ids or user_id == self.owner_id
+
+
+def hash_stream(source: BinaryIO, max_bytes: int = MAX_IMAGE_BYTES) -> tuple[str, int]:
+    """
+    Returns (sha256 hex digest, length) of a seekable file object and
+    rewinds it. Raises BlobTooLargeError past ``max_bytes``.
+    """
+    digest = hashlib.sha256()
+    length = 0
+    while chunk := source.read(CHUNK_SIZE):
+        length += len(chunk)
+        if length > max_bytes:
+            raise BlobTooLargeError(f"Blob exceeds {max_bytes} bytes")
+        digest.update(chunk)
+    source.seek(0)
+    return digest.hexdigest(), length
+
+
+class BlobStore(ABC):
+    @abstractmethod
+    async def put(self, source: BinaryIO, content_type: str, owner_id: Optional[str] = None) -> BlobInfo:
+        """Stores the contents of a seekable file object."""
+
+    @abstractmethod
+    async def stat(self, blob_id: str) -> Optional[BlobInfo]:
+        """Returns the blob's metadata, or None if it does not exist."""
+
+    @abstractmethod
+    def iter_range(self, blob_id: str, start: int, end: int) -> AsyncIterator[bytes]:
+        """Yields the bytes in [start, end] (inclusive) in chunks."""
+
+    async def put_bytes(self, data: bytes, content_type: str, owner_id: Optional[str] = None) -> BlobInfo:
+        return await self.put(io.BytesIO(data), content_type, owner_id)
+
+
+class GridFSBlobStore(BlobStore):
+    def __init__(self, database, bucket_name: str = "images"):
+        self.database = database
+        self.bucket_name = bucket_name
+        self._bucket = self._bucket_database = None
+
+    @property
+    def files(self):
+        return self.database[f"{self.bucket_name}.files"]
+
+    @property
+    def bucket(self) -> AsyncIOMotorGridFSBucket:
+        # Built on first use, and again after the app's lifespan reopens the client (see database.py)
+        database = resolve(self.database)
+        if self._bucket is None or self._bucket_database is not database:
+            self._bucket = AsyncIOMotorGridFSBucket(database, bucket_name=self.bucket_name, chunk_size_bytes=CHUNK_SIZE)
+            self._bucket_database = database
+        return self._bucket
+
+    async def put(self, source, content_type, owner_id=None):
+        blob_id, length = await asyncio.to_thread(hash_stream, source)
+        owner_ids = [owner_id] if owner_id else []
+        info = BlobInfo(id=blob_id, length=length, content_type=content_type, owner_id=owner_id, owner_ids=owner_ids)
+        if owner_id:
+            exists = (await self.files.update_one(
+                {"_id": blob_id}, {"$addToSet": {"metadata.owner_ids": owner_id}}
+            )).matched_count
+        else:
+            exists = await self.files.count_documents({"_id": blob_id}, limit=1)
+        if exists:
+            return info
+
+        await self.bucket.upload_from_stream_with_id(
+            blob_id,
+            blob_id,
+            source,
+            metadata={"contentType": content_type, "owner_id": owner_id, "owner_ids": owner_ids},
+        )
+        return info
+
+    async def stat(self, blob_id):
+        doc = await self.files.find_one({"_id": blob_id}, {"length": 1, "metadata": 1})
+        if not doc:
+            return None
+        metadata = doc.get("metadata") or {}
+        return BlobInfo(
+            id=blob_id,
+            length=doc["length"],
+            content_type=metadata.get("contentType", "application/octet-stream"),
+            owner_id=metadata.get("owner_id"),
+            owner_ids=metadata.get("owner_ids") or [],
+        )
+
+    async def iter_range(self, blob_id, start, end):
+        grid_out = await self.bucket.open_download_stream(blob_id)
+        grid_out.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await grid_out.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+class LocalBlobStore(BlobStore):
+    def __init__(self, root: str = BLOB_DIR):
+        self.root = root
+
+    def _path(self, blob_id: str) -> str:
+        return os.path.join(self.root, blob_id[:2], blob_id)
+
+    def _write_meta(self, path: str, meta: dict):
+        tmp_path = f"{path}.json.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, f"{path}.json")
+
+    def _write(self, source: BinaryIO, blob_id: str, meta: dict):
+        path = self._path(blob_id)
+        if os.path.exists(path):
+            stored = self._read_meta(blob_id)
+            owner_ids = stored.setdefault("owner_ids", [])
+            if meta["owner_id"] and meta["owner_id"] not in owner_ids:
+                owner_ids.append(meta["owner_id"])
+                self._write_meta(path, stored)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temp file and rename so readers never see a partial blob
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            while chunk := source.read(CHUNK_SIZE):
+                f.write(chunk)
+        self._write_meta(path, meta)
+        os.replace(tmp_path, path)
+
+    async def put(self, source, content_type, owner_id=None):
+        blob_id, length = await asyncio.to_thread(hash_stream, source)
+        meta = {
+            "length": length,
+            "contentType": content_type,
+            "owner_id": owner_id,
+            "owner_ids": [owner_id] if owner_id else [],
+            "uploaded_at": datetime.now(timezone.utc).isoformat(),
+        }
+        await asyncio.to_thread(self._write, source, blob_id, meta)
+        return BlobInfo(
+            id=blob_id, length=length, content_type=content_type, owner_id=owner_id, owner_ids=meta["owner_ids"]
+        )
+
+    def _read_meta(self, blob_id: str) -> Optional[dict]:
+        path = self._path(blob_id)
+        if not os.path.exists(path):
+            return None
+        with open(f"{path}.json") as f:
+            return json.load(f)
+
+    async def stat(self, blob_id):
+        meta = await asyncio.to_thread(self._read_meta, blob_id)
+        if meta is None:
+            return None
+        return BlobInfo(
+            id=blob_id,
+            length=meta["length"],
+            content_type=meta["contentType"],
+            owner_id=meta.get("owner_id"),
+            owner_ids=meta.get("owner_ids") or [],
+        )
+
+    async def iter_range(self, blob_id, start, end):
+        f = await asyncio.to_thread(open, self._path(blob_id), "rb")
+        try:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await asyncio.to_thread(f.read, min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            f.close()
+
+
+def get_blob_store(database=db) -> BlobStore:
+    if BLOB_STORE == "local":
+        return LocalBlobStore()
+    return GridFSBlobStore(database)
+
+
+blob_store = get_blob_store()
@@ -0,0 +1,75 @@
+"""
+Small in-process caches.
+
+Each gunicorn worker has its own copy, so entries must either be safe to
+serve slightly stale (bounded by the TTL) or be invalidated explicitly by
+the write paths that change them.
+
+Caches given a ``name`` also count their hits and misses on /metrics
+(``cache_hits_total`` / ``cache_misses_total``, see metrics.py).
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from metrics import CACHE_HITS, CACHE_MISSES
+
+
+class TTLCache:
+    """
+    LRU cache whose entries also expire ``ttl`` seconds after being set.
+    Not thread-safe; meant to be used from a single event loop.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, name: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Labelled once here, not on every lookup
+        self._hit_counter = CACHE_HITS.labels(name) if name else None
+        self._miss_counter = CACHE_MISSES.labels(name) if name else None
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            if self._miss_counter is not None:
+                self._miss_counter.inc()
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        if self._hit_counter is not None:
+            self._hit_counter.inc()
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any):
+        if self.max_entries <= 0 or self.ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -1,10 +1,356 @@
+"""
+The MongoDB connection: client lifecycle, pool and wire settings, and read
+routing.
+
+``mongo`` owns the Motor client. main.py opens it in the app's lifespan,
+so each gunicorn worker connects once it starts serving, warms its pool,
+and closes it on shutdown. Scripts and tests that never run the lifespan
+get a client opened on first use. ``db`` stands in for the database of the
+current client, so modules can keep importing it and defaulting
+``database=db`` parameters to it.
+
+Settings, per worker process (start.sh runs 4):
+
+- MONGODB_MAX_POOL_SIZE / MONGODB_MIN_POOL_SIZE: connections per server
+- MONGODB_COMPRESSORS: wire compression, in order of preference. zstd and
+  snappy are optional extras (see pymongo's docs for the package each
+  needs); the ones not installed are left out, and the server picks among
+  the rest. Uncompressed when none is available.
+- MONGODB_HISTORY_READS: read preference for feed and history pages
+  (``history_reads``). Everything else, writes and the reads that decide
+  them included, goes to the primary.
+- MONGODB_MAX_STALENESS_SECONDS: how far behind a secondary may be to
+  serve history reads. MongoDB requires at least 90.
+
+History reads on a secondary could be older than the version their ETag
+was computed from, and a client would then keep the stale page until the
+next change. ``request_session`` runs a request's version lookup and its
+history read in one causally consistent session, so the secondary waits
+until it has caught up with the version before answering.
+``RequestSessionMiddleware`` ends those sessions.
+
+GET /healthz reports ``mongo.health()``: ping latency and how many of each
+pool's connections are checked out.
+"""
+import asyncio
+import contextvars
+import logging
 import os
+import threading
+import time
+import warnings
+from collections import Counter
+from typing import Awaitable, Callable, Optional, TypeVar
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReadPreference, monitoring
+from pymongo.compression_support import validate_compressors
+from pymongo.errors import PyMongoError
+from pymongo.read_preferences import Primary, SecondaryPreferred
 from dotenv import load_dotenv
 
+from metrics import command_metrics
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 MONGODB_URL = os.getenv("MONGODB_URL")
+MONGODB_DB = os.getenv("MONGODB_DB", "high_low_buffalo_db")
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", 100))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", 10))
+MONGODB_COMPRESSORS = os.getenv("MONGODB_COMPRESSORS", "zstd,snappy")
+MONGODB_HISTORY_READS = os.getenv("MONGODB_HISTORY_READS", "secondaryPreferred")
+MONGODB_MAX_STALENESS_SECONDS = int(os.getenv("MONGODB_MAX_STALENESS_SECONDS", 90))
+HEALTH_TIMEOUT_SECONDS = float(os.getenv("HEALTH_TIMEOUT_SECONDS", 2))
+
+
+def available_compressors(names: str) -> list[str]:
+    """
+    The compressors in ``names`` this process can use, without pymongo's
+    warning for each missing one.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        available = validate_compressors(None, names)
+    missing = [name for name in names.split(",") if name.strip() and name.strip() not in available]
+    if missing:
+        logger.info("Wire compression without %s: not installed", ", ".join(missing))
+    return available
+
+
+# Connection housekeeping that isn't a round trip made on behalf of a request
+UNCOUNTED_COMMANDS = {"hello", "ismaster", "isMaster", "ping", "endSessions", "saslStart", "saslContinue"}
+
+if MONGODB_HISTORY_READS == "secondaryPreferred":
+    HISTORY_READ_PREFERENCE = SecondaryPreferred(max_staleness=MONGODB_MAX_STALENESS_SECONDS)
+elif MONGODB_HISTORY_READS == "primary":
+    HISTORY_READ_PREFERENCE = Primary()
+else:
+    raise ValueError(f"Unknown MONGODB_HISTORY_READS: {MONGODB_HISTORY_READS}")
+
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Counts the commands sent to MongoDB, by command name. Motor runs them on
+    executor threads, so counts are process-wide; tests take a snapshot
+    before and after a request to measure its round trips.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts: Counter[str] = Counter()
+
+    def started(self, event):
+        if event.command_name not in UNCOUNTED_COMMANDS:
+            with self._lock:
+                self.counts[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def total(self) -> int:
+        with self._lock:
+            return sum(self.counts.values())
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """
+    Open, checked-out and waited-for connections per server, from the
+    pool events pymongo emits on its own threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open: Counter[str] = Counter()
+        self.checked_out: Counter[str] = Counter()
+        self.waiting: Counter[str] = Counter()
+
+    def _add(self, counter: Counter, event, delta: int):
+        address = "%s:%s" % event.address
+        with self._lock:
+            counter[address] += delta
+
+    def connection_created(self, event):
+        self._add(self.open, event, 1)
+
+    def connection_closed(self, event):
+        self._add(self.open, event, -1)
+
+    def connection_check_out_started(self, event):
+        self._add(self.waiting, event, 1)
+
+    def connection_check_out_failed(self, event):
+        self._add(self.waiting, event, -1)
+
+    def connection_checked_out(self, event):
+        self._add(self.waiting, event, -1)
+        self._add(self.checked_out, event, 1)
+
+    def connection_checked_in(self, event):
+        self._add(self.checked_out, event, -1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        with self._lock:
+            address = "%s:%s" % event.address
+            for counter in (self.open, self.checked_out, self.waiting):
+                counter.pop(address, None)
+
+    def connection_ready(self, event):
+        pass
+
+    def snapshot(self) -> dict[str, dict]:
+        with self._lock:
+            return {
+                address: {
+                    "open": self.open[address],
+                    "checked_out": self.checked_out[address],
+                    "waiting": max(self.waiting[address], 0),
+                    "saturation": round(self.checked_out[address] / MONGODB_MAX_POOL_SIZE, 3),
+                }
+                for address in self.open
+            }
+
+
+command_counter = CommandCounter()
+pool_monitor = PoolMonitor()
+
+
+class Mongo:
+    """
+    The process's Motor client, opened by ``connect`` (or on first use) and
+    released by ``close``.
+    """
+
+    def __init__(self, url: Optional[str] = MONGODB_URL, name: str = MONGODB_DB):
+        self.url = url
+        self.name = name
+        self._client: Optional[AsyncIOMotorClient] = None
+        self._database = None
+
+    def open(self):
+        if self._client is None:
+            self._client = AsyncIOMotorClient(
+                self.url,
+                maxPoolSize=MONGODB_MAX_POOL_SIZE,
+                minPoolSize=MONGODB_MIN_POOL_SIZE,
+                compressors=available_compressors(MONGODB_COMPRESSORS),
+                # Default for every operation that doesn't opt into history_reads
+                read_preference=ReadPreference.PRIMARY,
+                event_listeners=[command_counter, command_metrics, pool_monitor],
+            )
+            self._database = self._client[self.name]
+
+    async def connect(self):
+        """
+        Opens the client and waits for a first connection, so the worker only
+        serves once MongoDB answers.
+        """
+        self.open()
+        await self._client.admin.command("ping")
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = self._database = None
+
+    @property
+    def client(self) -> AsyncIOMotorClient:
+        self.open()
+        return self._client
+
+    @property
+    def database(self):
+        self.open()
+        return self._database
+
+    async def health(self) -> dict:
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.client.admin.command("ping"), HEALTH_TIMEOUT_SECONDS)
+            ping_ms, error = round((time.perf_counter() - started) * 1000, 2), None
+        except (PyMongoError, asyncio.TimeoutError) as e:
+            ping_ms, error = None, repr(e)
+        pools = pool_monitor.snapshot()
+        return {
+            "ok": error is None,
+            "ping_ms": ping_ms,
+            "error": error,
+            "max_pool_size": MONGODB_MAX_POOL_SIZE,
+            "saturation": max((pool["saturation"] for pool in pools.values()), default=0.0),
+            "pools": pools,
+        }
+
+
+class DatabaseProxy:
+    """
+    Forwards to the database of ``mongo``'s current client.
+    """
+
+    def __getattr__(self, name):
+        return getattr(mongo.database, name)
+
+    def __getitem__(self, name):
+        return mongo.database[name]
+
+
+def resolve(database):
+    """
+    The Motor database behind ``database``, for APIs that type-check it
+    (e.g. GridFS buckets).
+    """
+    return mongo.database if isinstance(database, DatabaseProxy) else database
+
+
+mongo = Mongo()
+db = DatabaseProxy()
+
+
+def history_reads(collection):
+    """
+    ``collection`` with the read preference for feed and history pages.
+    """
+    return collection.with_options(read_preference=HISTORY_READ_PREFERENCE)
+
+
+# Sessions opened by the current request; None outside RequestSessionMiddleware
+_request_sessions: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar("request_sessions", default=None)
+
+
+async def request_session():
+    """
+    The current request's causally consistent session, started on first
+    use, or None when history reads go to the primary anyway or there is no
+    request.
+    """
+    sessions = _request_sessions.get()
+    if sessions is None or isinstance(HISTORY_READ_PREFERENCE, Primary):
+        return None
+    if not sessions:
+        sessions.append(await mongo.client.start_session(causal_consistency=True))
+    return sessions[0]
+
+
+class RequestSessionMiddleware:
+    """
+    Pure ASGI middleware ending the sessions ``request_session`` started.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        sessions: list = []
+        token = _request_sessions.set(sessions)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_sessions.reset(token)
+            for session in sessions:
+                await session.end_session()
+
+
+T = TypeVar("T")
+
+_supports_transactions: Optional[bool] = None
+
+
+async def supports_transactions() -> bool:
+    """
+    Multi-document transactions need a replica set or sharded cluster;
+    local development often runs a standalone mongod.
+    """
+    global _supports_transactions
+    if _supports_transactions is None:
+        try:
+            hello = await mongo.client.admin.command("hello")
+        except PyMongoError:
+            return False
+        _supports_transactions = "setName" in hello or hello.get("msg") == "isdbgrid"
+    return _supports_transactions
+
 
-client = AsyncIOMotorClient(MONGODB_URL)
-db = client.high_low_buffalo_db
\ No newline at end of file
+async def run_transaction(callback: Callable[..., Awaitable[T]]) -> T:
+    """
+    Runs ``callback(session)`` inside a transaction, retried on transient
+    errors. Without transaction support it runs once with ``session=None``,
+    which keeps each write atomic on its own.
+    """
+    if not await supports_transactions():
+        return await callback(None)
+    async with await mongo.client.start_session() as session:
+        return await session.with_transaction(callback)
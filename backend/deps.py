@@ -1,19 +1,77 @@
+import hashlib
+import os
+import secrets
 from typing import Optional
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, Header, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
+from fastapi.security.utils import get_authorization_scheme_param
 from jose import jwt, JWTError
-from database import db
 from security import SECRET_KEY, ALGORITHM
 from schemas import TokenData, User
+from cache import TTLCache
+from invalidation import bus
+from metrics import record_user
+from storage import store
+import versions
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/v1/auth/token")
 
+# Shared secret for admin/cron endpoints, sent as X-Admin-Token. Unset disables them.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Sent with ETagged per-user responses: browsers may keep them, but must revalidate every use
+CONDITIONAL_CACHE_CONTROL = "private, no-cache"
+
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", 30))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", 10000))
+
+# Validated users keyed by token subject (email). Per worker: write paths
+# that change a user document must call invalidate_user(), which also evicts
+# the entry in every other worker through the invalidation bus.
+user_cache = TTLCache(max_entries=USER_CACHE_MAX_ENTRIES, ttl=USER_CACHE_TTL_SECONDS, name="users")
+# Invalidations arrive by user id, so remember which email each cached id belongs to
+_cached_emails = TTLCache(max_entries=USER_CACHE_MAX_ENTRIES, ttl=USER_CACHE_TTL_SECONDS)
+
+def _evict_user(user_id: Optional[str]):
+    if user_id is None:
+        user_cache.clear()
+        _cached_emails.clear()
+        return
+    email = _cached_emails.get(user_id)
+    if email is not None:
+        user_cache.invalidate(email)
+        _cached_emails.invalidate(user_id)
+
+bus.subscribe("users", _evict_user)
+
+def invalidate_user(user_id: str):
+    bus.publish("users", user_id)
+
 async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
+    return await authenticate(token)
+
+async def get_stream_user(request: Request, access_token: Optional[str] = None) -> User:
+    """
+    get_current_user for URLs the browser fetches by itself: event streams
+    and images. EventSource and <img> can't send an Authorization header,
+    so the token may also come as ?access_token=.
+    """
+    scheme, token = get_authorization_scheme_param(request.headers.get("authorization"))
+    if scheme.lower() != "bearer":
+        token = access_token
+    return await authenticate(token)
+
+async def authenticate(token: Optional[str]) -> User:
+    """
+    Resolves a bearer token to its user, through the per-worker user cache.
+    """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    if not token:
+        raise credentials_exception
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
@@ -22,8 +80,76 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
         token_data = TokenData(email=email)
     except JWTError:
         raise credentials_exception
-    
-    user = await db.users.find_one({"email": token_data.email})
+
+    cached = user_cache.get(token_data.email)
+    if cached is not None:
+        record_user(str(cached.id))
+        # Hand out a copy so handlers can't mutate the cached object
+        return cached.model_copy()
+
+    user = await store.users.get_by_email(token_data.email)
     if user is None:
         raise credentials_exception
-    return User(**user)
\ No newline at end of file
+    validated = User(**user)
+    user_cache.set(token_data.email, validated)
+    _cached_emails.set(str(validated.id), token_data.email)
+    record_user(str(validated.id))
+    return validated.model_copy()
+
+async def get_fresh_user(current_user: User = Depends(get_current_user)) -> User:
+    """
+    The current user read from the database instead of the worker's cache,
+    for responses that are the user document itself. Another worker may
+    have changed it within USER_CACHE_TTL_SECONDS; refreshes the cache too.
+    """
+    user = await store.users.get_by_email(current_user.email)
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
+    validated = User(**user)
+    user_cache.set(validated.email, validated)
+    _cached_emails.set(str(validated.id), validated.email)
+    return validated.model_copy()
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN or not x_admin_token or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin token required")
+
+
+def conditional_get(scope: str):
+    """
+    Dependency for conditional GETs of per-user resources. Answers 304 when
+    If-None-Match still matches, before the endpoint runs its query, and
+    otherwise returns the headers to send with the full response.
+
+    ``scope`` is a versions.SCOPES counter, or "me" for the user document
+    itself, which is tagged by its content. That content must be read fresh
+    (get_fresh_user): the cached copy can lag other workers' writes, and its
+    hash would then confirm a stale body with a 304.
+    """
+    user_dependency = get_fresh_user if scope == "me" else get_current_user
+
+    async def dependency(request: Request, current_user: User = Depends(user_dependency)) -> dict:
+        user_id = str(current_user.id)
+        settings = current_user.settings
+        variant = request.url.query
+        if scope == "me":
+            version = hashlib.blake2b(current_user.model_dump_json().encode(), digest_size=8).hexdigest()
+        else:
+            version = await store.users.get_version(user_id, scope)
+            # Herd and friend listings start from the user document; a worker still
+            # holding a stale copy must not pair it with the new version
+            if scope == "herds" and settings:
+                variant += "|" + ",".join(settings.herds)
+            elif scope == "friends" and settings:
+                variant += "|" + ",".join(settings.friends)
+
+        headers = {
+            "ETag": versions.etag(user_id, scope, version, variant),
+            "Cache-Control": CONDITIONAL_CACHE_CONTROL,
+            "Vary": "Authorization",
+        }
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and versions.etag_matches(if_none_match, headers["ETag"]):
+            raise HTTPException(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return headers
+    return dependency
@@ -0,0 +1,394 @@
+"""
+Live feed events for GET /reflections/feed/events.
+
+Timeline entries (see timelines.py) are the per-recipient copies of
+reflections, so every new reflection, reaction or flag a user should see
+shows up as a change to one of their entries. Each worker turns those
+changes into Server-Sent Events and pushes them to the recipients that have
+a stream open on it:
+
+    id: <event id>
+    event: upsert
+    data: {"item": <feed item, as GET /reflections/feed returns it>}
+
+``remove`` events carry the ``reflection_id`` of an entry that is gone, and
+``reset`` means events were lost: the client should reload the feed.
+
+Sources, chosen with FEED_EVENTS:
+
+- ``changestream``: every worker watches the change stream of ``timelines``,
+  the per-recipient projection of ``reflections``. Event ids are resume
+  tokens, valid in any worker, so a client reconnecting with Last-Event-ID
+  has the events it missed replayed from the oplog. Removals need pre-images
+  on timelines (migration 10, MongoDB 6.0+).
+- ``local``: in-process pub/sub fed through ``FeedEventHub.publish`` with
+  change-stream shaped documents, plus a bounded replay log. For a single
+  worker and tests.
+- ``auto`` (default): ``changestream`` when the server supports it,
+  otherwise ``local``.
+
+Per worker, an open stream costs one bounded queue, indexed by recipient.
+Events for users with no stream open here are dropped after a dict lookup.
+"""
+import asyncio
+import logging
+import os
+import re
+from collections import deque
+from typing import AsyncIterator, Callable, Optional
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from database import db
+from invalidation import RESUME_TOKEN_LOST_CODES, supports_change_streams
+from schemas import ReflectionFeedItem
+from serialization import document, encode
+import timelines
+
+logger = logging.getLogger(__name__)
+
+FEED_EVENTS = os.getenv("FEED_EVENTS", "auto")
+# Events buffered per stream; a client that falls further behind is told to reload
+FEED_EVENTS_QUEUE_SIZE = int(os.getenv("FEED_EVENTS_QUEUE_SIZE", 100))
+FEED_EVENTS_MAX_STREAMS_PER_USER = int(os.getenv("FEED_EVENTS_MAX_STREAMS_PER_USER", 5))
+# Longest backlog replayed on reconnect; past it a reload is cheaper
+FEED_EVENTS_MAX_REPLAY = int(os.getenv("FEED_EVENTS_MAX_REPLAY", 500))
+# Events kept for replay by the local source
+FEED_EVENTS_LOG_SIZE = int(os.getenv("FEED_EVENTS_LOG_SIZE", 10000))
+# Proxies close idle connections; a comment line keeps the stream alive
+FEED_EVENTS_HEARTBEAT_SECONDS = float(os.getenv("FEED_EVENTS_HEARTBEAT_SECONDS", 15))
+
+WATCHED_OPERATIONS = ["insert", "replace", "update", "delete"]
+# Only what event_from_change reads; keeps change stream payloads small
+CHANGE_PROJECTION = {
+    "operationType": 1,
+    "fullDocument.recipient_id": 1,
+    "fullDocument.item": 1,
+    "fullDocument.my_reactions": 1,
+    "fullDocumentBeforeChange.recipient_id": 1,
+    "fullDocumentBeforeChange.reflection_id": 1,
+}
+RESUME_TOKEN_PATTERN = re.compile(r"^[0-9A-Fa-f]{1,4096}$")
+
+
+class ResumeLost(Exception):
+    """
+    The events after a Last-Event-ID can no longer be replayed.
+    """
+
+
+class FeedEvent:
+    __slots__ = ("id", "recipient_id", "type", "data")
+
+    def __init__(self, id: str, recipient_id: Optional[str], type: str, data: dict):
+        self.id = id
+        self.recipient_id = recipient_id
+        self.type = type
+        self.data = data
+
+    def encode(self) -> bytes:
+        return b"id: %s\nevent: %s\ndata: %s\n\n" % (self.id.encode(), self.type.encode(), encode(self.data))
+
+
+def reset_event(event_id: Optional[str], recipient_id: Optional[str] = None) -> FeedEvent:
+    # An empty id clears the client's Last-Event-ID, so it won't ask to resume from a lost position
+    return FeedEvent(event_id or "", recipient_id, "reset", {})
+
+
+def event_from_change(event_id: str, change: dict) -> Optional[FeedEvent]:
+    """
+    Turns a change to a timeline entry into the event for its recipient.
+    """
+    operation = change.get("operationType")
+    if operation in ("insert", "replace", "update"):
+        entry = change.get("fullDocument")
+        if not entry:
+            # Deleted again before the update lookup ran; the delete has its own event
+            return None
+        item = document(ReflectionFeedItem, timelines.feed_item(entry))
+        return FeedEvent(event_id, entry["recipient_id"], "upsert", {"item": item})
+    if operation == "delete":
+        before = change.get("fullDocumentBeforeChange")
+        if not before:
+            return None
+        return FeedEvent(event_id, before["recipient_id"], "remove", {"reflection_id": str(before["reflection_id"])})
+    return None
+
+
+class Subscription:
+    """
+    One open event stream.
+    """
+    __slots__ = ("recipient_id", "queue")
+
+    def __init__(self, recipient_id: str, queue_size: int):
+        self.recipient_id = recipient_id
+        # None closes the stream
+        self.queue: asyncio.Queue[Optional[FeedEvent]] = asyncio.Queue(queue_size)
+
+    def offer(self, event: Optional[FeedEvent]) -> bool:
+        """
+        Queues ``event`` without waiting. When the client has fallen too far
+        behind, the backlog is replaced by a reset and False is returned.
+        """
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(event if event is None else reset_event(event.id, self.recipient_id))
+            return False
+
+
+class ChangeStreamSource:
+    def __init__(self, database):
+        self.database = database
+        self.head: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+        self._options = {"full_document": "updateLookup"}
+
+    async def start(self, deliver: Callable[[Optional[FeedEvent]], None]):
+        self._deliver = deliver
+        if await supports_pre_images(self.database):
+            self._options["full_document_before_change"] = "whenAvailable"
+        self._task = asyncio.create_task(self._watch())
+
+    def _pipeline(self, recipient_id: Optional[str] = None) -> list[dict]:
+        match = {"operationType": {"$in": WATCHED_OPERATIONS}}
+        if recipient_id is not None:
+            match["$or"] = [
+                {"fullDocument.recipient_id": recipient_id},
+                {"fullDocumentBeforeChange.recipient_id": recipient_id},
+            ]
+        return [{"$match": match}, {"$project": CHANGE_PROJECTION}]
+
+    async def _watch(self):
+        resume_token = None
+        while True:
+            try:
+                async with self.database.timelines.watch(
+                    self._pipeline(), resume_after=resume_token, **self._options
+                ) as stream:
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        self.head = change["_id"]["_data"]
+                        event = event_from_change(self.head, change)
+                        if event is not None:
+                            self._deliver(event)
+            except asyncio.CancelledError:
+                raise
+            except PyMongoError as e:
+                logger.warning("Feed event change stream interrupted: %s", e)
+                if isinstance(e, OperationFailure) and e.code in RESUME_TOKEN_LOST_CODES:
+                    resume_token = None
+                if resume_token is None:
+                    # Events may have been missed with no way to replay them
+                    self._deliver(None)
+                await asyncio.sleep(1)
+
+    async def replay(self, recipient_id: str, last_event_id: str, limit: int) -> AsyncIterator[FeedEvent]:
+        """
+        Yields the recipient's events after ``last_event_id`` that are in the
+        oplog now, then returns.
+        """
+        if not RESUME_TOKEN_PATTERN.match(last_event_id):
+            raise ResumeLost(last_event_id)
+        replayed = 0
+        try:
+            async with self.database.timelines.watch(
+                self._pipeline(recipient_id),
+                resume_after={"_data": last_event_id},
+                max_await_time_ms=200,
+                **self._options,
+            ) as stream:
+                # try_next returns None once the stream has caught up
+                while (change := await stream.try_next()) is not None:
+                    replayed += 1
+                    if replayed > limit:
+                        raise ResumeLost(last_event_id)
+                    event = event_from_change(change["_id"]["_data"], change)
+                    if event is not None:
+                        yield event
+        except PyMongoError as e:
+            raise ResumeLost(last_event_id) from e
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+class LocalSource:
+    """
+    In-process stand-in for the change stream. Event ids are sequence
+    numbers, only meaningful to this process.
+    """
+
+    def __init__(self, log_size: int = FEED_EVENTS_LOG_SIZE):
+        self.head: Optional[str] = None
+        self._seq = 0
+        # Sequence number of the newest event that fell out of the log
+        self._evicted = 0
+        self._log: deque[FeedEvent] = deque(maxlen=log_size)
+
+    async def start(self, deliver: Callable[[Optional[FeedEvent]], None]):
+        self._deliver = deliver
+
+    def publish(self, change: dict):
+        self._seq += 1
+        self.head = str(self._seq)
+        event = event_from_change(self.head, change)
+        if event is None:
+            return
+        if len(self._log) == self._log.maxlen:
+            self._evicted = int(self._log[0].id)
+        self._log.append(event)
+        self._deliver(event)
+
+    async def replay(self, recipient_id: str, last_event_id: str, limit: int) -> AsyncIterator[FeedEvent]:
+        try:
+            after = int(last_event_id)
+        except ValueError:
+            raise ResumeLost(last_event_id)
+        if after < self._evicted or after > self._seq:
+            raise ResumeLost(last_event_id)
+        replayed = 0
+        for event in list(self._log):
+            if int(event.id) > after and event.recipient_id == recipient_id:
+                replayed += 1
+                if replayed > limit:
+                    raise ResumeLost(last_event_id)
+                yield event
+
+    async def stop(self):
+        pass
+
+
+async def supports_pre_images(database) -> bool:
+    # fullDocumentBeforeChange arrived in MongoDB 6.0
+    try:
+        info = await database.command("buildInfo")
+    except PyMongoError:
+        return False
+    return info.get("versionArray", [0])[0] >= 6
+
+
+class FeedEventHub:
+    def __init__(
+        self,
+        backend: str = FEED_EVENTS,
+        queue_size: int = FEED_EVENTS_QUEUE_SIZE,
+        max_streams_per_user: int = FEED_EVENTS_MAX_STREAMS_PER_USER,
+    ):
+        self.backend = backend
+        self.queue_size = queue_size
+        self.max_streams_per_user = max_streams_per_user
+        self.source = None
+        self.delivered = 0
+        self.overflows = 0
+        self._subscriptions: dict[str, list[Subscription]] = {}
+
+    def _dispatch(self, event: Optional[FeedEvent]):
+        if event is None:
+            # The source lost events: everyone connected has to reload
+            for subscriptions in self._subscriptions.values():
+                for subscription in subscriptions:
+                    subscription.offer(reset_event(self.source.head, subscription.recipient_id))
+            return
+        for subscription in self._subscriptions.get(event.recipient_id, ()):
+            self.delivered += 1
+            if not subscription.offer(event):
+                self.overflows += 1
+
+    def publish(self, change: dict):
+        """
+        Feeds a change-stream shaped document to the local source.
+        """
+        if not isinstance(self.source, LocalSource):
+            raise RuntimeError("publish() needs the local feed event source")
+        self.source.publish(change)
+
+    def subscribe(self, recipient_id: str) -> Subscription:
+        subscriptions = self._subscriptions.setdefault(recipient_id, [])
+        if len(subscriptions) >= self.max_streams_per_user:
+            # Close the oldest stream rather than let one user hold unbounded queues
+            subscriptions.pop(0).offer(None)
+        subscription = Subscription(recipient_id, self.queue_size)
+        subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscriptions.get(subscription.recipient_id)
+        if subscriptions and subscription in subscriptions:
+            subscriptions.remove(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.recipient_id]
+
+    async def stream(self, recipient_id: str, last_event_id: Optional[str] = None) -> AsyncIterator[bytes]:
+        """
+        The encoded event stream for one client: events missed since
+        ``last_event_id`` first, then live events until the client leaves.
+        """
+        # Subscribe before replaying so nothing falls between the two
+        subscription = self.subscribe(recipient_id)
+        try:
+            yield b"retry: 5000\n\n"
+            replayed: set[str] = set()
+            if last_event_id:
+                try:
+                    async for event in self.source.replay(recipient_id, last_event_id, FEED_EVENTS_MAX_REPLAY):
+                        replayed.add(event.id)
+                        yield event.encode()
+                except ResumeLost:
+                    yield reset_event(self.source.head).encode()
+
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), FEED_EVENTS_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+                    continue
+                if event is None:
+                    return
+                if replayed:
+                    # Live events queued during the replay start with the ones it already sent
+                    if event.id in replayed:
+                        continue
+                    replayed = set()
+                yield event.encode()
+        finally:
+            self.unsubscribe(subscription)
+
+    async def start(self, database=db):
+        backend = self.backend
+        if database is None:
+            # In-memory storage publishes its timeline changes here (see storage/memory.py)
+            backend = "local"
+        elif backend == "auto":
+            backend = "changestream" if await supports_change_streams(database) else "local"
+        self.source = ChangeStreamSource(database) if backend == "changestream" else LocalSource()
+        await self.source.start(self._dispatch)
+        logger.info("Feed events started with %s source", backend)
+
+    async def stop(self):
+        for subscriptions in list(self._subscriptions.values()):
+            for subscription in subscriptions:
+                subscription.offer(None)
+        if self.source is not None:
+            await self.source.stop()
+
+    def stats(self) -> dict:
+        return {
+            "source": type(self.source).__name__ if self.source else None,
+            "recipients": len(self._subscriptions),
+            "streams": sum(len(s) for s in self._subscriptions.values()),
+            "delivered": self.delivered,
+            "overflows": self.overflows,
+        }
+
+
+hub = FeedEventHub()
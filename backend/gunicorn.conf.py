@@ -0,0 +1,21 @@
+"""
+Gunicorn hooks for multiprocess metrics (see metrics.py). start.sh points
+PROMETHEUS_MULTIPROC_DIR at a directory shared by the workers.
+"""
+import os
+import shutil
+
+
+def on_starting(server):
+    # Samples left by a previous run would be summed into this one
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    # Drops the live gauges of a worker that exited; its counters keep counting in the totals
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
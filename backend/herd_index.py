@@ -0,0 +1,98 @@
+"""
+Reverse herd membership index: ``settings.herds`` on each user document
+lists the ids of the herds the user belongs to.
+
+routers/herds.py updates it in the same transaction as the herd's
+memberships (see database.run_transaction), so access checks and herd
+listings can read a user's herds straight off the user document.
+
+    python herd_index.py check    # report users whose index has drifted
+    python herd_index.py repair   # rewrite the index from herd_memberships
+"""
+import argparse
+import asyncio
+from collections import defaultdict
+from typing import Iterable
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from database import db
+
+
+def _user_obj_ids(user_ids: Iterable[str]) -> list[ObjectId]:
+    return [ObjectId(u) for u in set(user_ids) if ObjectId.is_valid(u)]
+
+
+async def add_herd(herd_id: str, user_ids: Iterable[str], session=None, database=db):
+    user_obj_ids = _user_obj_ids(user_ids)
+    if user_obj_ids:
+        await database.users.update_many(
+            {"_id": {"$in": user_obj_ids}}, {"$addToSet": {"settings.herds": herd_id}}, session=session
+        )
+
+
+async def remove_herd(herd_id: str, user_ids: Iterable[str], session=None, database=db):
+    user_obj_ids = _user_obj_ids(user_ids)
+    if user_obj_ids:
+        await database.users.update_many(
+            {"_id": {"$in": user_obj_ids}}, {"$pull": {"settings.herds": herd_id}}, session=session
+        )
+
+
+async def herd_ids_by_user(user_ids: Iterable[str], database=db) -> dict[str, list[str]]:
+    """
+    Batched lookup of the herds each user belongs to.
+    """
+    result = {}
+    async for user in database.users.find({"_id": {"$in": _user_obj_ids(user_ids)}}, {"settings.herds": 1}):
+        herds = (user.get("settings") or {}).get("herds") or []
+        result[str(user["_id"])] = [h for h in herds if isinstance(h, str)]
+    return result
+
+
+async def _drift(database) -> list[UpdateOne]:
+    expected: dict[str, set[str]] = defaultdict(set)
+    async for membership in database.herd_memberships.find({}, {"_id": 0, "herd_id": 1, "user_id": 1}):
+        expected[membership["user_id"]].add(membership["herd_id"])
+
+    ops = []
+    async for user in database.users.find({}, {"settings.herds": 1}):
+        user_id = str(user["_id"])
+        actual = (user.get("settings") or {}).get("herds")
+        want = sorted(expected.get(user_id, ()))
+        if not isinstance(actual, list) or sorted(actual, key=str) != want:
+            # Pipeline update, so users whose settings are null get fixed too
+            ops.append(UpdateOne(
+                {"_id": user["_id"]},
+                [{"$set": {"settings": {"$mergeObjects": [{"$ifNull": ["$settings", {}]}, {"herds": want}]}}}],
+            ))
+    return ops
+
+
+async def repair(database=db, dry_run: bool = False) -> int:
+    """
+    Rewrites ``settings.herds`` of every user whose index disagrees with
+    the herd_memberships collection. Returns the number of drifted users.
+    """
+    ops = await _drift(database)
+    if ops and not dry_run:
+        for start in range(0, len(ops), 1000):
+            await database.users.bulk_write(ops[start:start + 1000], ordered=False)
+    return len(ops)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Check or repair the reverse herd membership index.")
+    parser.add_argument("command", choices=["check", "repair"])
+    args = parser.parse_args()
+
+    drifted = await repair(dry_run=args.command == "check")
+    if args.command == "check":
+        print(f"{drifted} users have a drifted herd index")
+    else:
+        print(f"Repaired the herd index of {drifted} users")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
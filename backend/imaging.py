@@ -0,0 +1,58 @@
+"""
+Pure image transforms for the thumbnail pipeline.
+
+This module runs inside ProcessPoolExecutor workers, so it deliberately
+imports nothing from the app (no database client, no settings) and keeps
+its entry point a plain picklable function.
+"""
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+# Variant name -> target width in pixels
+THUMBNAIL_WIDTHS = {"sm": 320, "md": 640, "lg": 1280}
+
+# Format name -> (Pillow format, content type, save options)
+OUTPUT_FORMATS = {
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", "image/jpeg", {"quality": 82, "optimize": True, "progressive": True}),
+}
+
+# Refuse decompression bombs well before they exhaust a worker's memory
+Image.MAX_IMAGE_PIXELS = 40_000_000
+
+
+def _encode(img: Image.Image, fmt: str) -> bytes:
+    pil_format, _, options = OUTPUT_FORMATS[fmt]
+    if pil_format == "JPEG" and img.mode != "RGB":
+        img = img.convert("RGB")
+    out = BytesIO()
+    img.save(out, pil_format, **options)
+    return out.getvalue()
+
+
+def render_variants(data: bytes) -> dict[str, dict[str, bytes]]:
+    """
+    Decodes an image and returns {variant: {format: encoded bytes}} for every
+    width in THUMBNAIL_WIDTHS. Images are never upscaled, so small originals
+    produce variants at their own width.
+    """
+    max_width = max(THUMBNAIL_WIDTHS.values())
+
+    with Image.open(BytesIO(data)) as img:
+        # Let the JPEG decoder downscale by a power of two while decoding,
+        # which is much cheaper than decoding full size and resizing
+        img.draft("RGB", (max_width, max_width))
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "transparency" in img.info or img.mode in ("LA", "PA") else "RGB")
+
+        variants = {}
+        # Resize largest first and derive each smaller variant from the previous one
+        source = img
+        for name, width in sorted(THUMBNAIL_WIDTHS.items(), key=lambda item: -item[1]):
+            if source.width > width:
+                height = max(1, round(source.height * width / source.width))
+                source = source.resize((width, height), Image.LANCZOS, reducing_gap=2.0)
+            variants[name] = {fmt: _encode(source, fmt) for fmt in OUTPUT_FORMATS}
+        return variants
@@ -0,0 +1,294 @@
+"""
+Cross-worker cache invalidation bus.
+
+start.sh runs several gunicorn workers, each with its own in-process caches
+(see deps.user_cache). When one worker handles a write, every other worker
+must drop its copy. Subscribers register a handler per collection:
+
+    bus.subscribe("users", lambda user_id: ...)
+
+and receive the id of every changed document, or None when they should
+drop everything (e.g. after the bus lost events).
+
+Transports, chosen with INVALIDATION_BUS:
+
+- ``changestream``: every worker watches MongoDB change streams on users,
+  herds and reflections, so any write (even from scripts or other hosts)
+  evicts entries everywhere. Needs a replica set, which Atlas always is.
+- ``unix``: single-node fallback. Workers exchange datagrams over Unix
+  sockets in INVALIDATION_SOCKET_DIR; only writes made through
+  ``bus.publish`` are seen.
+- ``local``: in-process only, for a single worker and tests.
+- ``auto`` (default): ``changestream`` when the server supports it,
+  otherwise ``unix``.
+
+Eviction delay is bounded by transport lag (tracked in ``bus.stats()`` and
+exported on /metrics, see metrics.py), and in the worst case by the caches'
+own TTLs.
+"""
+import asyncio
+import glob
+import json
+import logging
+import os
+import socket
+import tempfile
+import time
+from collections import defaultdict, deque
+from datetime import timezone
+from typing import Callable, Optional
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from database import db
+from metrics import INVALIDATION_LAG, INVALIDATIONS_DROPPED
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_BUS = os.getenv("INVALIDATION_BUS", "auto")
+INVALIDATION_SOCKET_DIR = os.getenv(
+    "INVALIDATION_SOCKET_DIR", os.path.join(tempfile.gettempdir(), "hlb-invalidation")
+)
+WATCHED_COLLECTIONS = ["users", "herds", "reflections"]
+# ChangeStreamFatalError / ChangeStreamHistoryLost: the resume token is unusable
+RESUME_TOKEN_LOST_CODES = {280, 286}
+
+Handler = Callable[[Optional[str]], None]
+
+
+class LagStats:
+    """
+    Delay between a change being made and this worker hearing about it.
+    Keeps totals plus a window of recent samples for percentiles.
+    """
+
+    def __init__(self, window: int = 1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent: deque[float] = deque(maxlen=window)
+
+    def record(self, lag: float):
+        lag = max(lag, 0.0)
+        self.count += 1
+        self.total += lag
+        self.max = max(self.max, lag)
+        self.recent.append(lag)
+
+    def percentile(self, p: float) -> float:
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    def snapshot(self) -> dict:
+        return {
+            "received": self.count,
+            "lag_avg_seconds": self.total / self.count if self.count else 0.0,
+            "lag_p99_seconds": self.percentile(0.99),
+            "lag_max_seconds": self.max,
+        }
+
+
+class ChangeStreamTransport:
+    def __init__(self, database):
+        self.database = database
+        self._task: Optional[asyncio.Task] = None
+        self._resume_token = None
+
+    async def start(self, deliver):
+        self._deliver = deliver
+        self._task = asyncio.create_task(self._watch())
+
+    def broadcast(self, collection: str, doc_id: str, sent_at: float):
+        # Every worker watches the database itself; nothing to send
+        pass
+
+    async def _watch(self):
+        pipeline = [
+            {"$match": {"ns.coll": {"$in": WATCHED_COLLECTIONS}}},
+            {"$project": {"ns": 1, "documentKey": 1, "clusterTime": 1, "wallTime": 1}},
+        ]
+        while True:
+            try:
+                async with self.database.watch(pipeline, resume_after=self._resume_token) as stream:
+                    async for change in stream:
+                        self._resume_token = stream.resume_token
+                        sent_at = self._event_time(change)
+                        doc_id = change.get("documentKey", {}).get("_id")
+                        self._deliver(change["ns"]["coll"], str(doc_id) if doc_id is not None else None, sent_at)
+            except asyncio.CancelledError:
+                raise
+            except PyMongoError as e:
+                logger.warning("Invalidation change stream interrupted: %s", e)
+                if isinstance(e, OperationFailure) and e.code in RESUME_TOKEN_LOST_CODES:
+                    self._resume_token = None
+                if self._resume_token is None:
+                    # Events may have been missed with no way to replay them:
+                    # tell every subscriber to start over
+                    for collection in WATCHED_COLLECTIONS:
+                        self._deliver(collection, None, time.time())
+                await asyncio.sleep(1)
+
+    @staticmethod
+    def _event_time(change: dict) -> float:
+        wall_time = change.get("wallTime")
+        if wall_time is not None:
+            return wall_time.replace(tzinfo=timezone.utc).timestamp()
+        cluster_time = change.get("clusterTime")
+        return float(cluster_time.time) if cluster_time is not None else time.time()
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+class UnixSocketTransport:
+    """
+    Each worker binds a datagram socket named after its pid in a shared
+    directory and sends every invalidation to all the other sockets there.
+    """
+
+    def __init__(self, socket_dir: str = INVALIDATION_SOCKET_DIR):
+        self.socket_dir = socket_dir
+        self.path = os.path.join(socket_dir, f"worker-{os.getpid()}.sock")
+        self.dropped = 0
+        self._sock: Optional[socket.socket] = None
+        self._peers: list[str] = []
+        self._peers_mtime = None
+
+    async def start(self, deliver):
+        self._deliver = deliver
+        os.makedirs(self.socket_dir, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        self._sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(self._sock.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        while True:
+            try:
+                payload = self._sock.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                message = json.loads(payload)
+                self._deliver(message["c"], message["id"], message["t"])
+            except (ValueError, KeyError):
+                logger.warning("Ignoring malformed invalidation message")
+
+    def _peer_paths(self) -> list[str]:
+        # Re-list the directory only when a worker has come or gone
+        mtime = os.stat(self.socket_dir).st_mtime_ns
+        if mtime != self._peers_mtime:
+            self._peers = [p for p in glob.glob(os.path.join(self.socket_dir, "*.sock")) if p != self.path]
+            self._peers_mtime = mtime
+        return self._peers
+
+    def broadcast(self, collection: str, doc_id: Optional[str], sent_at: float):
+        if self._sock is None:
+            return
+        payload = json.dumps({"c": collection, "id": doc_id, "t": sent_at}).encode()
+        for peer in self._peer_paths():
+            try:
+                self._sock.sendto(payload, peer)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # The worker behind this socket has exited
+                try:
+                    os.unlink(peer)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                # Peer's receive buffer is full; its TTL will catch up
+                self.dropped += 1
+                INVALIDATIONS_DROPPED.inc()
+
+    async def stop(self):
+        if self._sock is not None:
+            asyncio.get_running_loop().remove_reader(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+
+async def supports_change_streams(database) -> bool:
+    try:
+        hello = await database.command("hello")
+    except PyMongoError:
+        return False
+    return "setName" in hello or hello.get("msg") == "isdbgrid"
+
+
+class InvalidationBus:
+    def __init__(self, backend: str = INVALIDATION_BUS, socket_dir: str = INVALIDATION_SOCKET_DIR):
+        self.backend = backend
+        self.socket_dir = socket_dir
+        self.transport = None
+        self.lag = LagStats()
+        self._handlers: dict[str, list[Handler]] = defaultdict(list)
+
+    def subscribe(self, collection: str, handler: Handler):
+        self._handlers[collection].append(handler)
+
+    def _dispatch(self, collection: str, doc_id: Optional[str], sent_at: float):
+        lag = max(time.time() - sent_at, 0.0)
+        self.lag.record(lag)
+        INVALIDATION_LAG.labels(collection).observe(lag)
+        for handler in self._handlers.get(collection, []):
+            try:
+                handler(doc_id)
+            except Exception:
+                logger.exception("Invalidation handler for %s failed", collection)
+
+    def publish(self, collection: str, doc_id: Optional[str]):
+        """
+        Evicts ``doc_id`` from this worker's caches right away and tells the
+        other workers to do the same.
+        """
+        sent_at = time.time()
+        for handler in self._handlers.get(collection, []):
+            handler(doc_id)
+        if self.transport is not None:
+            self.transport.broadcast(collection, doc_id, sent_at)
+
+    async def start(self, database=db):
+        backend = self.backend
+        if database is None:
+            # In-memory storage (see storage/__init__.py): one process, nothing to watch
+            backend = "local"
+        elif backend == "auto":
+            backend = "changestream" if await supports_change_streams(database) else "unix"
+
+        if backend == "changestream":
+            self.transport = ChangeStreamTransport(database)
+        elif backend == "unix":
+            self.transport = UnixSocketTransport(self.socket_dir)
+        else:
+            self.transport = None
+
+        if self.transport is not None:
+            await self.transport.start(self._dispatch)
+        logger.info("Cache invalidation bus started with %s transport", backend)
+
+    async def stop(self):
+        if self.transport is not None:
+            await self.transport.stop()
+            self.transport = None
+
+    def stats(self) -> dict:
+        stats = {"transport": type(self.transport).__name__ if self.transport else "local", **self.lag.snapshot()}
+        if isinstance(self.transport, UnixSocketTransport):
+            stats["dropped"] = self.transport.dropped
+        return stats
+
+
+bus = InvalidationBus()
@@ -1,8 +1,43 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, Request, Response
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from routers import auth, users, reflections, notifications, herds
+from routers import auth, users, reflections, notifications, herds, images
+import migrations
+from storage import StorageError, store
+from thumbnails import pipeline as thumbnail_pipeline
+from invalidation import bus as invalidation_bus
+from feed_events import hub as feed_event_hub
+from deps import require_admin
+from database import RequestSessionMiddleware, mongo
+from admission import AdmissionMiddleware
+import metrics
+from slow_requests import SlowRequestMiddleware
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Apply pending migrations (one worker at a time, the others wait: see migrations.py),
+    # then refuse to start if required indexes are missing.
+    # The in-memory storage engine has no database (see storage/__init__.py).
+    db = store.database
+    if db is not None:
+        # Each worker opens its own pools once it is about to serve (see database.py)
+        await mongo.connect()
+        if migrations.AUTO_MIGRATE:
+            await migrations.migrate(db)
+        await migrations.verify(db)
+    await invalidation_bus.start(db)
+    await feed_event_hub.start(db)
+    yield
+    await feed_event_hub.stop()
+    await invalidation_bus.stop()
+    await thumbnail_pipeline.shutdown()
+    mongo.close()
+
+app = FastAPI(lifespan=lifespan)
+
+# Inside CORSMiddleware, so browsers can read 429 and 503 answers (see admission.py)
+app.add_middleware(AdmissionMiddleware)
 
 # Configure CORS
 origins = [
@@ -17,14 +52,41 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Lets the frontend read ETags for its If-None-Match revalidation (see lib/api.ts)
+    expose_headers=["ETag"],
 )
+app.add_middleware(RequestSessionMiddleware)
+# Reads the per-request stats MetricsMiddleware sets up, so it goes inside it
+app.add_middleware(SlowRequestMiddleware)
+# Outermost, so the latency it records covers every other middleware
+app.add_middleware(metrics.MetricsMiddleware)
+
+@app.exception_handler(StorageError)
+async def storage_error_handler(request: Request, exc: StorageError):
+    # Repositories report missing, forbidden and conflicting writes (see storage/__init__.py)
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
 
 @app.get("/")
 def read_root():
     return {"message": "Backend is running"}
 
+@app.get("/healthz", include_in_schema=False)
+async def read_health():
+    # For load balancers and orchestrators: ping latency and pool saturation of this worker
+    if store.database is None:
+        return {"ok": True, "storage": store.backend}
+    health = await mongo.health()
+    return JSONResponse(status_code=200 if health["ok"] else 503, content={**health, "storage": store.backend})
+
+@app.get("/metrics", dependencies=[Depends(require_admin)], include_in_schema=False)
+def read_metrics():
+    # Prometheus text format, summed over every gunicorn worker (see metrics.py)
+    content, content_type = metrics.render()
+    return Response(content, media_type=content_type)
+
 app.include_router(auth.router, prefix="/api/v1/auth", tags=["auth"])
 app.include_router(users.router, prefix="/api/v1/users", tags=["users"])
 app.include_router(reflections.router, prefix="/api/v1/reflections", tags=["reflections"])
 app.include_router(notifications.router, prefix="/api/v1/notifications", tags=["notifications"])
 app.include_router(herds.router, prefix="/api/v1/herds", tags=["herds"])
+app.include_router(images.router, prefix="/api/v1/images", tags=["images"])
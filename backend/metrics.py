@@ -0,0 +1,258 @@
+"""
+Request metrics in the Prometheus text format, served on GET /metrics.
+
+``MetricsMiddleware`` records, per route template (``/api/v1/herds/{id}``,
+never the raw path):
+
+- ``http_requests_total``: requests by method, route and status
+- ``http_request_duration_seconds``: latency histogram
+- ``http_requests_in_flight``: requests being handled right now
+- ``http_request_mongo_commands``: MongoDB round trips per request
+
+``CommandMetrics`` is a pymongo CommandListener (installed on the client in
+database.py) that attributes every command to the request that issued it:
+``mongo_commands_total``, ``mongo_command_duration_seconds`` and
+``mongo_reply_bytes_total``, by route and command name. Commands sent
+outside a request, e.g. by change streams or background tasks, are
+recorded under the route "-".
+
+Process internals that requests depend on:
+
+- ``invalidation_lag_seconds``: delay between a change and a worker
+  evicting it from its caches, by collection (see invalidation.py)
+- ``invalidations_dropped_total``: invalidations a worker couldn't send
+  because a peer's socket buffer was full
+- ``cache_hits_total`` / ``cache_misses_total``: lookups in the named
+  in-process caches (see cache.py), by cache
+
+start.sh runs several gunicorn workers, each with its own counters. With
+PROMETHEUS_MULTIPROC_DIR set (start.sh sets it, gunicorn.conf.py cleans it
+up) every worker writes its samples to files there and /metrics sums them,
+so any worker can answer the scrape. Without it, /metrics reports the
+answering process only.
+"""
+import contextvars
+import os
+import re
+import threading
+import time
+from typing import Optional
+
+import bson
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from pymongo import monitoring
+from starlette.routing import compile_path
+
+try:
+    from fastapi.routing import iter_route_contexts
+except ImportError:
+    iter_route_contexts = None
+
+# Re-encoding replies to measure them costs CPU on every command; turn off if it shows
+METRICS_REPLY_BYTES = os.getenv("METRICS_REPLY_BYTES", "true").lower() == "true"
+# Commands kept per request for the slow-request log (see slow_requests.py)
+MAX_LOGGED_COMMANDS = int(os.getenv("MAX_LOGGED_COMMANDS", 50))
+
+UNMATCHED_ROUTE = "unmatched"
+NO_REQUEST = "-"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COMMAND_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+ROUND_TRIP_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 50)
+INVALIDATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5, 30)
+
+REQUESTS = Counter("http_requests_total", "HTTP requests", ["method", "route", "status"])
+LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ["method", "route"], buckets=LATENCY_BUCKETS
+)
+IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "HTTP requests being handled", ["method", "route"], multiprocess_mode="livesum"
+)
+ROUND_TRIPS = Histogram(
+    "http_request_mongo_commands", "MongoDB commands per HTTP request", ["route"], buckets=ROUND_TRIP_BUCKETS
+)
+COMMANDS = Counter("mongo_commands_total", "MongoDB commands", ["route", "command", "outcome"])
+COMMAND_LATENCY = Histogram(
+    "mongo_command_duration_seconds", "MongoDB command latency", ["route", "command"], buckets=COMMAND_BUCKETS
+)
+REPLY_BYTES = Counter("mongo_reply_bytes_total", "BSON bytes returned by MongoDB", ["route", "command"])
+INVALIDATION_LAG = Histogram(
+    "invalidation_lag_seconds", "Delay between a change and this worker evicting it", ["collection"],
+    buckets=INVALIDATION_BUCKETS,
+)
+INVALIDATIONS_DROPPED = Counter("invalidations_dropped_total", "Invalidations not delivered to a worker")
+CACHE_HITS = Counter("cache_hits_total", "In-process cache lookups that found a live entry", ["cache"])
+CACHE_MISSES = Counter("cache_misses_total", "In-process cache lookups that found nothing or an expired entry", ["cache"])
+
+
+class RequestStats:
+    """
+    What one request made MongoDB do. Motor runs commands on executor
+    threads, which see a copy of the request's context, so the listener
+    updates this shared object rather than setting context variables.
+    """
+    __slots__ = ("route", "user_id", "commands", "command_log", "serialization_seconds", "_lock")
+
+    def __init__(self, route: str):
+        self.route = route
+        self.user_id: Optional[str] = None
+        self.commands = 0
+        # (command, seconds, ok), capped at MAX_LOGGED_COMMANDS
+        self.command_log: list[tuple[str, float, bool]] = []
+        self.serialization_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def count_command(self):
+        with self._lock:
+            self.commands += 1
+
+    def log_command(self, command: str, seconds: float, ok: bool):
+        with self._lock:
+            if len(self.command_log) < MAX_LOGGED_COMMANDS:
+                self.command_log.append((command, seconds, ok))
+
+
+current_request: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "current_request", default=None
+)
+
+
+def record_user(user_id: str):
+    stats = current_request.get()
+    if stats is not None:
+        stats.user_id = user_id
+
+
+def record_serialization(seconds: float):
+    stats = current_request.get()
+    if stats is not None:
+        stats.serialization_seconds += seconds
+
+
+class CommandMetrics(monitoring.CommandListener):
+    def _route(self, event, ok: bool) -> str:
+        stats = current_request.get()
+        if stats is None:
+            return NO_REQUEST
+        stats.log_command(event.command_name, event.duration_micros / 1e6, ok)
+        return stats.route
+
+    def started(self, event):
+        stats = current_request.get()
+        if stats is not None:
+            stats.count_command()
+
+    def succeeded(self, event):
+        route = self._route(event, True)
+        COMMANDS.labels(route, event.command_name, "ok").inc()
+        COMMAND_LATENCY.labels(route, event.command_name).observe(event.duration_micros / 1e6)
+        if METRICS_REPLY_BYTES and event.reply:
+            REPLY_BYTES.labels(route, event.command_name).inc(len(bson.encode(event.reply)))
+
+    def failed(self, event):
+        route = self._route(event, False)
+        COMMANDS.labels(route, event.command_name, "error").inc()
+        COMMAND_LATENCY.labels(route, event.command_name).observe(event.duration_micros / 1e6)
+
+
+command_metrics = CommandMetrics()
+
+
+# (id(app), route count) -> [(pattern, template, methods)]
+_route_tables: dict[tuple[int, int], list] = {}
+
+
+def _route_table(app) -> list[tuple[re.Pattern, str, Optional[set]]]:
+    """
+    Every route of ``app`` with its full path template. Recent FastAPI
+    versions keep included routes under their router's own prefix, so the
+    full templates come from ``iter_route_contexts`` when it exists.
+    """
+    routes = list(getattr(app, "routes", ()))
+    key = (id(app), len(routes))
+    table = _route_tables.get(key)
+    if table is None:
+        if iter_route_contexts is not None:
+            entries = [(context.path_format, context.methods) for context in iter_route_contexts(routes)]
+        else:
+            entries = [(route.path, getattr(route, "methods", None)) for route in routes if hasattr(route, "path")]
+        table = [(compile_path(path)[0], path, methods) for path, methods in entries]
+        _route_tables[key] = table
+    return table
+
+
+def route_template(scope) -> str:
+    """
+    The path template of the route that will handle ``scope``. Matching up
+    front, rather than reading the route after the app ran, lets in-flight
+    requests carry the label too.
+    """
+    path = scope["path"]
+    root_path = scope.get("root_path", "")
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    method = "GET" if scope.get("method") == "HEAD" else scope.get("method")
+    for pattern, template, methods in _route_table(scope.get("app")):
+        if pattern.match(path) and (not methods or method in methods):
+            return template
+    return UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware, so streaming responses aren't buffered.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method, route = scope["method"], route_template(scope)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        stats = RequestStats(route)
+        token = current_request.set(stats)
+        in_flight = IN_FLIGHT.labels(method, route)
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            in_flight.dec()
+            current_request.reset(token)
+            REQUESTS.labels(method, route, str(status_code)).inc()
+            LATENCY.labels(method, route).observe(elapsed)
+            ROUND_TRIPS.labels(route).observe(stats.commands)
+
+
+def render() -> tuple[bytes, str]:
+    """
+    The current metrics and their content type. Sums every worker's samples
+    in multiprocess mode.
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,379 @@
+"""
+Versioned schema migrations and index bootstrap.
+
+Every index the routers rely on is declared in ``INDEXES``. Migrations are
+numbered and applied in order; each applied version is recorded in the
+``schema_migrations`` collection so it only ever runs once.
+
+The FastAPI lifespan hook in main.py applies pending migrations (unless
+AUTO_MIGRATE=false) and refuses to start while any migration is pending or
+a required index is missing. Every gunicorn worker runs that hook, so
+``migrate`` first takes a lease, a document in ``schema_migrations`` that
+expires after MIGRATION_LEASE_SECONDS unless renewed. One worker migrates;
+the others wait for it to finish (or for its lease to expire, if it died)
+before they verify. From the command line:
+
+    python migrations.py upgrade   # apply pending migrations
+    python migrations.py status    # show applied/pending versions
+    python migrations.py verify    # exit non-zero if the schema is not ready
+"""
+import argparse
+import asyncio
+import base64
+import binascii
+import os
+import socket
+import sys
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable
+
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from database import db
+from blobstore import get_blob_store
+import reflection_stats
+import herd_index
+import authors
+
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "true").lower() == "true"
+# Renewed before each migration, so it only needs to outlast the slowest one
+MIGRATION_LEASE_SECONDS = int(os.getenv("MIGRATION_LEASE_SECONDS", 600))
+MIGRATION_POLL_SECONDS = float(os.getenv("MIGRATION_POLL_SECONDS", 1))
+
+# _id of the lease document; applied migrations are keyed by their version
+LEASE_ID = "lease"
+
+INDEXES = {
+    "users": [
+        # Also makes signup race-free: a concurrent duplicate insert fails with DuplicateKeyError
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        # Reverse friend lookups when bumping friends versions (see versions.bump_followers)
+        IndexModel([("settings.friends", ASCENDING)], name="settings_friends"),
+    ],
+    "reflections": [
+        IndexModel([("user_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)], name="user_timestamp"),
+        IndexModel([("sharedWith", ASCENDING)], name="shared_with"),
+        IndexModel([("sharedHerds", ASCENDING)], name="shared_herds"),
+        # Image access checks (see routers/images.py); most reflections have no image
+        IndexModel(
+            [("image_id", ASCENDING)],
+            name="image_id",
+            partialFilterExpression={"image_id": {"$type": "string"}},
+        ),
+    ],
+    "herd_memberships": [
+        # One membership per user and herd; also serves membership lookups and fan-out
+        IndexModel([("herd_id", ASCENDING), ("user_id", ASCENDING)], name="herd_user_unique", unique=True),
+        IndexModel([("herd_id", ASCENDING), ("_id", DESCENDING)], name="herd_newest"),
+    ],
+    "timelines": [
+        IndexModel(
+            [("recipient_id", ASCENDING), ("timestamp", DESCENDING), ("reflection_id", DESCENDING)],
+            name="recipient_timestamp",
+        ),
+        IndexModel(
+            [("recipient_id", ASCENDING), ("reflection_id", ASCENDING)],
+            name="recipient_reflection_unique",
+            unique=True,
+        ),
+        IndexModel([("reflection_id", ASCENDING)], name="reflection_id"),
+    ],
+    "reactions": [
+        IndexModel(
+            [("reflection_id", ASCENDING), ("user_id", ASCENDING), ("type", ASCENDING)],
+            name="reflection_user_type_unique",
+            unique=True,
+        ),
+    ],
+    "reminder_deliveries": [
+        # Idempotency records only need to outlive the period they cover
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=60 * 24 * 3600),
+    ],
+}
+
+
+class SchemaNotReadyError(RuntimeError):
+    pass
+
+
+@dataclass
+class Migration:
+    version: int
+    description: str
+    apply: Callable[..., Awaitable[None]]
+
+
+MIGRATIONS: list[Migration] = []
+
+
+def migration(version: int, description: str):
+    def decorator(fn):
+        MIGRATIONS.append(Migration(version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return fn
+    return decorator
+
+
+async def ensure_indexes(database):
+    # create_indexes is a no-op for indexes that already exist with the same spec
+    for collection, indexes in INDEXES.items():
+        await database[collection].create_indexes(indexes)
+
+
+@migration(1, "Create initial indexes for users, reflections, herds and timelines")
+async def _initial_indexes(database):
+    await ensure_indexes(database)
+
+
+@migration(2, "Move inline base64 reflection images into the blob store")
+async def _externalize_images(database):
+    store = get_blob_store(database)
+    cursor = database.reflections.find({"image": {"$type": "string"}}, {"image": 1, "user_id": 1})
+    async for reflection in cursor:
+        # Data URLs look like "data:image/png;base64,....". Anything else is left untouched.
+        header, _, encoded = reflection["image"].partition(",")
+        if not (header.startswith("data:") and header.endswith(";base64")):
+            continue
+        try:
+            data = base64.b64decode(encoded)
+        except (binascii.Error, ValueError):
+            continue
+
+        content_type = header[len("data:"):-len(";base64")] or "application/octet-stream"
+        info = await store.put_bytes(data, content_type, owner_id=reflection.get("user_id"))
+        update = {"$set": {"image_id": info.id}, "$unset": {"image": ""}}
+        await database.reflections.update_one({"_id": reflection["_id"]}, update)
+        await database.timelines.update_many(
+            {"reflection_id": reflection["_id"]},
+            {"$set": {"item.image_id": info.id}, "$unset": {"item.image": ""}},
+        )
+
+
+@migration(3, "Expire reminder delivery records")
+async def _reminder_delivery_ttl(database):
+    await ensure_indexes(database)
+
+
+@migration(4, "Denormalize last_reflection_at and reflection_streak onto users")
+async def _reflection_stats(database):
+    await reflection_stats.backfill(database)
+
+
+@migration(5, "Build the reverse herd index in users.settings.herds")
+async def _herd_index(database):
+    await herd_index.repair(database)
+
+
+@migration(6, "Move embedded herd members into herd_memberships")
+async def _herd_memberships(database):
+    await ensure_indexes(database)
+
+    async for herd in database.herds.find({"members": {"$exists": True}}, {"members": 1}):
+        herd_id = str(herd["_id"])
+        ops = [
+            UpdateOne(
+                {"herd_id": herd_id, "user_id": member["user_id"]},
+                {"$setOnInsert": {
+                    "email": member.get("email"),
+                    "joined_at": member.get("joined_at"),
+                    "role": member.get("role", "member"),
+                }},
+                upsert=True,
+            )
+            for member in herd.get("members") or []
+            if member.get("user_id")
+        ]
+        if ops:
+            await database.herd_memberships.bulk_write(ops, ordered=False)
+        member_count = await database.herd_memberships.count_documents({"herd_id": herd_id})
+        await database.herds.update_one(
+            {"_id": herd["_id"]}, {"$set": {"member_count": member_count}, "$unset": {"members": ""}}
+        )
+
+    try:
+        await database.herds.drop_index("member_created")
+    except OperationFailure:
+        pass  # Never created, or already dropped
+    await herd_index.repair(database)
+
+
+@migration(7, "Move embedded curiosityReactions into reactions edges with counters")
+async def _reaction_edges(database):
+    await ensure_indexes(database)
+
+    async for reflection in database.reflections.find({"curiosityReactions": {"$exists": True}}):
+        embedded = reflection.get("curiosityReactions") or {}
+        counts, mine, edges = {}, {}, []
+        for reaction_type, user_ids in embedded.items():
+            user_ids = set(u for u in user_ids or [] if isinstance(u, str))
+            counts[reaction_type] = len(user_ids)
+            for user_id in user_ids:
+                mine.setdefault(user_id, []).append(reaction_type)
+                key = {"reflection_id": reflection["_id"], "user_id": user_id, "type": reaction_type}
+                edges.append(UpdateOne(key, {"$setOnInsert": {"created_at": datetime.now(timezone.utc)}}, upsert=True))
+        if edges:
+            await database.reactions.bulk_write(edges, ordered=False)
+
+        del reflection["curiosityReactions"]
+        reflection["reaction_counts"] = counts
+        await database.reflections.update_one(
+            {"_id": reflection["_id"]},
+            {"$set": {"reaction_counts": counts}, "$unset": {"curiosityReactions": ""}},
+        )
+        # Timeline copies: new counters for everyone, my_reactions for each reactor
+        await database.timelines.update_many(
+            {"reflection_id": reflection["_id"]},
+            {"$set": {"item": reflection}},
+        )
+        flags = [
+            UpdateOne({"recipient_id": user_id, "reflection_id": reflection["_id"]}, {"$set": {"my_reactions": types}})
+            for user_id, types in mine.items()
+        ]
+        if flags:
+            await database.timelines.bulk_write(flags, ordered=False)
+
+
+@migration(8, "Snapshot author_name onto reflections and timeline entries")
+async def _author_snapshots(database):
+    await authors.propagate_all(database)
+
+
+@migration(9, "Index users.settings.friends for conditional GET version bumps")
+async def _friends_index(database):
+    await ensure_indexes(database)
+
+
+@migration(10, "Enable change stream pre-images on timelines for live feed removals")
+async def _timeline_pre_images(database):
+    try:
+        await database.command("collMod", "timelines", changeStreamPreAndPostImages={"enabled": True})
+    except OperationFailure:
+        # Standalone servers and MongoDB < 6.0: live feeds just won't see removals
+        pass
+
+
+@migration(11, "Index reflections.image_id for image access checks")
+async def _image_id_index(database):
+    await ensure_indexes(database)
+
+
+async def applied_versions(database) -> set[int]:
+    return {doc["_id"] async for doc in database.schema_migrations.find({"_id": {"$ne": LEASE_ID}}, {"_id": 1})}
+
+
+async def pending_versions(database) -> list[int]:
+    done = await applied_versions(database)
+    return [m.version for m in MIGRATIONS if m.version not in done]
+
+
+async def acquire_lease(database, holder: str) -> bool:
+    """
+    Takes or renews the migration lease for ``holder``. False while another
+    holder's lease is current.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        # Matches our own lease or an expired one; otherwise the upsert
+        # collides with the current holder's document
+        await database.schema_migrations.find_one_and_update(
+            {"_id": LEASE_ID, "$or": [{"holder": holder}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"holder": holder, "expires_at": now + timedelta(seconds=MIGRATION_LEASE_SECONDS)}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+async def release_lease(database, holder: str):
+    await database.schema_migrations.delete_one({"_id": LEASE_ID, "holder": holder})
+
+
+async def missing_indexes(database) -> list[str]:
+    missing = []
+    for collection, indexes in INDEXES.items():
+        existing = await database[collection].index_information()
+        for index in indexes:
+            name = index.document["name"]
+            if name not in existing:
+                missing.append(f"{collection}.{name}")
+    return missing
+
+
+async def migrate(database=db) -> list[int]:
+    """
+    Applies every pending migration in version order, under the lease, and
+    returns the versions that were applied. Returns [] without applying
+    anything when another process finished them while this one waited.
+    """
+    holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    while not await acquire_lease(database, holder):
+        if not await pending_versions(database):
+            return []
+        await asyncio.sleep(MIGRATION_POLL_SECONDS)
+
+    try:
+        done = await applied_versions(database)
+        applied = []
+        for m in MIGRATIONS:
+            if m.version in done:
+                continue
+            if not await acquire_lease(database, holder):
+                raise SchemaNotReadyError(
+                    f"Migration lease expired before migration {m.version}; raise MIGRATION_LEASE_SECONDS"
+                )
+            await m.apply(database)
+            await database.schema_migrations.update_one(
+                {"_id": m.version},
+                {"$setOnInsert": {
+                    "description": m.description,
+                    "applied_at": datetime.now(timezone.utc).isoformat(),
+                }},
+                upsert=True,
+            )
+            applied.append(m.version)
+        return applied
+    finally:
+        await release_lease(database, holder)
+
+
+async def verify(database=db):
+    """
+    Raises SchemaNotReadyError if a migration is pending or a required index is missing.
+    """
+    pending = await pending_versions(database)
+    if pending:
+        raise SchemaNotReadyError(f"Pending schema migrations: {pending}. Run `python migrations.py upgrade`.")
+
+    missing = await missing_indexes(database)
+    if missing:
+        raise SchemaNotReadyError(f"Missing required indexes: {', '.join(missing)}. Run `python migrations.py upgrade`.")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Manage database schema migrations and indexes.")
+    parser.add_argument("command", choices=["upgrade", "status", "verify"])
+    args = parser.parse_args()
+
+    if args.command == "upgrade":
+        applied = await migrate()
+        print(f"Applied migrations: {applied}" if applied else "Schema is up to date")
+    elif args.command == "status":
+        done = await applied_versions(db)
+        for m in MIGRATIONS:
+            state = "applied" if m.version in done else "pending"
+            print(f"{m.version:>4}  {state:<8} {m.description}")
+    elif args.command == "verify":
+        try:
+            await verify()
+        except SchemaNotReadyError as e:
+            print(e)
+            sys.exit(1)
+        print("Schema is ready")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
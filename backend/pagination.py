@@ -0,0 +1,116 @@
+"""
+Keyset (cursor) pagination helpers for list endpoints.
+
+Pages are ordered by (sort_field, id_field) descending. The cursor handed to
+clients is an opaque url-safe token holding the sort key of the last item of
+the previous page, so each page is an indexed range scan no matter how deep
+the client has scrolled.
+"""
+import base64
+import json
+from typing import Iterable, Optional
+
+from bson import ObjectId
+from fastapi import HTTPException, Query
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class PageParams:
+    def __init__(
+        self,
+        cursor: Optional[str] = Query(None, description="Opaque cursor from a previous page's next_cursor"),
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    ):
+        self.cursor = cursor
+        self.limit = limit
+
+
+def encode_cursor(doc: dict, sort_field: Optional[str], id_field: str = "_id") -> str:
+    key = [str(doc[id_field])]
+    if sort_field:
+        key.insert(0, doc[sort_field])
+    raw = json.dumps(key, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort_field: Optional[str]) -> tuple[Optional[str], ObjectId]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        key = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if sort_field:
+            sort_value, last_id = key
+        else:
+            sort_value, (last_id,) = None, key
+        return sort_value, ObjectId(last_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_filter(cursor: str, sort_field: Optional[str], id_field: str = "_id") -> dict:
+    sort_value, last_id = decode_cursor(cursor, sort_field)
+    if not sort_field:
+        return {id_field: {"$lt": last_id}}
+    return {
+        "$or": [
+            {sort_field: {"$lt": sort_value}},
+            {sort_field: sort_value, id_field: {"$lt": last_id}},
+        ]
+    }
+
+
+async def fetch_page(
+    collection,
+    query: dict,
+    page: PageParams,
+    sort_field: Optional[str] = "timestamp",
+    id_field: str = "_id",
+    projection: Optional[dict] = None,
+    session=None,
+) -> tuple[list[dict], Optional[str]]:
+    """
+    Returns one page of documents matching ``query`` and the cursor for the
+    next page (None when this is the last one).
+    """
+    if page.cursor:
+        query = {"$and": [query, keyset_filter(page.cursor, sort_field, id_field)]}
+
+    sort = [(id_field, -1)]
+    if sort_field:
+        sort.insert(0, (sort_field, -1))
+
+    # Fetch one extra document to find out whether another page exists
+    docs = await collection.find(query, projection, session=session).sort(sort).limit(page.limit + 1).to_list(page.limit + 1)
+
+    next_cursor = None
+    if len(docs) > page.limit:
+        docs = docs[:page.limit]
+        next_cursor = encode_cursor(docs[-1], sort_field, id_field)
+    return docs, next_cursor
+
+
+def paginate(
+    docs: Iterable[dict],
+    page: PageParams,
+    sort_field: Optional[str] = "timestamp",
+    id_field: str = "_id",
+) -> tuple[list[dict], Optional[str]]:
+    """
+    ``fetch_page`` for documents already in memory (see storage/memory.py):
+    same order, same cursors.
+    """
+    def key(doc: dict) -> tuple:
+        return (doc[sort_field], doc[id_field]) if sort_field else (doc[id_field],)
+
+    docs = sorted(docs, key=key, reverse=True)
+    if page.cursor:
+        sort_value, last_id = decode_cursor(page.cursor, sort_field)
+        last = (sort_value, last_id) if sort_field else (last_id,)
+        docs = [doc for doc in docs if key(doc) < last]
+
+    next_cursor = None
+    if len(docs) > page.limit:
+        docs = docs[:page.limit]
+        next_cursor = encode_cursor(docs[-1], sort_field, id_field)
+    return docs, next_cursor
@@ -0,0 +1,180 @@
+"""
+Per-user reflection stats denormalized onto the user document:
+
+- ``last_reflection_at``: timestamp of the user's latest reflection
+- ``reflection_streak``: consecutive UTC days with a reflection, ending on
+  the day of ``last_reflection_at``
+
+They let /notifications/status and the reminder dispatcher decide without
+querying reflections. create_reflection and delete_reflection keep them
+current; ``python reflection_stats.py backfill`` populates existing users.
+"""
+import argparse
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from database import db
+
+# Enough history to compute any realistic streak when recomputing after a delete
+MAX_STREAK_SCAN = 3660
+
+
+def day_start(dt: datetime) -> datetime:
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def streak_from_days(days: list[str]) -> int:
+    """
+    Counts consecutive days from the first entry of a list of distinct
+    "YYYY-MM-DD" strings sorted newest first.
+    """
+    if not days:
+        return 0
+    streak = 1
+    expected = datetime.fromisoformat(days[0]) - timedelta(days=1)
+    for day in days[1:]:
+        if datetime.fromisoformat(day) != expected:
+            break
+        streak += 1
+        expected -= timedelta(days=1)
+    return streak
+
+
+def current_streak(last_reflection_at: Optional[str], stored_streak: int, now: Optional[datetime] = None) -> int:
+    """
+    The stored streak only counts while it is still alive, i.e. the last
+    reflection was today or yesterday.
+    """
+    if not last_reflection_at:
+        return 0
+    now = now or datetime.now(timezone.utc)
+    yesterday = (day_start(now) - timedelta(days=1)).isoformat()
+    return stored_streak if last_reflection_at >= yesterday else 0
+
+
+def affected_by_delete(last_reflection_at: Optional[str], stored_streak: int, timestamp: str) -> bool:
+    """
+    Deleting a reflection older than the first day of the stored streak
+    can't change either field, so no recompute is needed.
+    """
+    if not last_reflection_at:
+        return True
+    streak_start = datetime.fromisoformat(last_reflection_at[:10]) - timedelta(days=max(stored_streak, 1) - 1)
+    return timestamp[:10] >= streak_start.strftime("%Y-%m-%d")
+
+
+async def record_reflection(user_id: str, timestamp: str, database=db):
+    """
+    Atomically folds a new reflection into the user's stats with a single
+    pipeline update, so concurrent creates can't lose an increment.
+    """
+    created = datetime.fromisoformat(timestamp)
+    today = day_start(created).isoformat()
+    yesterday = (day_start(created) - timedelta(days=1)).isoformat()
+
+    await database.users.update_one(
+        {"_id": ObjectId(user_id)},
+        [{"$set": {
+            # Every expression below sees the document as it was before this update
+            "reflection_streak": {"$switch": {
+                "branches": [
+                    {"case": {"$gte": ["$last_reflection_at", today]},
+                     "then": {"$max": [{"$ifNull": ["$reflection_streak", 0]}, 1]}},
+                    {"case": {"$gte": ["$last_reflection_at", yesterday]},
+                     "then": {"$add": [{"$ifNull": ["$reflection_streak", 0]}, 1]}},
+                ],
+                "default": 1,
+            }},
+            "last_reflection_at": {"$max": ["$last_reflection_at", timestamp]},
+        }}],
+    )
+
+
+async def _compute(user_id: str, database) -> tuple[Optional[str], int]:
+    cursor = database.reflections.find(
+        {"user_id": user_id}, {"_id": 0, "timestamp": 1}
+    ).sort([("timestamp", -1), ("_id", -1)])
+
+    last_reflection_at, days = None, []
+    async for reflection in cursor:
+        if last_reflection_at is None:
+            last_reflection_at = reflection["timestamp"]
+        day = reflection["timestamp"][:10]
+        if days and day == days[-1]:
+            continue
+        # Stop at the first gap: older reflections can't extend the streak
+        if days and datetime.fromisoformat(day) != datetime.fromisoformat(days[-1]) - timedelta(days=1):
+            break
+        days.append(day)
+        if len(days) >= MAX_STREAK_SCAN:
+            break
+    return last_reflection_at, streak_from_days(days)
+
+
+async def recompute(user_id: str, database=db, attempts: int = 3):
+    """
+    Recomputes a user's stats from their reflections, e.g. after a delete.
+    The write only applies if no other reflection was recorded meanwhile;
+    otherwise the computation is retried.
+    """
+    for _ in range(attempts):
+        user = await database.users.find_one({"_id": ObjectId(user_id)}, {"last_reflection_at": 1})
+        if user is None:
+            return
+        last_reflection_at, streak = await _compute(user_id, database)
+        result = await database.users.update_one(
+            {"_id": ObjectId(user_id), "last_reflection_at": user.get("last_reflection_at")},
+            {"$set": {"last_reflection_at": last_reflection_at, "reflection_streak": streak}},
+        )
+        if result.matched_count:
+            return
+
+
+async def backfill(database=db) -> int:
+    """
+    Populates the stats of every user from the reflections collection.
+    Returns the number of users updated.
+    """
+    pipeline = [
+        {"$group": {
+            "_id": "$user_id",
+            "last_reflection_at": {"$max": "$timestamp"},
+            "days": {"$addToSet": {"$substrBytes": ["$timestamp", 0, 10]}},
+        }},
+    ]
+    ops = []
+    updated = 0
+    async for row in database.reflections.aggregate(pipeline, allowDiskUse=True):
+        if not ObjectId.is_valid(row["_id"]):
+            continue
+        ops.append(UpdateOne(
+            {"_id": ObjectId(row["_id"])},
+            {"$set": {
+                "last_reflection_at": row["last_reflection_at"],
+                "reflection_streak": streak_from_days(sorted(row["days"], reverse=True)),
+            }},
+        ))
+        if len(ops) >= 1000:
+            updated += (await database.users.bulk_write(ops, ordered=False)).modified_count
+            ops = []
+    if ops:
+        updated += (await database.users.bulk_write(ops, ordered=False)).modified_count
+    return updated
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Manage denormalized per-user reflection stats.")
+    parser.add_argument("command", choices=["backfill"])
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        updated = await backfill()
+        print(f"Backfilled reflection stats for {updated} users")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,196 @@
+"""
+Bulk reminder dispatcher behind POST /notifications/trigger.
+
+One aggregation over ``users`` compares each user's denormalized
+``last_reflection_at`` (see reflection_stats.py) against their cadence and
+yields only the users whose daily or weekly reminder is due. Results
+are streamed from the cursor into a bounded queue drained by
+REMINDER_WORKERS concurrent senders.
+
+Each reminder is claimed in ``reminder_deliveries`` under a key made of the
+user, cadence and period (day or ISO week) before it is sent, so re-running
+the dispatcher, or running it from two places at once, never sends the same
+reminder twice. A failed send releases its claim so the next run retries it.
+
+    python reminders.py    # same as calling the endpoint
+"""
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, asdict, field
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from pymongo.errors import DuplicateKeyError
+
+from database import db
+from utils.email import EmailSender, get_sender
+
+logger = logging.getLogger(__name__)
+
+REMINDER_WORKERS = int(os.getenv("REMINDER_WORKERS", 16))
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", 1000))
+
+MESSAGES = {
+    "daily": (
+        "Reminder: Time to Reflect!",
+        "You haven't recorded your High, Low, and Buffalo today. Take a moment to reflect!",
+    ),
+    "weekly": (
+        "Reminder: Time to Reflect!",
+        "It's been a week since your last reflection. Time to check in!",
+    ),
+}
+
+
+@dataclass
+class DispatchStats:
+    due: int = 0
+    sent: int = 0
+    skipped: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+    errors: list[str] = field(default_factory=list)
+
+    def as_dict(self) -> dict:
+        stats = asdict(self)
+        stats["per_second"] = round(self.sent / self.seconds, 1) if self.seconds else 0.0
+        return stats
+
+
+def period_keys(now: datetime) -> dict[str, str]:
+    iso_year, iso_week, _ = now.isocalendar()
+    return {"daily": now.strftime("%Y-%m-%d"), "weekly": f"{iso_year}-W{iso_week:02d}"}
+
+
+def due_users_pipeline(now: datetime) -> list[dict]:
+    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
+    week_ago = (now - timedelta(days=7)).isoformat()
+    periods = period_keys(now)
+
+    return [
+        {"$match": {
+            "is_active": {"$ne": False},
+            "$or": [
+                {"settings.notificationCadence": {"$in": ["daily", "weekly"]}},
+                {"settings.notificationCadence": {"$exists": False}},
+            ],
+        }},
+        {"$project": {
+            "email": 1,
+            "user_id": {"$toString": "$_id"},
+            "cadence": {"$ifNull": ["$settings.notificationCadence", "daily"]},
+            "last_reflection_at": 1,
+        }},
+        {"$match": {"$expr": {"$or": [
+            {"$eq": [{"$ifNull": ["$last_reflection_at", None]}, None]},
+            {"$and": [{"$eq": ["$cadence", "daily"]}, {"$lt": ["$last_reflection_at", today_start]}]},
+            {"$and": [{"$eq": ["$cadence", "weekly"]}, {"$lt": ["$last_reflection_at", week_ago]}]},
+        ]}}},
+        # Skip reminders already sent for this period without touching the sender
+        {"$set": {"delivery_key": {"$concat": [
+            "$user_id", ":", "$cadence", ":",
+            {"$cond": [{"$eq": ["$cadence", "daily"]}, periods["daily"], periods["weekly"]]},
+        ]}}},
+        {"$lookup": {
+            "from": "reminder_deliveries",
+            "localField": "delivery_key",
+            "foreignField": "_id",
+            "pipeline": [{"$project": {"_id": 1}}],
+            "as": "delivered",
+        }},
+        {"$match": {"delivered": {"$size": 0}}},
+        {"$project": {"email": 1, "user_id": 1, "cadence": 1, "delivery_key": 1}},
+    ]
+
+
+def _record_failure(stats: DispatchStats, user: dict, error: Exception):
+    stats.failed += 1
+    if len(stats.errors) < 10:
+        stats.errors.append(f"{user['email']}: {error}")
+
+
+async def _deliver(database, sender: EmailSender, user: dict, stats: DispatchStats):
+    key = user["delivery_key"]
+    try:
+        await database.reminder_deliveries.insert_one({
+            "_id": key,
+            "user_id": user["user_id"],
+            "cadence": user["cadence"],
+            "status": "sending",
+            "created_at": datetime.now(timezone.utc),
+        })
+    except DuplicateKeyError:
+        # Another run already claimed this reminder
+        stats.skipped += 1
+        return
+
+    subject, body = MESSAGES[user["cadence"]]
+    try:
+        await sender.send(user["email"], subject, body)
+    except Exception as e:
+        logger.warning("Failed to send reminder to %s: %s", user["email"], e)
+        await database.reminder_deliveries.delete_one({"_id": key})
+        _record_failure(stats, user, e)
+        return
+
+    await database.reminder_deliveries.update_one({"_id": key}, {"$set": {"status": "sent"}})
+    stats.sent += 1
+
+
+async def dispatch_reminders(
+    database=db,
+    sender: Optional[EmailSender] = None,
+    now: Optional[datetime] = None,
+    workers: int = REMINDER_WORKERS,
+) -> DispatchStats:
+    now = now or datetime.now(timezone.utc)
+    own_sender = sender is None
+    sender = sender or get_sender()
+    stats = DispatchStats()
+    started = time.perf_counter()
+
+    # Bounded so a slow sender applies backpressure to the cursor
+    queue: asyncio.Queue = asyncio.Queue(maxsize=workers * 4)
+
+    async def worker():
+        while True:
+            user = await queue.get()
+            try:
+                await _deliver(database, sender, user, stats)
+            except Exception as e:
+                # Claim or bookkeeping writes failed (e.g. the network). Keep going:
+                # a dead worker would stop draining the queue and stall the cursor
+                logger.exception("Failed to deliver reminder to %s", user["email"])
+                _record_failure(stats, user, e)
+            finally:
+                queue.task_done()
+
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    try:
+        cursor = database.users.aggregate(due_users_pipeline(now), batchSize=REMINDER_BATCH_SIZE)
+        async for user in cursor:
+            stats.due += 1
+            await queue.put(user)
+        await queue.join()
+    finally:
+        # Cancelled rather than sent a sentinel, which could wait on a full queue forever
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if own_sender:
+            await sender.close()
+
+    stats.seconds = round(time.perf_counter() - started, 3)
+    logger.info("Reminder dispatch: %s", stats.as_dict())
+    return stats
+
+
+async def main():
+    stats = await dispatch_reminders()
+    print(stats.as_dict())
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
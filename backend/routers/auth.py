@@ -1,18 +1,28 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from datetime import timedelta
-from database import db
+from storage import store
 import schemas, security
 
 router = APIRouter()
 
+def hashing_overloaded():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many sign-in attempts right now, please retry shortly",
+        headers={"Retry-After": "2"},
+    )
+
 @router.post("/signup", response_model=schemas.User, response_model_by_alias=False)
 async def create_user(user: schemas.UserCreate):
-    user_exists = await db.users.find_one({"email": user.email})
-    if user_exists:
+    # Cheap check first so duplicate signups don't cost a bcrypt hash
+    if await store.users.email_taken(user.email):
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    hashed_password = security.get_password_hash(user.password)
+    try:
+        hashed_password = await security.hash_password(user.password)
+    except security.HashingOverloadedError:
+        raise hashing_overloaded()
     user_dict = user.model_dump()
     user_dict["hashed_password"] = hashed_password
     del user_dict["password"]
@@ -25,20 +35,32 @@ async def create_user(user: schemas.UserCreate):
             "herds": [],
             "friends": []
         }
+    # settings.herds is the herd index every access check reads (see herd_index.py):
+    # only membership changes write it, never the client
+    user_dict["settings"]["herds"] = []
     
-    new_user = await db.users.insert_one(user_dict)
-    created_user = await db.users.find_one({"_id": new_user.inserted_id})
-    return created_user
+    # Signups that race past the check above fail with a ConflictError
+    return await store.users.create(user_dict)
 
 @router.post("/token", response_model=schemas.Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = await db.users.find_one({"email": form_data.username})
-    if not user or not security.verify_password(form_data.password, user["hashed_password"]):
+    user = await store.users.get_by_email(form_data.username)
+    valid, new_hash = False, None
+    if user:
+        try:
+            valid, new_hash = await security.verify_and_update_password(form_data.password, user["hashed_password"])
+        except security.HashingOverloadedError:
+            raise hashing_overloaded()
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+
+    # Transparently upgrade hashes made with an older BCRYPT_ROUNDS
+    if new_hash:
+        await store.users.replace_password_hash(user, new_hash)
     access_token_expires = timedelta(minutes=security.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = security.create_access_token(
         data={"sub": user["email"]}, expires_delta=access_token_expires
@@ -1,125 +1,95 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Body
 from typing import List
-from datetime import datetime, timezone
 from bson import ObjectId
 
-from schemas import Herd, HerdCreate, HerdUpdate, HerdMember, User, FriendAddRequest
-from deps import get_current_user
-from database import db
+from schemas import Herd, HerdCreate, HerdUpdate, HerdMember, User, FriendAddRequest, Page
+from deps import get_current_user, invalidate_user, conditional_get
+from pagination import PageParams
+from serialization import page_response
+from storage import store
 
 router = APIRouter()
 
+def is_member(user: User, herd_id: str) -> bool:
+    # O(1) via the reverse herd index on the user (see herd_index.py)
+    return bool(user.settings) and herd_id in user.settings.herds
+
 @router.post("/", response_model=Herd, status_code=status.HTTP_201_CREATED, response_model_by_alias=False)
 async def create_herd(
     herd: HerdCreate,
     current_user: User = Depends(get_current_user)
 ):
-    herd_data = herd.model_dump()
-    user_id = str(current_user.id)
-    
-    # Create initial member (the owner)
-    owner_member = HerdMember(
-        user_id=user_id,
-        email=current_user.email,
-        joined_at=datetime.now(timezone.utc),
-        role="owner"
-    )
-
-    now = datetime.now(timezone.utc).isoformat()
-    
-    new_herd = {
-        **herd_data,
-        "owner_id": user_id,
-        "members": [owner_member.model_dump()],
-        "created_at": now,
-        "updated_at": now
-    }
-    
-    result = await db.herds.insert_one(new_herd)
-    created_herd = await db.herds.find_one({"_id": result.inserted_id})
-    return created_herd
-
-@router.get("/", response_model=List[Herd], response_model_by_alias=False)
+    new_herd = await store.herds.create(current_user, herd.model_dump())
+    invalidate_user(str(current_user.id))
+    return new_herd
+
+@router.get("/", response_model=Page[Herd], response_model_by_alias=False)
 async def list_herds(
-    current_user: User = Depends(get_current_user)
+    page: PageParams = Depends(),
+    current_user: User = Depends(get_current_user),
+    cache_headers: dict = Depends(conditional_get("herds"))
 ):
-    # Find herds where the user is in the members list
-    # We query 'members.user_id' inside the array of objects
-    herds = await db.herds.find(
-        {"members.user_id": str(current_user.id)}
-    ).to_list(100)
-    return herds
+    # The user's herds come straight from their reverse herd index
+    herd_ids = current_user.settings.herds if current_user.settings else []
+    herds, next_cursor = await store.herds.list_by_ids(herd_ids, page)
+    return page_response(Herd, herds, next_cursor, headers=cache_headers)
 
 @router.get("/{id}", response_model=Herd, response_model_by_alias=False)
 async def get_herd(
     id: str,
     current_user: User = Depends(get_current_user)
 ):
-    try:
-        obj_id = ObjectId(id)
-    except Exception:
+    if not ObjectId.is_valid(id):
         raise HTTPException(status_code=400, detail="Invalid ID format")
 
-    herd = await db.herds.find_one({"_id": obj_id})
+    herd = await store.herds.get(id)
     if not herd:
         raise HTTPException(status_code=404, detail="Herd not found")
 
-    # Check if user is a member
-    is_member = any(m["user_id"] == str(current_user.id) for m in herd.get("members", []))
-    if not is_member:
+    if not is_member(current_user, id):
         raise HTTPException(status_code=403, detail="Not authorized to access this herd")
 
     return herd
 
-@router.put("/{id}", response_model=Herd, response_model_by_alias=False)
-async def update_herd(
+@router.get("/{id}/members", response_model=Page[HerdMember], response_model_by_alias=False)
+async def list_members(
     id: str,
-    herd_update: HerdUpdate,
+    page: PageParams = Depends(),
     current_user: User = Depends(get_current_user)
 ):
-    try:
-        obj_id = ObjectId(id)
-    except Exception:
+    if not ObjectId.is_valid(id):
         raise HTTPException(status_code=400, detail="Invalid ID format")
 
-    herd = await db.herds.find_one({"_id": obj_id})
-    if not herd:
-        raise HTTPException(status_code=404, detail="Herd not found")
+    if not is_member(current_user, id):
+        raise HTTPException(status_code=403, detail="Not authorized to access this herd")
 
-    # Only owner can update details
-    if herd.get("owner_id") != str(current_user.id):
-        raise HTTPException(status_code=403, detail="Only the owner can update the herd")
+    members, next_cursor = await store.herds.list_members(id, page)
+    return page_response(HerdMember, members, next_cursor)
 
-    update_data = herd_update.model_dump(exclude_unset=True)
-    if update_data:
-        update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
-        await db.herds.update_one(
-            {"_id": obj_id},
-            {"$set": update_data}
-        )
+@router.put("/{id}", response_model=Herd, response_model_by_alias=False)
+async def update_herd(
+    id: str,
+    herd_update: HerdUpdate,
+    current_user: User = Depends(get_current_user)
+):
+    if not ObjectId.is_valid(id):
+        raise HTTPException(status_code=400, detail="Invalid ID format")
 
-    updated_herd = await db.herds.find_one({"_id": obj_id})
-    return updated_herd
+    # Only the owner can update details
+    return await store.herds.update(str(current_user.id), id, herd_update.model_dump(exclude_unset=True))
 
 @router.delete("/{id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_herd(
     id: str,
     current_user: User = Depends(get_current_user)
 ):
-    try:
-        obj_id = ObjectId(id)
-    except Exception:
+    if not ObjectId.is_valid(id):
         raise HTTPException(status_code=400, detail="Invalid ID format")
 
-    herd = await db.herds.find_one({"_id": obj_id})
-    if not herd:
-        raise HTTPException(status_code=404, detail="Herd not found")
-
-    # Only owner can delete
-    if herd.get("owner_id") != str(current_user.id):
-        raise HTTPException(status_code=403, detail="Only the owner can delete the herd")
-
-    await db.herds.delete_one({"_id": obj_id})
+    # Only the owner can delete
+    member_ids = await store.herds.delete(str(current_user.id), id)
+    for user_id in member_ids:
+        invalidate_user(user_id)
     return None
 
 @router.post("/{id}/members", response_model=Herd, response_model_by_alias=False)
@@ -128,43 +98,13 @@ async def add_member(
     member_request: FriendAddRequest, # Reusing schema: { "email": "..." }
     current_user: User = Depends(get_current_user)
 ):
-    try:
-        obj_id = ObjectId(id)
-    except Exception:
+    if not ObjectId.is_valid(id):
         raise HTTPException(status_code=400, detail="Invalid ID format")
 
-    herd = await db.herds.find_one({"_id": obj_id})
-    if not herd:
-        raise HTTPException(status_code=404, detail="Herd not found")
-
-    # Check permissions - assume only owner can add for now
-    if herd.get("owner_id") != str(current_user.id):
-        raise HTTPException(status_code=403, detail="Only the owner can add members")
-
-    # Verify user exists
-    user_to_add = await db.users.find_one({"email": member_request.email})
-    if not user_to_add:
-        raise HTTPException(status_code=404, detail="User with this email not found")
-
-    user_to_add_id = str(user_to_add["_id"])
-
-    # Check if already a member
-    if any(m["user_id"] == user_to_add_id for m in herd.get("members", [])):
-        raise HTTPException(status_code=400, detail="User is already a member of this herd")
-
-    new_member = HerdMember(
-        user_id=user_to_add_id,
-        email=user_to_add["email"],
-        joined_at=datetime.now(timezone.utc),
-        role="member"
-    )
-
-    await db.herds.update_one(
-        {"_id": obj_id},
-        {"$push": {"members": new_member.model_dump()}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
-    )
-
-    return await db.herds.find_one({"_id": obj_id})
+    # Only the owner can add (for now)
+    herd, user_id = await store.herds.add_member(str(current_user.id), id, member_request.email)
+    invalidate_user(user_id)
+    return herd
 
 @router.delete("/{id}/members/{user_id}", response_model=Herd, response_model_by_alias=False)
 async def remove_member(
@@ -172,37 +112,10 @@ async def remove_member(
     user_id: str,
     current_user: User = Depends(get_current_user)
 ):
-    try:
-        obj_id = ObjectId(id)
-    except Exception:
+    if not ObjectId.is_valid(id):
         raise HTTPException(status_code=400, detail="Invalid ID format")
 
-    herd = await db.herds.find_one({"_id": obj_id})
-    if not herd:
-        raise HTTPException(status_code=404, detail="Herd not found")
-
-    current_user_id = str(current_user.id)
-    
-    # Check permissions
-    # 1. Owner can remove anyone
-    # 2. User can remove themselves (leave)
-    is_owner = herd.get("owner_id") == current_user_id
-    is_self = user_id == current_user_id
-
-    if not (is_owner or is_self):
-        raise HTTPException(status_code=403, detail="Not authorized to remove this member")
-
-    # Cannot remove the owner (owner must delete herd or transfer ownership - transfer not implemented yet)
-    if user_id == herd.get("owner_id"):
-        raise HTTPException(status_code=400, detail="Owner cannot be removed. Delete the herd instead.")
-
-    # Check if member exists
-    if not any(m["user_id"] == user_id for m in herd.get("members", [])):
-        raise HTTPException(status_code=404, detail="Member not found in herd")
-
-    await db.herds.update_one(
-        {"_id": obj_id},
-        {"$pull": {"members": {"user_id": user_id}}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
-    )
-
-    return await db.herds.find_one({"_id": obj_id})
\ No newline at end of file
+    # Owners can remove anyone but themselves; members can leave
+    herd = await store.herds.remove_member(str(current_user.id), id, user_id)
+    invalidate_user(user_id)
+    return herd
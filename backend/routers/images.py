@@ -0,0 +1,148 @@
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, UploadFile, File, Query, status
+from fastapi.responses import StreamingResponse
+from typing import Optional, Literal
+
+from schemas import User, ImageUploadResponse
+from deps import get_current_user, get_stream_user
+from blobstore import blob_store, is_valid_blob_id, BlobTooLargeError, MAX_IMAGE_BYTES
+from storage import store
+from thumbnails import pipeline, PipelineSaturatedError
+
+router = APIRouter()
+
+ALLOWED_CONTENT_TYPES = {"image/jpeg", "image/png", "image/gif", "image/webp"}
+# Blobs are content-addressed, so a given URL always serves the same bytes.
+# Only the viewer's browser may keep them, and not for long: access ends
+# when a reflection stops being shared with them.
+CACHE_CONTROL = "private, max-age=86400"
+# Served while a thumbnail is still being rendered, so the client re-checks soon
+FALLBACK_CACHE_CONTROL = "private, max-age=60"
+
+
+def parse_range(range_header: str, length: int) -> Optional[tuple[int, int]]:
+    """
+    Parses a single-range "bytes=start-end" header into inclusive offsets.
+    Returns None when the header should be ignored, raises 416 when unsatisfiable.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+
+    start_s, _, end_s = spec.strip().partition("-")
+    try:
+        if start_s:
+            start = int(start_s)
+            end = int(end_s) if end_s else length - 1
+        else:
+            # Suffix range: the last N bytes
+            suffix = int(end_s)
+            start, end = max(length - suffix, 0), length - 1
+    except ValueError:
+        return None
+
+    if start >= length or start > end:
+        raise HTTPException(
+            status_code=416,
+            headers={"Content-Range": f"bytes */{length}"},
+        )
+    return start, min(end, length - 1)
+
+
+@router.post("/", response_model=ImageUploadResponse, status_code=status.HTTP_201_CREATED)
+async def upload_image(
+    file: UploadFile = File(...),
+    current_user: User = Depends(get_current_user)
+):
+    if file.content_type not in ALLOWED_CONTENT_TYPES:
+        raise HTTPException(status_code=415, detail="Unsupported image type")
+
+    # Shed load before storing anything if the thumbnail workers are backed up
+    try:
+        pipeline.reserve()
+    except PipelineSaturatedError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Image processing is busy, please retry shortly",
+            headers={"Retry-After": "5"},
+        )
+
+    try:
+        info = await blob_store.put(file.file, file.content_type, owner_id=str(current_user.id))
+        await file.seek(0)
+        data = await file.read()
+    except BlobTooLargeError:
+        pipeline.release()
+        raise HTTPException(status_code=413, detail=f"Image must be smaller than {MAX_IMAGE_BYTES // (1024 * 1024)}MB")
+    except Exception:
+        pipeline.release()
+        raise
+
+    pipeline.submit(info.id, data)
+    return {"id": info.id, "content_type": info.content_type, "length": info.length}
+
+
+@router.get("/{image_id}")
+async def download_image(
+    image_id: str,
+    request: Request,
+    size: Optional[Literal["sm", "md", "lg"]] = Query(None, description="Thumbnail variant; omit for the original"),
+    current_user: User = Depends(get_stream_user),
+):
+    """
+    Serves an image to the users who uploaded it and to everyone who may
+    read a reflection showing it. Others get a 404, as for a missing image.
+    """
+    if not is_valid_blob_id(image_id):
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    original = await blob_store.stat(image_id)
+    if original is None or not original.owned_by(str(current_user.id)):
+        herd_ids = current_user.settings.herds if current_user.settings else []
+        if original is None or not await store.reflections.shows_image(str(current_user.id), herd_ids, image_id):
+            raise HTTPException(status_code=404, detail="Image not found")
+
+    blob_id = image_id
+    cache_control = CACHE_CONTROL
+    if size:
+        variant_id = await pipeline.variant_id(image_id, size, request.headers.get("accept", ""))
+        if variant_id:
+            blob_id = variant_id
+        else:
+            cache_control = FALLBACK_CACHE_CONTROL
+
+    info = original if blob_id == image_id else await blob_store.stat(blob_id)
+    if info is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    headers = {
+        "ETag": info.etag,
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+    if size:
+        # The variant served depends on whether the client accepts WebP
+        headers["Vary"] = "Accept"
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or info.etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    start, end = 0, info.length - 1
+    status_code = status.HTTP_200_OK
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # A stale If-Range means the client's partial copy is outdated: send the whole image
+    if range_header and (not if_range or if_range.strip() == info.etag):
+        byte_range = parse_range(range_header, info.length)
+        if byte_range:
+            start, end = byte_range
+            status_code = status.HTTP_206_PARTIAL_CONTENT
+            headers["Content-Range"] = f"bytes {start}-{end}/{info.length}"
+
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        blob_store.iter_range(blob_id, start, end),
+        status_code=status_code,
+        media_type=info.content_type,
+        headers=headers,
+    )
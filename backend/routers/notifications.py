@@ -1,8 +1,10 @@
 from fastapi import APIRouter, status, Depends
 from datetime import datetime, timedelta, timezone
-from database import db
-from deps import get_current_user
+from deps import get_current_user, require_admin
+from reminders import MESSAGES
+from reflection_stats import current_streak
 from schemas import User
+from storage import store
 import logging
 
 router = APIRouter()
@@ -24,39 +26,35 @@ async def get_notification_status(current_user: User = Depends(get_current_user)
     if cadence == "paused":
         return {"reminder_needed": False, "message": "Notifications are paused."}
 
+    # 3. Compare against the denormalized last_reflection_at; no database round trip
     now = datetime.now(timezone.utc)
-    user_id = str(current_user.id)
-    
+    last_reflection_at = current_user.last_reflection_at
+    streak = current_streak(last_reflection_at, current_user.reflection_streak, now)
+
     should_notify = False
     message = ""
 
-    # 3. Check reflections based on cadence
     if cadence == "daily":
-        # Check if user has reflected today (since midnight UTC)
+        # Reflected today (since midnight UTC)?
         today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        today_iso = today_start.isoformat()
-        
-        count = await db.reflections.count_documents({
-            "user_id": user_id,
-            "timestamp": {"$gte": today_iso}
-        })
-        
-        if count == 0:
+        if not last_reflection_at or last_reflection_at < today_start.isoformat():
             should_notify = True
-            message = "You haven't recorded your High, Low, and Buffalo today. Take a moment to reflect!"
-            
+            message = MESSAGES["daily"][1]
+
     elif cadence == "weekly":
-        # Check if user has reflected in the last 7 days
+        # Reflected in the last 7 days?
         seven_days_ago = now - timedelta(days=7)
-        seven_days_ago_iso = seven_days_ago.isoformat()
-        
-        count = await db.reflections.count_documents({
-            "user_id": user_id,
-            "timestamp": {"$gte": seven_days_ago_iso}
-        })
-        
-        if count == 0:
+        if not last_reflection_at or last_reflection_at < seven_days_ago.isoformat():
             should_notify = True
-            message = "It's been a week since your last reflection. Time to check in!"
+            message = MESSAGES["weekly"][1]
 
-    return {"reminder_needed": should_notify, "message": message}
\ No newline at end of file
+    return {"reminder_needed": should_notify, "message": message, "streak": streak}
+
+@router.post("/trigger", status_code=status.HTTP_200_OK, dependencies=[Depends(require_admin)])
+async def trigger_reminders():
+    """
+    (Admin/Cron) Sends reminder emails to every user whose daily or weekly
+    reminder is due. Safe to re-run: reminders already sent this period are skipped.
+    """
+    stats = await store.notifications.dispatch_reminders()
+    return stats.as_dict()
@@ -1,8 +1,9 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Response, status
 from typing import List
-from database import db
-from bson import ObjectId
+from pagination import PageParams
+from storage import store
 import schemas, deps
+from authors import author_name
 
 router = APIRouter()
 
@@ -12,7 +13,7 @@ async def add_friend(
     current_user: schemas.User = Depends(deps.get_current_user)
 ):
     # Search for user by email
-    friend = await db.users.find_one({"email": friend_request.email})
+    friend = await store.users.get_by_email(friend_request.email)
     if not friend:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -28,29 +29,25 @@ async def add_friend(
         )
 
     # Add to friends list if not already there
-    # Note: We rely on $addToSet to handle uniqueness
-    await db.users.update_one(
-        {"_id": ObjectId(current_user.id)},
-        {"$addToSet": {"settings.friends": friend_id}}
-    )
+    await store.users.add_friend(str(current_user.id), friend_id)
+    deps.invalidate_user(str(current_user.id))
     
     # Return basic info about the friend
     return schemas.User(**friend)
 
-@router.get("/friends", response_model=List[schemas.User], response_model_by_alias=False)
+@router.get("/friends", response_model=schemas.Page[schemas.User], response_model_by_alias=False)
 async def get_friends(
-    current_user: schemas.User = Depends(deps.get_current_user)
+    response: Response,
+    page: PageParams = Depends(),
+    current_user: schemas.User = Depends(deps.get_current_user),
+    cache_headers: dict = Depends(deps.conditional_get("friends"))
 ):
+    response.headers.update(cache_headers)
     if not current_user.settings or not current_user.settings.friends:
-        return []
+        return {"items": [], "next_cursor": None}
 
-    try:
-        friend_ids = [ObjectId(fid) for fid in current_user.settings.friends]
-        friends = await db.users.find({"_id": {"$in": friend_ids}}).to_list(1000)
-        return [schemas.User(**f) for f in friends]
-    except Exception as e:
-        print(f"Error fetching friends: {e}")
-        return []
+    friends, next_cursor = await store.users.list_friends(current_user.settings.friends, page)
+    return {"items": [schemas.User(**f) for f in friends], "next_cursor": next_cursor}
 
 @router.delete("/friends/{friend_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def remove_friend(
@@ -74,22 +71,47 @@ async def remove_friend(
         )
 
     # Remove from friends list
-    await db.users.update_one(
-        {"_id": ObjectId(current_user.id)},
-        {"$pull": {"settings.friends": friend_id}}
-    )
+    await store.users.remove_friend(str(current_user.id), friend_id)
+    deps.invalidate_user(str(current_user.id))
     
     return None
 
 @router.get("/me", response_model=schemas.User, response_model_by_alias=False)
-async def read_users_me(current_user: schemas.User = Depends(deps.get_current_user)):
+async def read_users_me(
+    response: Response,
+    # The same read the ETag hashes (FastAPI resolves a dependency once per request)
+    current_user: schemas.User = Depends(deps.get_fresh_user),
+    cache_headers: dict = Depends(deps.conditional_get("me"))
+):
+    response.headers.update(cache_headers)
     return current_user
 
+@router.put("/me", response_model=schemas.User, response_model_by_alias=False)
+async def update_user_me(
+    user_update: schemas.UserUpdate,
+    background_tasks: BackgroundTasks,
+    current_user: schemas.User = Depends(deps.get_current_user)
+):
+    update_data = user_update.model_dump(exclude_unset=True)
+    if not update_data:
+        return current_user
+
+    await store.users.update_profile(str(current_user.id), update_data)
+    deps.invalidate_user(str(current_user.id))
+    updated_user = current_user.model_copy(update=update_data)
+
+    # Reflections carry a snapshot of the author's name; rewrite them after responding
+    if author_name(updated_user) != author_name(current_user):
+        background_tasks.add_task(store.reflections.rename_author, str(current_user.id), author_name(updated_user))
+    return updated_user
+
 @router.put("/me/settings", response_model=schemas.User, response_model_by_alias=False)
 async def update_user_settings(settings: schemas.UserSettings, current_user: schemas.User = Depends(deps.get_current_user)):
-    await db.users.update_one(
-        {"_id": ObjectId(current_user.id)},
-        {"$set": {"settings": settings.model_dump()}}
-    )
+    # settings.herds is the server-maintained herd index (see herd_index.py);
+    # clients send back whatever copy they last fetched, so never overwrite it
+    herds = current_user.settings.herds if current_user.settings else []
+    settings = settings.model_copy(update={"herds": herds})
+    await store.users.update_settings(str(current_user.id), settings.notificationCadence, settings.friends)
+    deps.invalidate_user(str(current_user.id))
     current_user.settings = settings
     return current_user
\ No newline at end of file
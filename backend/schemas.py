@@ -1,10 +1,16 @@
 from pydantic import BaseModel, EmailStr, Field, BeforeValidator, field_validator
-from typing import Optional, Annotated, Any, List
+from typing import Optional, Annotated, Any, List, Generic, TypeVar
 from datetime import datetime
 from bson import ObjectId
 
 PyObjectId = Annotated[str, BeforeValidator(str)]
 
+T = TypeVar("T")
+
+class Page(BaseModel, Generic[T]):
+    items: List[T]
+    next_cursor: Optional[str] = None
+
 class HerdMember(BaseModel):
     user_id: str
     email: EmailStr
@@ -21,12 +27,12 @@ class HerdCreate(HerdBase):
 class HerdUpdate(BaseModel):
     name: Optional[str] = None
     description: Optional[str] = None
-    members: Optional[List[HerdMember]] = None
 
 class Herd(HerdBase):
     id: Optional[PyObjectId] = Field(alias="_id", default=None)
     owner_id: str
-    members: List[HerdMember] = []
+    # Members live in the herd_memberships collection; see GET /herds/{id}/members
+    member_count: int = 0
     created_at: str
     updated_at: str
 
@@ -56,9 +62,15 @@ class UserBase(BaseModel):
 class UserCreate(UserBase):
     password: str
 
+class UserUpdate(BaseModel):
+    full_name: Optional[str] = None
+
 class User(UserBase):
     id: Optional[PyObjectId] = Field(alias="_id", default=None)
     is_active: bool = True
+    # Maintained by reflection_stats on every reflection create/delete
+    last_reflection_at: Optional[str] = None
+    reflection_streak: int = 0
 
     class Config:
         populate_by_name = True
@@ -76,7 +88,13 @@ class FriendAddRequest(BaseModel):
     email: EmailStr
 
 class ReactionRequest(BaseModel):
-    type: str = "curious"
+    # Used as a field name in reaction_counts, so no dots or "$"
+    type: str = Field("curious", pattern=r"^[A-Za-z0-9_-]{1,32}$")
+
+class ImageUploadResponse(BaseModel):
+    id: str
+    content_type: str
+    length: int
 
 class ReflectionBase(BaseModel):
     high: str
@@ -84,9 +102,8 @@ class ReflectionBase(BaseModel):
     buffalo: str
     sharedWith: list[str] = []
     sharedHerds: list[str] = []
-    image: Optional[str] = None
-    # Dictionary mapping ReactionType -> List of UserIDs
-    curiosityReactions: dict[str, list[str]] = {}
+    # SHA-256 id of an image uploaded through POST /images/
+    image_id: Optional[str] = None
     isFlaggedForFollowUp: Optional[bool] = False
 
 class ReflectionCreate(ReflectionBase):
@@ -98,14 +115,19 @@ class ReflectionUpdate(BaseModel):
     buffalo: Optional[str] = None
     sharedWith: Optional[list[str]] = None
     sharedHerds: Optional[list[str]] = None
-    image: Optional[str] = None
-    curiosityReactions: Optional[dict[str, list[str]]] = None
+    image_id: Optional[str] = None
     isFlaggedForFollowUp: Optional[bool] = None
 
 class Reflection(ReflectionBase):
     id: Optional[PyObjectId] = Field(alias="_id", default=None)
     user_id: str
     timestamp: str
+    # Snapshot of the author's display name, kept current by authors.py
+    author_name: Optional[str] = None
+    # Reaction type -> number of users; the reactions themselves live in the reactions collection
+    reaction_counts: dict[str, int] = {}
+    # Reaction types the requesting user has left (feed and react responses only)
+    my_reactions: list[str] = []
 
     class Config:
         populate_by_name = True
@@ -113,4 +135,4 @@ class Reflection(ReflectionBase):
         json_encoders = {ObjectId: str}
 
 class ReflectionFeedItem(Reflection):
-    author_name: str
\ No newline at end of file
+    thumbnail_url: Optional[str] = None
\ No newline at end of file
@@ -0,0 +1,111 @@
+"""
+Fast path for serializing list pages.
+
+When an endpoint returns plain documents, FastAPI validates every row
+against the response model (running the ObjectId ``BeforeValidator`` and
+``EmailStr`` checks per row) and then serializes the validated copy. List
+endpoints skip that for documents they read themselves:
+
+- ``projection(model)`` asks MongoDB for exactly the fields of a schema.
+  Whatever comes back under that projection was written by this API through
+  the same schemas, so it is trusted.
+- ``document(model, doc)`` reshapes a trusted document into the response
+  layout: fields in schema order, ``_id`` renamed to ``id``, ObjectIds as
+  strings and defaults for missing fields. No models are built.
+- ``page_response(model, docs, next_cursor)`` encodes the page with orjson
+  (pydantic-core when orjson is not installed) and returns the bytes as a
+  ``RawJSONResponse``.
+
+The output is byte-for-byte what the response model would produce (see
+test_serialization.py). Routes keep their ``response_model`` for the OpenAPI
+schema. Set VALIDATE_RESPONSES=true to validate pages through precompiled
+TypeAdapters instead, e.g. while changing a schema. Timings per schema:
+``python -m benchmarks.serialization``.
+"""
+import os
+import time
+from functools import lru_cache
+from typing import Any, Iterable, Optional
+
+from bson import ObjectId
+from fastapi import Response
+from pydantic import BaseModel, TypeAdapter
+from pydantic_core import to_json
+
+from metrics import record_serialization
+from schemas import Page, Reflection, ReflectionFeedItem, Herd, HerdMember
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+VALIDATE_RESPONSES = os.getenv("VALIDATE_RESPONSES", "false").lower() == "true"
+
+
+class RawJSONResponse(Response):
+    """
+    A response whose content is already encoded JSON.
+    """
+    media_type = "application/json"
+
+
+@lru_cache(maxsize=None)
+def page_adapter(model: type[BaseModel]) -> TypeAdapter:
+    return TypeAdapter(Page[model])
+
+
+@lru_cache(maxsize=None)
+def _layout(model: type[BaseModel]) -> tuple[tuple[str, str, Any], ...]:
+    # (field name, key in the stored document, default); "id" is stored as "_id".
+    # Defaults are only ever encoded, never handed out, so sharing them is safe.
+    return tuple(
+        (name, field.alias or name, None if field.is_required() else field.get_default(call_default_factory=True))
+        for name, field in model.model_fields.items()
+    )
+
+
+def projection(model: type[BaseModel], prefix: str = "") -> dict:
+    """
+    MongoDB projection selecting the stored fields of ``model``. Use
+    ``prefix`` for documents embedded under a key, e.g. "item." on timelines.
+    """
+    return {f"{prefix}{key}": 1 for _, key, _ in _layout(model)}
+
+
+def document(model: type[BaseModel], doc: dict) -> dict:
+    """
+    Reshapes a trusted document into what ``model`` would serialize to.
+    """
+    out = {}
+    for name, key, default in _layout(model):
+        value = doc.get(key, default)
+        out[name] = str(value) if isinstance(value, ObjectId) else value
+    return out
+
+
+def encode(content: Any) -> bytes:
+    if orjson is not None:
+        # default=str stringifies ObjectIds nested anywhere, like PyObjectId does
+        return orjson.dumps(content, default=str, option=orjson.OPT_UTC_Z)
+    return to_json(content, fallback=str)
+
+
+def page_response(
+    model: type[BaseModel], docs: Iterable[dict], next_cursor: Optional[str], headers: Optional[dict] = None
+) -> RawJSONResponse:
+    started = time.perf_counter()
+    if VALIDATE_RESPONSES:
+        adapter = page_adapter(model)
+        page = adapter.validate_python({"items": list(docs), "next_cursor": next_cursor})
+        body = adapter.dump_json(page, by_alias=False)
+    else:
+        body = encode({"items": [document(model, doc) for doc in docs], "next_cursor": next_cursor})
+    record_serialization(time.perf_counter() - started)
+    return RawJSONResponse(body, headers=headers)
+
+
+# Build the core schemas at import rather than on the first request
+for _model in (Reflection, ReflectionFeedItem, Herd, HerdMember):
+    page_adapter(_model)
+    _layout(_model)
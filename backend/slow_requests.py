@@ -0,0 +1,215 @@
+"""
+Slow-request log and on-demand profiles.
+
+``SlowRequestMiddleware`` writes one JSON log line (logger "slow_requests")
+for every request that takes longer than SLOW_REQUEST_MS:
+
+    {"route": "/api/v1/reflections/feed", "method": "GET", "status": 200,
+     "duration_ms": 812.4, "user_id": "...", "serialization_ms": 3.1,
+     "mongo_commands": 2, "mongo_ms": 790.2,
+     "commands": [["find", 788.9, true], ["find", 1.3, true]]}
+
+The route, user, commands and serialization time come from the request's
+metrics.RequestStats, so this middleware must run inside MetricsMiddleware.
+At most SLOW_REQUEST_LOGS_PER_SECOND lines are written per worker; the next
+line reports how many were suppressed.
+
+Admins can profile a single request by sending ``X-Profile: html`` (a
+flame-graph page) or ``X-Profile: speedscope`` (JSON for speedscope.app)
+together with their ``X-Admin-Token``. The request then runs under
+pyinstrument's sampling profiler and the profile is written to PROFILE_DIR,
+named in the ``X-Profile-File`` response header. Only the newest
+PROFILE_MAX_FILES profiles are kept, and a worker profiles one request at a
+time.
+
+With profiling off the cost per request is a header lookup and a clock
+read; ``python -m benchmarks.slow_requests`` measures it.
+"""
+import asyncio
+import json
+import logging
+import os
+import secrets
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+import deps
+from metrics import RequestStats, current_request
+
+try:
+    from pyinstrument import Profiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+except ImportError:
+    Profiler = None
+
+logger = logging.getLogger("slow_requests")
+
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", 500))
+SLOW_REQUEST_LOGS_PER_SECOND = float(os.getenv("SLOW_REQUEST_LOGS_PER_SECOND", 10))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "hlb-profiles"))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", 50))
+PROFILE_INTERVAL_SECONDS = float(os.getenv("PROFILE_INTERVAL_SECONDS", 0.001))
+
+PROFILE_FORMATS = {"html": ".html", "speedscope": ".speedscope.json"}
+# Long-lived by design; never slow
+STREAMING_CONTENT_TYPES = (b"text/event-stream",)
+
+
+class LogBudget:
+    """
+    Token bucket capping how many slow requests are logged per second.
+    """
+
+    def __init__(self, per_second: float):
+        self.per_second = per_second
+        self.tokens = per_second
+        self.suppressed = 0
+        self._updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.per_second, self.tokens + (now - self._updated) * self.per_second)
+        self._updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.suppressed += 1
+        return False
+
+
+def slow_request_record(
+    stats: RequestStats, method: str, status_code: int, duration: float, suppressed: int = 0
+) -> dict:
+    record = {
+        "route": stats.route,
+        "method": method,
+        "status": status_code,
+        "duration_ms": round(duration * 1000, 1),
+        "user_id": stats.user_id,
+        "serialization_ms": round(stats.serialization_seconds * 1000, 1),
+        "mongo_commands": stats.commands,
+        "mongo_ms": round(sum(seconds for _, seconds, _ in stats.command_log) * 1000, 1),
+        "commands": [[name, round(seconds * 1000, 1), ok] for name, seconds, ok in stats.command_log],
+    }
+    if suppressed:
+        record["suppressed_since_last"] = suppressed
+    return record
+
+
+def _header(scope, name: bytes) -> Optional[str]:
+    for key, value in scope.get("headers", ()):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def profile_format(scope) -> Optional[str]:
+    """
+    The profile format requested by an admin, or None.
+    """
+    requested = _header(scope, b"x-profile")
+    if requested is None:
+        return None
+    token = _header(scope, b"x-admin-token")
+    if not deps.ADMIN_TOKEN or not token or not secrets.compare_digest(token, deps.ADMIN_TOKEN):
+        return None
+    return requested if requested in PROFILE_FORMATS else None
+
+
+def _rotate(directory: str, keep: int):
+    profiles = sorted(
+        (entry for entry in os.scandir(directory) if entry.is_file()),
+        # Names start with a timestamp, which breaks mtime ties
+        key=lambda entry: (entry.stat().st_mtime_ns, entry.name),
+    )
+    for entry in profiles[:max(len(profiles) - keep, 0)]:
+        try:
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+class SlowRequestMiddleware:
+    def __init__(self, app, threshold_ms: float = SLOW_REQUEST_MS, profile_dir: str = PROFILE_DIR):
+        self.app = app
+        self.threshold = threshold_ms / 1000
+        self.profile_dir = profile_dir
+        self.budget = LogBudget(SLOW_REQUEST_LOGS_PER_SECOND)
+        self._profiling = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = current_request.get()
+        if stats is None:
+            # Not behind MetricsMiddleware; nothing to report from
+            await self.app(scope, receive, send)
+            return
+
+        status_code, streaming = 500, False
+        profile_path = self._profile_path(scope, stats)
+        profiler = None
+        if profile_path is not None:
+            profiler = Profiler(interval=PROFILE_INTERVAL_SECONDS, async_mode="enabled")
+            self._profiling = True
+
+        async def send_with_status(message):
+            nonlocal status_code, streaming
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                headers = message.get("headers", [])
+                streaming = any(
+                    key == b"content-type" and value.startswith(STREAMING_CONTENT_TYPES) for key, value in headers
+                )
+                if profile_path is not None:
+                    message = {**message, "headers": [*headers, (b"x-profile-file", os.path.basename(profile_path).encode())]}
+            await send(message)
+
+        started = time.perf_counter()
+        if profiler is not None:
+            profiler.start()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            duration = time.perf_counter() - started
+            if profiler is not None:
+                profiler.stop()
+                self._profiling = False
+                # Rendering takes a while on big profiles; keep it off the event loop
+                await asyncio.to_thread(self._write_profile, profiler, profile_path)
+            if duration >= self.threshold and not streaming and self.budget.take():
+                suppressed, self.budget.suppressed = self.budget.suppressed, 0
+                record = slow_request_record(stats, scope["method"], status_code, duration, suppressed)
+                logger.warning(json.dumps(record))
+
+    def _profile_path(self, scope, stats: RequestStats) -> Optional[str]:
+        format = profile_format(scope)
+        if format is None:
+            return None
+        if Profiler is None:
+            logger.warning("X-Profile ignored: pyinstrument is not installed")
+            return None
+        if self._profiling:
+            logger.warning("X-Profile ignored: this worker is already profiling a request")
+            return None
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        route = stats.route.strip("/").replace("/", "_").replace("{", "").replace("}", "") or "root"
+        name = f"{stamp}-{os.getpid()}-{scope['method']}-{route}{PROFILE_FORMATS[format]}"
+        return os.path.join(self.profile_dir, name)
+
+    def _write_profile(self, profiler, path: str):
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            if path.endswith(PROFILE_FORMATS["html"]):
+                content = profiler.output_html()
+            else:
+                content = profiler.output(renderer=SpeedscopeRenderer())
+            with open(path, "w") as f:
+                f.write(content)
+            _rotate(self.profile_dir, PROFILE_MAX_FILES)
+        except OSError:
+            logger.exception("Could not write profile %s", path)
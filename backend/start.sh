@@ -1,2 +1,4 @@
 #!/bin/bash
-gunicorn main:app --workers 4 --worker-class uvicorn.workers.UvicornWorker --bind 0.0.0.0:$PORT
\ No newline at end of file
+# Workers share their metrics through this directory (see metrics.py)
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/hlb-metrics}
+gunicorn main:app -c gunicorn.conf.py --workers 4 --worker-class uvicorn.workers.UvicornWorker --bind 0.0.0.0:$PORT
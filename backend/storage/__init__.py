@@ -0,0 +1,320 @@
+"""
+Repositories: the queries behind the API, one interface per aggregate, so
+routers never talk to Motor directly.
+
+- ``users``: accounts, settings, friends, and the version counters behind
+  ETags (see versions.py)
+- ``reflections``: reflections, the feed, reactions and flags
+- ``herds``: herds and their members
+- ``notifications``: reminder dispatch (see reminders.py)
+- ``image_variants``: which thumbnails of an image are ready (see
+  thumbnails.py)
+
+Engines, chosen with STORAGE:
+
+- ``mongo`` (default): Motor, in storage/mongo.py. Also keeps the
+  denormalized copies current: timelines, the herd index, reflection stats,
+  author snapshots and versions.
+- ``memory``: dicts in this process, in storage/memory.py. Same results and
+  errors, no server, so the whole API runs in-process for tests and
+  microbenchmarks. Nothing is shared between processes: run one worker,
+  with BLOB_STORE=local.
+
+Repositories raise ``NotFoundError``, ``ForbiddenError`` and
+``ConflictError``, which main.py turns into 404, 403 and 400 responses.
+Routers keep request validation and cache invalidation.
+
+Each Mongo repository method declares the round trips it may spend with
+``@round_trips(n)``. With ROUND_TRIP_BUDGETS=warn, calls that spend more
+are logged; with ``strict`` they raise ``RoundTripBudgetExceeded``, which
+is what tests and benchmarks should run with. Counting uses the request's
+metrics.RequestStats, so calls outside a request are not checked.
+"""
+import functools
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from metrics import current_request
+from pagination import PageParams
+from reminders import DispatchStats, EmailSender
+
+logger = logging.getLogger(__name__)
+
+STORAGE = os.getenv("STORAGE", "mongo")
+ROUND_TRIP_BUDGETS = os.getenv("ROUND_TRIP_BUDGETS", "off")
+
+Page = tuple[list[dict], Optional[str]]
+
+
+class StorageError(Exception):
+    status_code = 400
+
+    def __init__(self, detail: str):
+        super().__init__(detail)
+        self.detail = detail
+
+
+class NotFoundError(StorageError):
+    status_code = 404
+
+
+class ForbiddenError(StorageError):
+    status_code = 403
+
+
+class ConflictError(StorageError):
+    status_code = 400
+
+
+class RoundTripBudgetExceeded(RuntimeError):
+    pass
+
+
+def round_trips(budget: int):
+    """
+    Declares how many MongoDB commands a repository method may send on its
+    success path. Failing calls are not checked: telling a missing document
+    from a forbidden one costs an extra lookup.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            if ROUND_TRIP_BUDGETS == "off":
+                return await fn(*args, **kwargs)
+            stats = current_request.get()
+            if stats is None:
+                return await fn(*args, **kwargs)
+            before = stats.commands
+            result = await fn(*args, **kwargs)
+            spent = stats.commands - before
+            if spent > budget:
+                message = f"{fn.__qualname__} sent {spent} MongoDB commands, budget is {budget}"
+                if ROUND_TRIP_BUDGETS == "strict":
+                    raise RoundTripBudgetExceeded(message)
+                logger.warning(message)
+            return result
+        wrapper.round_trip_budget = budget
+        return wrapper
+    return decorator
+
+
+class UserRepository(ABC):
+    @abstractmethod
+    async def get_by_email(self, email: str) -> Optional[dict]:
+        """
+        The full user document, password hash included, or None.
+        """
+
+    @abstractmethod
+    async def email_taken(self, email: str) -> bool:
+        pass
+
+    @abstractmethod
+    async def create(self, user: dict) -> dict:
+        """
+        Inserts ``user`` and sets its ``_id``. Raises ConflictError when
+        the email is already registered.
+        """
+
+    @abstractmethod
+    async def replace_password_hash(self, user: dict, new_hash: str):
+        """
+        Swaps in a rehashed password, unless the hash changed meanwhile.
+        """
+
+    @abstractmethod
+    async def update_profile(self, user_id: str, fields: dict):
+        pass
+
+    @abstractmethod
+    async def update_settings(self, user_id: str, cadence: str, friends: list[str]):
+        """
+        Writes the user-editable settings. ``settings.herds`` is the
+        server-maintained herd index and is never written here.
+        """
+
+    @abstractmethod
+    async def add_friend(self, user_id: str, friend_id: str):
+        pass
+
+    @abstractmethod
+    async def remove_friend(self, user_id: str, friend_id: str):
+        pass
+
+    @abstractmethod
+    async def list_friends(self, friend_ids: list[str], page: PageParams) -> Page:
+        """
+        A page of the given users, newest first, without password hashes.
+        """
+
+    @abstractmethod
+    async def get_version(self, user_id: str, scope: str) -> int:
+        """
+        The user's versions.SCOPES counter for ``scope``.
+        """
+
+
+class ReflectionRepository(ABC):
+    @abstractmethod
+    async def feed(self, user_id: str, page: PageParams) -> Page:
+        """
+        A page of the user's feed, as feed items (see timelines.feed_item).
+        """
+
+    @abstractmethod
+    async def list_by_author(self, user_id: str, page: PageParams) -> Page:
+        pass
+
+    @abstractmethod
+    async def create(self, author, data: dict) -> dict:
+        """
+        Stores a new reflection by the ``author`` User, delivers it to the
+        feeds it is shared with and folds it into the author's stats.
+        """
+
+    @abstractmethod
+    async def update(self, user_id: str, reflection_id: str, data: dict) -> dict:
+        """
+        Applies ``data`` to one of the user's reflections and returns it.
+        Raises NotFoundError when the user has no such reflection.
+        """
+
+    @abstractmethod
+    async def delete(self, author, reflection_id: str) -> bool:
+        """
+        Deletes one of the ``author``'s reflections. Returns whether the
+        author's stats changed, i.e. whether their user document did.
+        """
+
+    @abstractmethod
+    async def toggle_reaction(self, user_id: str, herd_ids: list[str], reflection_id: str, type: str) -> dict:
+        """
+        Adds the user's reaction of ``type``, or removes it if present.
+        ``herd_ids`` are the user's herds, for the access check. Returns the
+        reflection with the user's ``my_reactions``.
+        """
+
+    @abstractmethod
+    async def toggle_flag(self, user_id: str, reflection_id: str) -> dict:
+        pass
+
+    @abstractmethod
+    async def shows_image(self, user_id: str, herd_ids: list[str], image_id: str) -> bool:
+        """
+        Whether a reflection the user may read has ``image_id``. ``herd_ids``
+        as for toggle_reaction.
+        """
+
+    @abstractmethod
+    async def rename_author(self, user_id: str, name: str) -> int:
+        """
+        Rewrites the author snapshot on the user's reflections (see
+        authors.py). Returns the number of reflections updated.
+        """
+
+
+class HerdRepository(ABC):
+    @abstractmethod
+    async def create(self, owner, data: dict) -> dict:
+        pass
+
+    @abstractmethod
+    async def list_by_ids(self, herd_ids: list[str], page: PageParams) -> Page:
+        pass
+
+    @abstractmethod
+    async def get(self, herd_id: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    async def list_members(self, herd_id: str, page: PageParams) -> Page:
+        pass
+
+    @abstractmethod
+    async def update(self, owner_id: str, herd_id: str, data: dict) -> dict:
+        pass
+
+    @abstractmethod
+    async def delete(self, owner_id: str, herd_id: str) -> list[str]:
+        """
+        Deletes the herd and returns the ids of its former members.
+        """
+
+    @abstractmethod
+    async def add_member(self, owner_id: str, herd_id: str, email: str) -> tuple[dict, str]:
+        """
+        Adds the user registered under ``email``. Returns the herd and the
+        new member's id.
+        """
+
+    @abstractmethod
+    async def remove_member(self, current_user_id: str, herd_id: str, user_id: str) -> dict:
+        """
+        Owners may remove anyone but themselves; members may leave.
+        """
+
+
+class NotificationRepository(ABC):
+    @abstractmethod
+    async def dispatch_reminders(self, sender: Optional[EmailSender] = None) -> DispatchStats:
+        pass
+
+
+class ImageVariantRepository(ABC):
+    @abstractmethod
+    async def is_ready(self, image_id: str) -> bool:
+        pass
+
+    @abstractmethod
+    async def get(self, image_id: str, size: str) -> Optional[dict[str, str]]:
+        """
+        ``{format: blob id}`` of a ready image's ``size`` variant, or None
+        while it is being rendered, failed or doesn't have that size.
+        """
+
+    @abstractmethod
+    async def mark_ready(self, image_id: str, variants: dict[str, dict[str, str]]):
+        pass
+
+    @abstractmethod
+    async def mark_failed(self, image_id: str):
+        pass
+
+
+class Storage:
+    """
+    The repositories of the configured engine. Routers hold on to the
+    module-level ``store``; ``configure`` swaps its engine in place.
+    """
+    users: UserRepository
+    reflections: ReflectionRepository
+    herds: HerdRepository
+    notifications: NotificationRepository
+    image_variants: ImageVariantRepository
+
+    def __init__(self, backend: str = STORAGE):
+        self.configure(backend)
+
+    def configure(self, backend: str):
+        if backend == "memory":
+            from storage.memory import MemoryEngine
+            engine = MemoryEngine()
+        elif backend == "mongo":
+            from storage.mongo import MongoEngine
+            engine = MongoEngine()
+        else:
+            raise ValueError(f"Unknown STORAGE backend: {backend}")
+        self.backend = backend
+        self.engine = engine
+        # None for the memory engine: there is nothing to migrate or watch
+        self.database = engine.database
+        self.users = engine.users
+        self.reflections = engine.reflections
+        self.herds = engine.herds
+        self.notifications = engine.notifications
+        self.image_variants = engine.image_variants
+
+
+store = Storage()
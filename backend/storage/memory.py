@@ -0,0 +1,594 @@
+"""
+In-memory engine for the repositories in storage/__init__.py.
+
+Keeps the same documents the Mongo engine does (users, reflections,
+reactions, herds, memberships, timelines, versions, reminder deliveries,
+image variants) in
+dicts, and maintains them the same way: the herd index on users, timeline
+entries per recipient, reflection stats and version bumps. Responses, ETags
+and errors therefore match what the API returns against MongoDB, minus the
+server.
+
+No method awaits in the middle of a change, so each one is atomic with
+respect to the others, like a transaction. Documents are copied on the way
+in and out; callers can't reach the stored ones.
+
+Timeline changes are published to feed_events.hub when it runs the local
+source, so live feed events work too.
+"""
+import asyncio
+import copy
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Optional
+
+from bson import ObjectId
+
+from pagination import PageParams, paginate
+from reflection_stats import affected_by_delete, day_start, streak_from_days
+from reminders import MESSAGES, DispatchStats, EmailSender, period_keys
+from schemas import HerdMember
+from storage import (
+    ConflictError,
+    ForbiddenError,
+    HerdRepository,
+    ImageVariantRepository,
+    NotFoundError,
+    NotificationRepository,
+    Page,
+    ReflectionRepository,
+    UserRepository,
+)
+from utils.email import get_sender
+import authors
+import feed_events
+import timelines
+
+logger = logging.getLogger(__name__)
+
+
+def _valid_user_ids(ids: Iterable[str]) -> set[str]:
+    return {i for i in ids if isinstance(i, str) and ObjectId.is_valid(i)}
+
+
+def _readable_by(reflection: dict, user_id: str, herd_ids: list[str]) -> bool:
+    return bool(
+        reflection["user_id"] == user_id
+        or user_id in reflection.get("sharedWith", [])
+        or set(herd_ids) & set(reflection.get("sharedHerds", []))
+    )
+
+
+class MemoryData:
+    """
+    The collections, shared by the repositories of one engine.
+    """
+
+    def __init__(self):
+        self.users: dict[ObjectId, dict] = {}
+        self.user_ids_by_email: dict[str, ObjectId] = {}
+        self.reflections: dict[ObjectId, dict] = {}
+        # (reflection_id, user_id, type) edges
+        self.reactions: set[tuple[ObjectId, str, str]] = set()
+        self.herds: dict[ObjectId, dict] = {}
+        # herd_id -> user_id -> membership
+        self.memberships: dict[str, dict[str, dict]] = defaultdict(dict)
+        # recipient_id -> reflection_id -> timeline entry
+        self.timelines: dict[str, dict[ObjectId, dict]] = defaultdict(dict)
+        self.versions: dict[str, dict[str, int]] = defaultdict(dict)
+        self.deliveries: set[str] = set()
+        # image_id -> {"status": ..., "variants": ...}
+        self.image_variants: dict[str, dict] = {}
+
+    def user(self, user_id: str) -> Optional[dict]:
+        return self.users.get(ObjectId(user_id)) if ObjectId.is_valid(user_id) else None
+
+    def settings(self, user: dict) -> dict:
+        if not user.get("settings"):
+            user["settings"] = {}
+        return user["settings"]
+
+    # versions.py
+
+    def bump(self, user_ids: Iterable[str], *scopes: str):
+        for user_id in {u for u in user_ids if u}:
+            for scope in scopes:
+                self.versions[user_id][scope] = self.versions[user_id].get(scope, 0) + 1
+
+    def bump_followers(self, user_ids: Iterable[str]):
+        user_ids = set(user_ids)
+        self.bump(
+            (str(u["_id"]) for u in self.users.values() if user_ids & set((u.get("settings") or {}).get("friends") or [])),
+            "friends",
+        )
+
+    # timelines.py
+
+    def _publish(self, change: dict):
+        if isinstance(feed_events.hub.source, feed_events.LocalSource):
+            feed_events.hub.publish(change)
+
+    def _upsert_entry(self, recipient_id: str, reflection: dict, my_reactions: Optional[list[str]] = None):
+        entries = self.timelines[recipient_id]
+        entry = entries.get(reflection["_id"])
+        if entry is None:
+            entry = entries[reflection["_id"]] = {"recipient_id": recipient_id, "reflection_id": reflection["_id"]}
+        entry["timestamp"] = reflection["timestamp"]
+        entry["item"] = copy.deepcopy(reflection)
+        if my_reactions is not None:
+            entry["my_reactions"] = my_reactions
+        self._publish({"operationType": "update", "fullDocument": copy.deepcopy(entry)})
+
+    def _delete_entry(self, recipient_id: str, reflection_id: ObjectId):
+        if self.timelines[recipient_id].pop(reflection_id, None) is not None:
+            self._publish({
+                "operationType": "delete",
+                "fullDocumentBeforeChange": {"recipient_id": recipient_id, "reflection_id": reflection_id},
+            })
+
+    def readers(self, reflection_id: ObjectId) -> set[str]:
+        return {recipient_id for recipient_id, entries in self.timelines.items() if reflection_id in entries}
+
+    def recipients(self, reflection: dict) -> set[str]:
+        recipients = _valid_user_ids(reflection.get("sharedWith", []))
+        for herd_id in reflection.get("sharedHerds", []):
+            recipients.update(self.memberships.get(herd_id, ()))
+        return recipients
+
+    def fan_out(self, reflection: dict):
+        recipients, previous = self.recipients(reflection), self.readers(reflection["_id"])
+        for recipient_id in previous - recipients:
+            self._delete_entry(recipient_id, reflection["_id"])
+        for recipient_id in recipients:
+            self._upsert_entry(recipient_id, reflection)
+        self.bump(recipients | previous, "feed")
+
+    def refresh(self, reflection: dict):
+        readers = self.readers(reflection["_id"])
+        for recipient_id in readers:
+            self._upsert_entry(recipient_id, reflection)
+        self.bump(readers, "feed")
+
+    def record_reaction(self, reflection: dict, user_id: str, reaction_type: str, added: bool):
+        readers = self.readers(reflection["_id"])
+        for recipient_id in readers:
+            my_reactions = None
+            if recipient_id == user_id:
+                mine = set(self.timelines[recipient_id][reflection["_id"]].get("my_reactions", []))
+                my_reactions = sorted(mine | {reaction_type} if added else mine - {reaction_type})
+            self._upsert_entry(recipient_id, reflection, my_reactions)
+        self.bump(readers, "feed")
+
+    def remove(self, reflection_id: ObjectId):
+        readers = self.readers(reflection_id)
+        for recipient_id in readers:
+            self._delete_entry(recipient_id, reflection_id)
+        self.bump(readers, "feed")
+
+    def grant_herd_access(self, herd_id: str, user_ids: Iterable[str]):
+        user_ids = _valid_user_ids(user_ids)
+        shared = [r for r in self.reflections.values() if herd_id in r.get("sharedHerds", [])]
+        for reflection in shared:
+            for user_id in user_ids:
+                self._upsert_entry(user_id, reflection)
+        if shared:
+            self.bump(user_ids, "feed")
+
+    def revoke_herd_access(self, herd_id: str, user_ids: Iterable[str]):
+        revoked_from = []
+        for user_id in _valid_user_ids(user_ids):
+            user = self.user(user_id)
+            remaining = set((user.get("settings") or {}).get("herds") or []) - {herd_id} if user else set()
+            revoked = [
+                reflection_id for reflection_id, entry in list(self.timelines[user_id].items())
+                if herd_id in entry["item"].get("sharedHerds", [])
+                and not remaining & set(entry["item"].get("sharedHerds", []))
+                and user_id not in entry["item"].get("sharedWith", [])
+            ]
+            for reflection_id in revoked:
+                self._delete_entry(user_id, reflection_id)
+            if revoked:
+                revoked_from.append(user_id)
+        self.bump(revoked_from, "feed")
+
+
+class MemoryUserRepository(UserRepository):
+    def __init__(self, data: MemoryData):
+        self.data = data
+
+    def _friends_changed(self, user_id: str):
+        self.data.bump([user_id], "friends")
+        self.data.bump_followers([user_id])
+
+    async def get_by_email(self, email: str) -> Optional[dict]:
+        user_id = self.data.user_ids_by_email.get(email)
+        return copy.deepcopy(self.data.users[user_id]) if user_id else None
+
+    async def email_taken(self, email: str) -> bool:
+        return email in self.data.user_ids_by_email
+
+    async def create(self, user: dict) -> dict:
+        if user["email"] in self.data.user_ids_by_email:
+            raise ConflictError("Email already registered")
+        user["_id"] = ObjectId()
+        self.data.users[user["_id"]] = copy.deepcopy(user)
+        self.data.user_ids_by_email[user["email"]] = user["_id"]
+        return user
+
+    async def replace_password_hash(self, user: dict, new_hash: str):
+        stored = self.data.users.get(user["_id"])
+        if stored and stored["hashed_password"] == user["hashed_password"]:
+            stored["hashed_password"] = new_hash
+
+    async def update_profile(self, user_id: str, fields: dict):
+        user = self.data.user(user_id)
+        if user is not None:
+            user.update(copy.deepcopy(fields))
+            self.data.bump_followers([user_id])
+
+    async def update_settings(self, user_id: str, cadence: str, friends: list[str]):
+        user = self.data.user(user_id)
+        if user is not None:
+            self.data.settings(user).update({"notificationCadence": cadence, "friends": list(friends)})
+            self._friends_changed(user_id)
+
+    async def add_friend(self, user_id: str, friend_id: str):
+        user = self.data.user(user_id)
+        if user is not None:
+            friends = self.data.settings(user).setdefault("friends", [])
+            if friend_id not in friends:
+                friends.append(friend_id)
+            self._friends_changed(user_id)
+
+    async def remove_friend(self, user_id: str, friend_id: str):
+        user = self.data.user(user_id)
+        if user is not None:
+            settings = self.data.settings(user)
+            settings["friends"] = [f for f in settings.get("friends", []) if f != friend_id]
+            self._friends_changed(user_id)
+
+    async def list_friends(self, friend_ids: list[str], page: PageParams) -> Page:
+        friends = (self.data.user(f) for f in set(friend_ids))
+        docs = [{k: v for k, v in f.items() if k != "hashed_password"} for f in friends if f is not None]
+        docs, next_cursor = paginate(docs, page, sort_field=None)
+        return copy.deepcopy(docs), next_cursor
+
+    async def get_version(self, user_id: str, scope: str) -> int:
+        return self.data.versions.get(user_id, {}).get(scope, 0)
+
+
+class MemoryReflectionRepository(ReflectionRepository):
+    def __init__(self, data: MemoryData):
+        self.data = data
+
+    def _owned(self, user_id: str, reflection_id: str) -> Optional[dict]:
+        reflection = self.data.reflections.get(ObjectId(reflection_id))
+        return reflection if reflection is not None and reflection["user_id"] == user_id else None
+
+    def _missing_or_forbidden(self, reflection_id: str, forbidden_detail: str) -> Exception:
+        if ObjectId(reflection_id) in self.data.reflections:
+            return ForbiddenError(forbidden_detail)
+        return NotFoundError("Reflection not found")
+
+    def _record_stats(self, user_id: str, timestamp: str):
+        # reflection_stats.record_reflection, without the pipeline
+        user = self.data.user(user_id)
+        if user is None:
+            return
+        created = datetime.fromisoformat(timestamp)
+        today = day_start(created).isoformat()
+        yesterday = (day_start(created) - timedelta(days=1)).isoformat()
+        last, streak = user.get("last_reflection_at"), user.get("reflection_streak") or 0
+        if last and last >= today:
+            user["reflection_streak"] = max(streak, 1)
+        elif last and last >= yesterday:
+            user["reflection_streak"] = streak + 1
+        else:
+            user["reflection_streak"] = 1
+        user["last_reflection_at"] = max(last, timestamp) if last else timestamp
+
+    def _recompute_stats(self, user_id: str):
+        user = self.data.user(user_id)
+        if user is None:
+            return
+        timestamps = [r["timestamp"] for r in self.data.reflections.values() if r["user_id"] == user_id]
+        user["last_reflection_at"] = max(timestamps) if timestamps else None
+        user["reflection_streak"] = streak_from_days(sorted({t[:10] for t in timestamps}, reverse=True))
+
+    async def feed(self, user_id: str, page: PageParams) -> Page:
+        entries, next_cursor = paginate(self.data.timelines.get(user_id, {}).values(), page, id_field="reflection_id")
+        return [timelines.feed_item(copy.deepcopy(entry)) for entry in entries], next_cursor
+
+    async def list_by_author(self, user_id: str, page: PageParams) -> Page:
+        docs, next_cursor = paginate((r for r in self.data.reflections.values() if r["user_id"] == user_id), page)
+        return copy.deepcopy(docs), next_cursor
+
+    async def create(self, author, data: dict) -> dict:
+        reflection = {
+            **copy.deepcopy(data),
+            "user_id": str(author.id),
+            "author_name": authors.author_name(author),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "_id": ObjectId(),
+        }
+        self.data.reflections[reflection["_id"]] = reflection
+        self.data.fan_out(reflection)
+        self._record_stats(reflection["user_id"], reflection["timestamp"])
+        self.data.bump_followers([reflection["user_id"]])
+        return copy.deepcopy(reflection)
+
+    async def update(self, user_id: str, reflection_id: str, data: dict) -> dict:
+        reflection = self._owned(user_id, reflection_id)
+        if reflection is None:
+            raise NotFoundError("Reflection not found")
+        reflection.update(copy.deepcopy(data))
+        if "sharedWith" in data or "sharedHerds" in data:
+            self.data.fan_out(reflection)
+        elif data:
+            self.data.refresh(reflection)
+        return copy.deepcopy(reflection)
+
+    async def delete(self, author, reflection_id: str) -> bool:
+        user_id = str(author.id)
+        reflection = self._owned(user_id, reflection_id)
+        if reflection is None:
+            raise NotFoundError("Reflection not found")
+        del self.data.reflections[reflection["_id"]]
+        self.data.remove(reflection["_id"])
+        self.data.reactions = {edge for edge in self.data.reactions if edge[0] != reflection["_id"]}
+        if not affected_by_delete(author.last_reflection_at, author.reflection_streak, reflection["timestamp"]):
+            return False
+        self._recompute_stats(user_id)
+        self.data.bump_followers([user_id])
+        return True
+
+    async def toggle_reaction(self, user_id: str, herd_ids: list[str], reflection_id: str, type: str) -> dict:
+        obj_id = ObjectId(reflection_id)
+        edge = (obj_id, user_id, type)
+        added = edge not in self.data.reactions
+        reflection = self.data.reflections.get(obj_id)
+        if reflection is None:
+            self.data.reactions.discard(edge)
+            raise NotFoundError("Reflection not found")
+        if added and not _readable_by(reflection, user_id, herd_ids):
+            raise ForbiddenError("Not authorized to view this reflection")
+
+        if added:
+            self.data.reactions.add(edge)
+        else:
+            self.data.reactions.discard(edge)
+        counts = reflection.setdefault("reaction_counts", {})
+        counts[type] = counts.get(type, 0) + (1 if added else -1)
+        self.data.record_reaction(reflection, user_id, type, added)
+        my_reactions = sorted(t for r, u, t in self.data.reactions if r == obj_id and u == user_id)
+        return {**copy.deepcopy(reflection), "my_reactions": my_reactions}
+
+    async def shows_image(self, user_id: str, herd_ids: list[str], image_id: str) -> bool:
+        return any(
+            r.get("image_id") == image_id and _readable_by(r, user_id, herd_ids)
+            for r in self.data.reflections.values()
+        )
+
+    async def toggle_flag(self, user_id: str, reflection_id: str) -> dict:
+        reflection = self._owned(user_id, reflection_id)
+        if reflection is None:
+            raise self._missing_or_forbidden(reflection_id, "Not authorized to flag this reflection")
+        reflection["isFlaggedForFollowUp"] = not reflection.get("isFlaggedForFollowUp", False)
+        self.data.refresh(reflection)
+        return copy.deepcopy(reflection)
+
+    async def rename_author(self, user_id: str, name: str) -> int:
+        renamed = [r for r in self.data.reflections.values() if r["user_id"] == user_id and r.get("author_name") != name]
+        for reflection in renamed:
+            reflection["author_name"] = name
+            self.data.refresh(reflection)
+        return len(renamed)
+
+
+class MemoryHerdRepository(HerdRepository):
+    def __init__(self, data: MemoryData):
+        self.data = data
+
+    def _members_changed(self, herd_id: str, user_ids: list[str]):
+        self.data.bump(self.data.memberships.get(herd_id, {}), "herds")
+        self.data.bump(user_ids, "herds")
+        self.data.bump_followers(user_ids)
+
+    def _owned(self, owner_id: str, herd_id: str, forbidden_detail: str) -> dict:
+        herd = self.data.herds.get(ObjectId(herd_id))
+        if herd is None:
+            raise NotFoundError("Herd not found")
+        if herd["owner_id"] != owner_id:
+            raise ForbiddenError(forbidden_detail)
+        return herd
+
+    def _add(self, herd_id: str, member: HerdMember):
+        self.data.memberships[herd_id][member.user_id] = {"_id": ObjectId(), "herd_id": herd_id, **member.model_dump()}
+        user = self.data.user(member.user_id)
+        if user is not None:
+            herds = self.data.settings(user).setdefault("herds", [])
+            if herd_id not in herds:
+                herds.append(herd_id)
+
+    def _remove(self, herd_id: str, user_ids: Iterable[str]):
+        for user_id in user_ids:
+            self.data.memberships[herd_id].pop(user_id, None)
+            user = self.data.user(user_id)
+            if user is not None:
+                settings = self.data.settings(user)
+                settings["herds"] = [h for h in settings.get("herds", []) if h != herd_id]
+        if not self.data.memberships[herd_id]:
+            del self.data.memberships[herd_id]
+
+    async def create(self, owner, data: dict) -> dict:
+        user_id = str(owner.id)
+        now = datetime.now(timezone.utc).isoformat()
+        herd = {
+            **copy.deepcopy(data),
+            "owner_id": user_id,
+            "member_count": 1,
+            "created_at": now,
+            "updated_at": now,
+            "_id": ObjectId(),
+        }
+        self.data.herds[herd["_id"]] = herd
+        herd_id = str(herd["_id"])
+        self._add(herd_id, HerdMember(user_id=user_id, email=owner.email, joined_at=datetime.now(timezone.utc), role="owner"))
+        self._members_changed(herd_id, [user_id])
+        return copy.deepcopy(herd)
+
+    async def list_by_ids(self, herd_ids: list[str], page: PageParams) -> Page:
+        herds = (self.data.herds.get(ObjectId(h)) for h in set(herd_ids) if ObjectId.is_valid(h))
+        docs, next_cursor = paginate((h for h in herds if h is not None), page, sort_field="created_at")
+        return copy.deepcopy(docs), next_cursor
+
+    async def get(self, herd_id: str) -> Optional[dict]:
+        return copy.deepcopy(self.data.herds.get(ObjectId(herd_id)))
+
+    async def list_members(self, herd_id: str, page: PageParams) -> Page:
+        docs, next_cursor = paginate(self.data.memberships.get(herd_id, {}).values(), page, sort_field=None)
+        return copy.deepcopy(docs), next_cursor
+
+    async def update(self, owner_id: str, herd_id: str, data: dict) -> dict:
+        herd = self._owned(owner_id, herd_id, "Only the owner can update the herd")
+        if data:
+            herd.update(copy.deepcopy(data), updated_at=datetime.now(timezone.utc).isoformat())
+            self.data.bump(self.data.memberships.get(herd_id, {}), "herds")
+        return copy.deepcopy(herd)
+
+    async def delete(self, owner_id: str, herd_id: str) -> list[str]:
+        herd = self._owned(owner_id, herd_id, "Only the owner can delete the herd")
+        del self.data.herds[herd["_id"]]
+        member_ids = list(self.data.memberships.get(herd_id, {}))
+        self._remove(herd_id, member_ids)
+        self.data.revoke_herd_access(herd_id, member_ids)
+        self._members_changed(herd_id, member_ids)
+        return member_ids
+
+    async def add_member(self, owner_id: str, herd_id: str, email: str) -> tuple[dict, str]:
+        user_id = self.data.user_ids_by_email.get(email)
+        if user_id is None:
+            raise NotFoundError("User with this email not found")
+        user_id = str(user_id)
+        herd = self._owned(owner_id, herd_id, "Only the owner can add members")
+        if user_id in self.data.memberships.get(herd_id, {}):
+            raise ConflictError("User is already a member of this herd")
+
+        herd["member_count"] += 1
+        herd["updated_at"] = datetime.now(timezone.utc).isoformat()
+        self._add(herd_id, HerdMember(user_id=user_id, email=email, joined_at=datetime.now(timezone.utc), role="member"))
+        self.data.grant_herd_access(herd_id, [user_id])
+        self._members_changed(herd_id, [user_id])
+        return copy.deepcopy(herd), user_id
+
+    async def remove_member(self, current_user_id: str, herd_id: str, user_id: str) -> dict:
+        herd = self.data.herds.get(ObjectId(herd_id))
+        if herd is None:
+            raise NotFoundError("Herd not found")
+        if not (herd["owner_id"] == current_user_id or user_id == current_user_id):
+            raise ForbiddenError("Not authorized to remove this member")
+        if user_id == herd["owner_id"]:
+            raise ConflictError("Owner cannot be removed. Delete the herd instead.")
+        if user_id not in self.data.memberships.get(herd_id, {}):
+            raise NotFoundError("Member not found in herd")
+
+        herd["member_count"] -= 1
+        herd["updated_at"] = datetime.now(timezone.utc).isoformat()
+        self._remove(herd_id, [user_id])
+        self.data.revoke_herd_access(herd_id, [user_id])
+        self._members_changed(herd_id, [user_id])
+        return copy.deepcopy(herd)
+
+
+class MemoryNotificationRepository(NotificationRepository):
+    def __init__(self, data: MemoryData):
+        self.data = data
+
+    def _due(self, now: datetime) -> list[dict]:
+        # reminders.due_users_pipeline, evaluated in Python
+        today_start = day_start(now).isoformat()
+        week_ago = (now - timedelta(days=7)).isoformat()
+        periods = period_keys(now)
+        due = []
+        for user in self.data.users.values():
+            cadence = (user.get("settings") or {}).get("notificationCadence", "daily")
+            if user.get("is_active") is False or cadence not in ("daily", "weekly"):
+                continue
+            last = user.get("last_reflection_at")
+            if last and last >= (today_start if cadence == "daily" else week_ago):
+                continue
+            key = f"{user['_id']}:{cadence}:{periods[cadence]}"
+            if key not in self.data.deliveries:
+                due.append({"email": user["email"], "user_id": str(user["_id"]), "cadence": cadence, "delivery_key": key})
+        return due
+
+    async def dispatch_reminders(self, sender: Optional[EmailSender] = None) -> DispatchStats:
+        own_sender = sender is None
+        sender = sender or get_sender()
+        stats = DispatchStats()
+        started = time.perf_counter()
+
+        async def deliver(user: dict):
+            key = user["delivery_key"]
+            if key in self.data.deliveries:
+                stats.skipped += 1
+                return
+            self.data.deliveries.add(key)
+            subject, body = MESSAGES[user["cadence"]]
+            try:
+                await sender.send(user["email"], subject, body)
+            except Exception as e:
+                logger.warning("Failed to send reminder to %s: %s", user["email"], e)
+                self.data.deliveries.discard(key)
+                stats.failed += 1
+                if len(stats.errors) < 10:
+                    stats.errors.append(f"{user['email']}: {e}")
+                return
+            stats.sent += 1
+
+        try:
+            due = self._due(datetime.now(timezone.utc))
+            stats.due = len(due)
+            await asyncio.gather(*(deliver(user) for user in due))
+        finally:
+            if own_sender:
+                await sender.close()
+        stats.seconds = round(time.perf_counter() - started, 3)
+        return stats
+
+
+class MemoryImageVariantRepository(ImageVariantRepository):
+    def __init__(self, data: MemoryData):
+        self.data = data
+
+    def _ready(self, image_id: str) -> Optional[dict]:
+        doc = self.data.image_variants.get(image_id)
+        return doc if doc and doc["status"] == "ready" else None
+
+    async def is_ready(self, image_id: str) -> bool:
+        return self._ready(image_id) is not None
+
+    async def get(self, image_id: str, size: str) -> Optional[dict[str, str]]:
+        formats = (self._ready(image_id) or {}).get("variants", {}).get(size)
+        return dict(formats) if formats else None
+
+    async def mark_ready(self, image_id: str, variants: dict[str, dict[str, str]]):
+        self.data.image_variants[image_id] = {"status": "ready", "variants": copy.deepcopy(variants)}
+
+    async def mark_failed(self, image_id: str):
+        doc = self.data.image_variants.setdefault(image_id, {})
+        doc["status"] = "failed"
+
+
+class MemoryEngine:
+    database = None
+
+    def __init__(self):
+        self.data = MemoryData()
+        self.users = MemoryUserRepository(self.data)
+        self.reflections = MemoryReflectionRepository(self.data)
+        self.herds = MemoryHerdRepository(self.data)
+        self.notifications = MemoryNotificationRepository(self.data)
+        self.image_variants = MemoryImageVariantRepository(self.data)
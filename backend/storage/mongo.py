@@ -0,0 +1,547 @@
+"""
+MongoDB engine for the repositories in storage/__init__.py.
+
+Writes keep the denormalized copies current after the write they cover:
+timelines (timelines.py), the reverse herd index (herd_index.py), reflection
+stats (reflection_stats.py) and the ETag versions (versions.py). Herd
+membership changes run in a transaction when the server supports them (see
+database.run_transaction).
+
+The budgets below are the worst success-path costs: sharing with herds
+costs a membership lookup, and transactions add a commit. test_round_trips.py
+checks the typical costs.
+"""
+import asyncio
+from datetime import datetime, timezone
+from typing import Optional
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from database import db, history_reads, request_session, run_transaction
+from pagination import PageParams, fetch_page
+from reminders import DispatchStats, EmailSender, dispatch_reminders
+from schemas import Herd, HerdMember, Reflection
+from serialization import projection
+from storage import (
+    ConflictError,
+    ForbiddenError,
+    HerdRepository,
+    ImageVariantRepository,
+    NotFoundError,
+    NotificationRepository,
+    Page,
+    ReflectionRepository,
+    UserRepository,
+    round_trips,
+)
+import authors
+import herd_index
+import reflection_stats
+import timelines
+import versions
+
+
+def readable_by(user_id: str, herd_ids: list[str]) -> dict:
+    """
+    Query clause matching reflections the user wrote or that are shared
+    with them directly or through one of ``herd_ids``.
+    """
+    return {"$or": [{"user_id": user_id}, {"sharedWith": user_id}, {"sharedHerds": {"$in": herd_ids}}]}
+
+
+async def raise_missing_or_forbidden(collection, obj_id: ObjectId, forbidden_detail: str, missing_detail: str):
+    """
+    Called after a conditional write matched nothing, to tell a missing
+    document apart from one the user may not touch. Only failing requests
+    pay for this extra round trip.
+    """
+    if await collection.count_documents({"_id": obj_id}, limit=1):
+        raise ForbiddenError(forbidden_detail)
+    raise NotFoundError(missing_detail)
+
+
+class MongoUserRepository(UserRepository):
+    def __init__(self, database):
+        self.db = database
+
+    async def friends_changed(self, user_id: str):
+        """
+        Bumps versions after the user's friend list changed: their own friend
+        listing, and the friend listings that include their user document.
+        """
+        await asyncio.gather(
+            versions.bump([user_id], "friends", database=self.db),
+            versions.bump_followers([user_id], database=self.db),
+        )
+
+    @round_trips(1)
+    async def get_by_email(self, email: str) -> Optional[dict]:
+        return await self.db.users.find_one({"email": email})
+
+    @round_trips(1)
+    async def email_taken(self, email: str) -> bool:
+        return await self.db.users.find_one({"email": email}, {"_id": 1}) is not None
+
+    @round_trips(1)
+    async def create(self, user: dict) -> dict:
+        # The unique email index catches signups that race past email_taken()
+        # insert_one sets user["_id"]; no need to read the document back
+        try:
+            await self.db.users.insert_one(user)
+        except DuplicateKeyError:
+            raise ConflictError("Email already registered")
+        return user
+
+    @round_trips(1)
+    async def replace_password_hash(self, user: dict, new_hash: str):
+        await self.db.users.update_one(
+            {"_id": user["_id"], "hashed_password": user["hashed_password"]},
+            {"$set": {"hashed_password": new_hash}},
+        )
+
+    @round_trips(2)
+    async def update_profile(self, user_id: str, fields: dict):
+        await self.db.users.update_one({"_id": ObjectId(user_id)}, {"$set": fields})
+        await versions.bump_followers([user_id], database=self.db)
+
+    @round_trips(3)
+    async def update_settings(self, user_id: str, cadence: str, friends: list[str]):
+        await self.db.users.update_one(
+            {"_id": ObjectId(user_id)},
+            {"$set": {"settings.notificationCadence": cadence, "settings.friends": friends}},
+        )
+        await self.friends_changed(user_id)
+
+    @round_trips(3)
+    async def add_friend(self, user_id: str, friend_id: str):
+        # $addToSet keeps the list unique
+        await self.db.users.update_one({"_id": ObjectId(user_id)}, {"$addToSet": {"settings.friends": friend_id}})
+        await self.friends_changed(user_id)
+
+    @round_trips(3)
+    async def remove_friend(self, user_id: str, friend_id: str):
+        await self.db.users.update_one({"_id": ObjectId(user_id)}, {"$pull": {"settings.friends": friend_id}})
+        await self.friends_changed(user_id)
+
+    @round_trips(1)
+    async def list_friends(self, friend_ids: list[str], page: PageParams) -> Page:
+        # Friends have no timestamp of their own, so pages are keyed on _id alone
+        return await fetch_page(
+            self.db.users,
+            {"_id": {"$in": [ObjectId(f) for f in friend_ids if ObjectId.is_valid(f)]}},
+            page,
+            sort_field=None,
+            projection={"hashed_password": 0},
+        )
+
+    @round_trips(1)
+    async def get_version(self, user_id: str, scope: str) -> int:
+        # Read first in the request's session, so a history read after it can't be older
+        return await versions.get_version(user_id, scope, database=self.db, session=await request_session())
+
+
+class MongoReflectionRepository(ReflectionRepository):
+    def __init__(self, database):
+        self.db = database
+
+    @round_trips(1)
+    async def feed(self, user_id: str, page: PageParams) -> Page:
+        # Read the precomputed timeline (see timelines.py) instead of scanning reflections.
+        # May be served by a secondary, in the session the ETag's version was read in
+        entries, next_cursor = await fetch_page(
+            history_reads(self.db.timelines),
+            {"recipient_id": user_id},
+            page,
+            id_field="reflection_id",
+            projection={**projection(Reflection, prefix="item."), "timestamp": 1, "reflection_id": 1, "my_reactions": 1},
+            session=await request_session(),
+        )
+        # Author names are snapshotted on the reflection (see authors.py): no user lookup
+        return [timelines.feed_item(entry) for entry in entries], next_cursor
+
+    @round_trips(1)
+    async def shows_image(self, user_id: str, herd_ids: list[str], image_id: str) -> bool:
+        return bool(await self.db.reflections.count_documents(
+            {"image_id": image_id, **readable_by(user_id, herd_ids)}, limit=1
+        ))
+
+    @round_trips(1)
+    async def list_by_author(self, user_id: str, page: PageParams) -> Page:
+        return await fetch_page(
+            history_reads(self.db.reflections),
+            {"user_id": user_id},
+            page,
+            projection=projection(Reflection),
+            session=await request_session(),
+        )
+
+    @round_trips(6)
+    async def create(self, author, data: dict) -> dict:
+        reflection = {
+            **data,
+            "user_id": str(author.id),
+            "author_name": authors.author_name(author),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+        }
+        # insert_one sets reflection["_id"]; no need to read the document back
+        await self.db.reflections.insert_one(reflection)
+        await timelines.fan_out_reflection(reflection, new=True)
+        await reflection_stats.record_reflection(reflection["user_id"], reflection["timestamp"], database=self.db)
+        # Friends see our stats in GET /users/friends
+        await versions.bump_followers([reflection["user_id"]], database=self.db)
+        return reflection
+
+    @round_trips(5)
+    async def update(self, user_id: str, reflection_id: str, data: dict) -> dict:
+        owned = {"_id": ObjectId(reflection_id), "user_id": user_id}
+        if data:
+            reflection = await self.db.reflections.find_one_and_update(
+                owned, {"$set": data}, return_document=ReturnDocument.AFTER
+            )
+        else:
+            reflection = await self.db.reflections.find_one(owned)
+        if reflection is None:
+            raise NotFoundError("Reflection not found")
+
+        # Sharing changes add or remove timeline entries; anything else just refreshes them
+        if "sharedWith" in data or "sharedHerds" in data:
+            await timelines.fan_out_reflection(reflection)
+        elif data:
+            await timelines.refresh_reflection(reflection)
+        return reflection
+
+    @round_trips(9)
+    async def delete(self, author, reflection_id: str) -> bool:
+        obj_id = ObjectId(reflection_id)
+        user_id = str(author.id)
+        reflection = await self.db.reflections.find_one_and_delete(
+            {"_id": obj_id, "user_id": user_id}, projection={"timestamp": 1}
+        )
+        if reflection is None:
+            raise NotFoundError("Reflection not found")
+
+        await timelines.remove_reflection(obj_id)
+        await self.db.reactions.delete_many({"reflection_id": obj_id})
+        if not reflection_stats.affected_by_delete(
+            author.last_reflection_at, author.reflection_streak, reflection["timestamp"]
+        ):
+            return False
+        await reflection_stats.recompute(user_id, database=self.db)
+        await versions.bump_followers([user_id], database=self.db)
+        return True
+
+    @round_trips(6)
+    async def toggle_reaction(self, user_id: str, herd_ids: list[str], reflection_id: str, type: str) -> dict:
+        obj_id = ObjectId(reflection_id)
+        edge = {"reflection_id": obj_id, "user_id": user_id, "type": type}
+
+        # Each reaction is an edge document; the unique index tells us which way
+        # the toggle goes without reading first
+        try:
+            await self.db.reactions.insert_one({**edge, "created_at": datetime.now(timezone.utc)})
+            added = True
+        except DuplicateKeyError:
+            await self.db.reactions.delete_one(edge)
+            added = False
+
+        # Adjust the counter; when adding, the access check (owner, direct share
+        # or herd share) is part of the filter
+        access = readable_by(user_id, herd_ids) if added else {}
+        reflection = await self.db.reflections.find_one_and_update(
+            {"_id": obj_id, **access},
+            {"$inc": {f"reaction_counts.{type}": 1 if added else -1}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if reflection is None:
+            if added:
+                await self.db.reactions.delete_one(edge)
+            await raise_missing_or_forbidden(
+                self.db.reflections, obj_id, "Not authorized to view this reflection", "Reflection not found"
+            )
+
+        _, my_reactions = await asyncio.gather(
+            timelines.record_reaction(reflection, user_id, type, added),
+            self.db.reactions.distinct("type", {"reflection_id": obj_id, "user_id": user_id}),
+        )
+        return {**reflection, "my_reactions": my_reactions}
+
+    @round_trips(3)
+    async def toggle_flag(self, user_id: str, reflection_id: str) -> dict:
+        obj_id = ObjectId(reflection_id)
+        # Only the author can flag their own reflection; the flip happens server-side
+        reflection = await self.db.reflections.find_one_and_update(
+            {"_id": obj_id, "user_id": user_id},
+            [{"$set": {"isFlaggedForFollowUp": {"$not": [{"$ifNull": ["$isFlaggedForFollowUp", False]}]}}}],
+            return_document=ReturnDocument.AFTER,
+        )
+        if reflection is None:
+            await raise_missing_or_forbidden(
+                self.db.reflections, obj_id, "Not authorized to flag this reflection", "Reflection not found"
+            )
+
+        await timelines.refresh_reflection(reflection)
+        return reflection
+
+    async def rename_author(self, user_id: str, name: str) -> int:
+        # Batched over the user's reflections; runs as a background task, so no budget
+        return await authors.propagate_author(user_id, name, database=self.db)
+
+
+def membership_doc(herd_id: str, member: HerdMember) -> dict:
+    return {"herd_id": herd_id, **member.model_dump()}
+
+
+class MongoHerdRepository(HerdRepository):
+    def __init__(self, database):
+        self.db = database
+
+    async def bump_members(self, herd_id: str):
+        """
+        Bumps the herds version of everyone currently in the herd, after a
+        change to the herd document itself.
+        """
+        await versions.bump_matching(self.db.herd_memberships, {"herd_id": herd_id}, "user_id", "herds", database=self.db)
+
+    async def members_changed(self, herd_id: str, user_ids: list[str]):
+        """
+        Bumps versions after ``user_ids`` joined or left the herd: the remaining
+        members see a new member_count, and the users' settings.herds changed,
+        which their friends see in GET /users/friends.
+        """
+        await asyncio.gather(
+            self.bump_members(herd_id),
+            versions.bump(user_ids, "herds", database=self.db),
+            versions.bump_followers(user_ids, database=self.db),
+        )
+
+    async def explain_failed_removal(self, obj_id: ObjectId, user_id: str, current_user_id: str):
+        herd = await self.db.herds.find_one({"_id": obj_id}, {"owner_id": 1})
+        if not herd:
+            raise NotFoundError("Herd not found")
+        if not (herd.get("owner_id") == current_user_id or user_id == current_user_id):
+            raise ForbiddenError("Not authorized to remove this member")
+        if user_id == herd.get("owner_id"):
+            raise ConflictError("Owner cannot be removed. Delete the herd instead.")
+        raise NotFoundError("Member not found in herd")
+
+    @round_trips(7)
+    async def create(self, owner, data: dict) -> dict:
+        user_id = str(owner.id)
+        owner_member = HerdMember(
+            user_id=user_id,
+            email=owner.email,
+            joined_at=datetime.now(timezone.utc),
+            role="owner",
+        )
+        now = datetime.now(timezone.utc).isoformat()
+        herd = {**data, "owner_id": user_id, "member_count": 1, "created_at": now, "updated_at": now}
+
+        # insert_one sets herd["_id"]; no need to read the document back
+        async def create(session):
+            await self.db.herds.insert_one(herd, session=session)
+            herd_id = str(herd["_id"])
+            await self.db.herd_memberships.insert_one(membership_doc(herd_id, owner_member), session=session)
+            await herd_index.add_herd(herd_id, [user_id], session=session, database=self.db)
+
+        await run_transaction(create)
+        await self.members_changed(str(herd["_id"]), [user_id])
+        return herd
+
+    @round_trips(1)
+    async def list_by_ids(self, herd_ids: list[str], page: PageParams) -> Page:
+        return await fetch_page(
+            self.db.herds,
+            {"_id": {"$in": [ObjectId(h) for h in herd_ids if ObjectId.is_valid(h)]}},
+            page,
+            sort_field="created_at",
+            projection=projection(Herd),
+        )
+
+    @round_trips(1)
+    async def get(self, herd_id: str) -> Optional[dict]:
+        return await self.db.herds.find_one({"_id": ObjectId(herd_id)})
+
+    @round_trips(1)
+    async def list_members(self, herd_id: str, page: PageParams) -> Page:
+        # Newest members first; served by the (herd_id, _id) index
+        return await fetch_page(
+            self.db.herd_memberships, {"herd_id": herd_id}, page, sort_field=None, projection=projection(HerdMember)
+        )
+
+    @round_trips(2)
+    async def update(self, owner_id: str, herd_id: str, data: dict) -> dict:
+        obj_id = ObjectId(herd_id)
+        # Only the owner can update details
+        owned = {"_id": obj_id, "owner_id": owner_id}
+        if data:
+            data = {**data, "updated_at": datetime.now(timezone.utc).isoformat()}
+            herd = await self.db.herds.find_one_and_update(owned, {"$set": data}, return_document=ReturnDocument.AFTER)
+        else:
+            herd = await self.db.herds.find_one(owned)
+        if herd is None:
+            await raise_missing_or_forbidden(self.db.herds, obj_id, "Only the owner can update the herd", "Herd not found")
+
+        if data:
+            await self.bump_members(herd_id)
+        return herd
+
+    @round_trips(10)
+    async def delete(self, owner_id: str, herd_id: str) -> list[str]:
+        obj_id = ObjectId(herd_id)
+
+        async def delete(session):
+            herd = await self.db.herds.find_one_and_delete(
+                {"_id": obj_id, "owner_id": owner_id}, projection={"_id": 1}, session=session
+            )
+            if herd is None:
+                return None
+            member_ids = await self.db.herd_memberships.distinct("user_id", {"herd_id": herd_id}, session=session)
+            await self.db.herd_memberships.delete_many({"herd_id": herd_id}, session=session)
+            await herd_index.remove_herd(herd_id, member_ids, session=session, database=self.db)
+            return member_ids
+
+        member_ids = await run_transaction(delete)
+        if member_ids is None:
+            await raise_missing_or_forbidden(self.db.herds, obj_id, "Only the owner can delete the herd", "Herd not found")
+
+        await timelines.revoke_herd_access(herd_id, member_ids)
+        await self.members_changed(herd_id, member_ids)
+        return member_ids
+
+    @round_trips(9)
+    async def add_member(self, owner_id: str, herd_id: str, email: str) -> tuple[dict, str]:
+        obj_id = ObjectId(herd_id)
+        user = await self.db.users.find_one({"email": email}, {"email": 1})
+        if not user:
+            raise NotFoundError("User with this email not found")
+
+        user_id = str(user["_id"])
+        new_member = HerdMember(
+            user_id=user_id,
+            email=user["email"],
+            joined_at=datetime.now(timezone.utc),
+            role="member",
+        )
+
+        # Only the owner can add (for now). The unique (herd_id, user_id) index
+        # rejects users who are already members.
+        async def add(session):
+            herd = await self.db.herds.find_one_and_update(
+                {"_id": obj_id, "owner_id": owner_id},
+                {"$inc": {"member_count": 1}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}},
+                return_document=ReturnDocument.AFTER,
+                session=session,
+            )
+            if herd is None:
+                return None
+            try:
+                await self.db.herd_memberships.insert_one(membership_doc(herd_id, new_member), session=session)
+            except DuplicateKeyError:
+                if session is None:
+                    # No transaction to roll back the count
+                    await self.db.herds.update_one({"_id": obj_id}, {"$inc": {"member_count": -1}})
+                raise ConflictError("User is already a member of this herd")
+            await herd_index.add_herd(herd_id, [user_id], session=session, database=self.db)
+            return herd
+
+        herd = await run_transaction(add)
+        if herd is None:
+            await raise_missing_or_forbidden(self.db.herds, obj_id, "Only the owner can add members", "Herd not found")
+
+        await timelines.grant_herd_access(herd_id, [user_id])
+        await self.members_changed(herd_id, [user_id])
+        return herd, user_id
+
+    @round_trips(9)
+    async def remove_member(self, current_user_id: str, herd_id: str, user_id: str) -> dict:
+        obj_id = ObjectId(herd_id)
+
+        # Permissions, folded into the filter:
+        # 1. Owner can remove anyone
+        # 2. User can remove themselves (leave)
+        # 3. Nobody can remove the owner (owner must delete herd or transfer ownership - transfer not implemented yet)
+        owner_id = {"$ne": user_id}
+        if user_id != current_user_id:
+            owner_id["$eq"] = current_user_id
+
+        async def remove(session):
+            herd = await self.db.herds.find_one_and_update(
+                {"_id": obj_id, "owner_id": owner_id},
+                {"$inc": {"member_count": -1}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}},
+                return_document=ReturnDocument.AFTER,
+                session=session,
+            )
+            if herd is None:
+                return None
+            result = await self.db.herd_memberships.delete_one({"herd_id": herd_id, "user_id": user_id}, session=session)
+            if result.deleted_count == 0:
+                if session is None:
+                    await self.db.herds.update_one({"_id": obj_id}, {"$inc": {"member_count": 1}})
+                raise NotFoundError("Member not found in herd")
+            await herd_index.remove_herd(herd_id, [user_id], session=session, database=self.db)
+            return herd
+
+        herd = await run_transaction(remove)
+        if herd is None:
+            await self.explain_failed_removal(obj_id, user_id, current_user_id)
+
+        await timelines.revoke_herd_access(herd_id, [user_id])
+        await self.members_changed(herd_id, [user_id])
+        return herd
+
+
+class MongoNotificationRepository(NotificationRepository):
+    def __init__(self, database):
+        self.db = database
+
+    async def dispatch_reminders(self, sender: Optional[EmailSender] = None) -> DispatchStats:
+        # One streamed aggregation plus a claim per due user; scales with the users due
+        return await dispatch_reminders(self.db, sender)
+
+
+class MongoImageVariantRepository(ImageVariantRepository):
+    """
+    One ``image_variants`` document per image:
+
+        {"_id": <image id>, "status": "ready", "variants": {"md": {"webp": <blob id>, "jpeg": <blob id>}}}
+    """
+
+    def __init__(self, database):
+        self.db = database
+
+    @round_trips(1)
+    async def is_ready(self, image_id: str) -> bool:
+        return await self.db.image_variants.find_one({"_id": image_id, "status": "ready"}, {"_id": 1}) is not None
+
+    @round_trips(1)
+    async def get(self, image_id: str, size: str) -> Optional[dict[str, str]]:
+        doc = await self.db.image_variants.find_one({"_id": image_id, "status": "ready"}, {f"variants.{size}": 1})
+        return (doc or {}).get("variants", {}).get(size)
+
+    @round_trips(1)
+    async def mark_ready(self, image_id: str, variants: dict[str, dict[str, str]]):
+        await self.db.image_variants.update_one(
+            {"_id": image_id},
+            {"$set": {"status": "ready", "variants": variants, "updated_at": datetime.now(timezone.utc).isoformat()}},
+            upsert=True,
+        )
+
+    @round_trips(1)
+    async def mark_failed(self, image_id: str):
+        await self.db.image_variants.update_one(
+            {"_id": image_id},
+            {"$set": {"status": "failed", "updated_at": datetime.now(timezone.utc).isoformat()}},
+            upsert=True,
+        )
+
+
+class MongoEngine:
+    def __init__(self, database=db):
+        self.database = database
+        self.users = MongoUserRepository(database)
+        self.reflections = MongoReflectionRepository(database)
+        self.herds = MongoHerdRepository(database)
+        self.notifications = MongoNotificationRepository(database)
+        self.image_variants = MongoImageVariantRepository(database)
@@ -0,0 +1,120 @@
+"""
+Token buckets, their cross-worker backend, and the 429/503 answers of
+AdmissionMiddleware. Run with:
+
+    python -m pytest test_admission.py
+"""
+import asyncio
+
+import httpx
+from fastapi import FastAPI
+
+import admission
+from admission import AdmissionMiddleware, Limiter, MemoryBuckets, SharedBuckets
+from security import create_access_token
+
+
+def test_bucket_allows_a_burst_then_refills():
+    buckets = MemoryBuckets()
+    assert [buckets.take("k", rate=1, burst=3, now=0) for _ in range(3)] == [0, 0, 0]
+    assert buckets.take("k", rate=1, burst=3, now=0) == 1.0
+    assert buckets.take("k", rate=1, burst=3, now=0.5) == 0.5
+    assert buckets.take("k", rate=1, burst=3, now=1.5) == 0
+    # Other keys have buckets of their own
+    assert buckets.take("other", rate=1, burst=3, now=1.5) == 0
+
+
+def test_shared_buckets_are_shared_between_processes(tmp_path):
+    # Two mappings of one file stand in for two gunicorn workers
+    path = str(tmp_path / "admission")
+    first, second = SharedBuckets(path, slots=64), SharedBuckets(path, slots=64)
+    try:
+        assert first.take("k", rate=1, burst=2, now=0) == 0
+        assert second.take("k", rate=1, burst=2, now=0) == 0
+        assert first.take("k", rate=1, burst=2, now=0) == 1.0
+        assert second.take("k", rate=1, burst=2, now=1) == 0
+    finally:
+        first.close()
+        second.close()
+
+
+def test_colliding_clients_never_get_a_fresh_bucket(tmp_path):
+    # One group of slots: a fifth client has to take over someone's slot
+    buckets = SharedBuckets(str(tmp_path / "admission"), slots=SharedBuckets.WAYS)
+    try:
+        clients = [f"client-{i}" for i in range(SharedBuckets.WAYS + 1)]
+        for client in clients[:-1]:
+            assert buckets.take(client, rate=1, burst=2, now=0) == 0
+            assert buckets.take(client, rate=1, burst=2, now=0) == 0
+        # Each slot is spent; the newcomer inherits an empty bucket
+        assert buckets.take(clients[-1], rate=1, burst=2, now=0) == 1.0
+        # Alternating between colliding keys doesn't mint tokens either
+        assert [buckets.take(client, rate=1, burst=2, now=0) for client in clients] == [1.0] * len(clients)
+        # Owners keep their buckets while the group has room
+        roomy = SharedBuckets(str(tmp_path / "roomy"), slots=SharedBuckets.WAYS)
+        try:
+            assert roomy.take("a", rate=1, burst=1, now=0) == 0
+            assert roomy.take("b", rate=1, burst=1, now=0) == 0
+            assert roomy.take("a", rate=1, burst=1, now=0) == 1.0
+        finally:
+            roomy.close()
+    finally:
+        buckets.close()
+
+
+def _app(limiter: Limiter) -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(AdmissionMiddleware, limiter=limiter)
+    release = asyncio.Event()
+
+    @app.get("/api/v1/reflections/feed")
+    async def feed():
+        return {}
+
+    @app.get("/api/v1/slow")
+    async def slow():
+        await release.wait()
+        return {}
+
+    @app.get("/healthz")
+    async def healthz():
+        return {}
+
+    app.state.release = release
+    return app
+
+
+def test_rate_limits_are_per_user_and_route(monkeypatch):
+    monkeypatch.setitem(admission.ROUTE_BUDGETS, "/api/v1/reflections/feed", (0.5, 2))
+    app = _app(Limiter("memory"))
+    alice = {"Authorization": f"Bearer {create_access_token({'sub': 'alice@example.com'})}"}
+    bob = {"Authorization": f"Bearer {create_access_token({'sub': 'bob@example.com'})}"}
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            statuses = [(await client.get("/api/v1/reflections/feed", headers=alice)).status_code for _ in range(3)]
+            assert statuses == [200, 200, 429]
+            rejected = await client.get("/api/v1/reflections/feed", headers=alice)
+            assert rejected.headers["retry-after"] == "2"
+            assert (await client.get("/api/v1/reflections/feed", headers=bob)).status_code == 200
+            assert (await client.get("/healthz", headers=alice)).status_code == 200
+
+    asyncio.run(scenario())
+
+
+def test_sheds_load_beyond_the_concurrency_cap():
+    app = _app(Limiter("off", max_in_flight=2))
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            held = [asyncio.create_task(client.get("/api/v1/slow")) for _ in range(2)]
+            await asyncio.sleep(0.05)
+            shed = await client.get("/api/v1/slow")
+            assert shed.status_code == 503 and shed.headers["retry-after"] == "1"
+            app.state.release.set()
+            assert [r.status_code for r in await asyncio.gather(*held)] == [200, 200]
+            assert (await client.get("/api/v1/reflections/feed")).status_code == 200
+
+    asyncio.run(scenario())
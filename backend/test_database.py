@@ -0,0 +1,70 @@
+"""
+Connection pool accounting behind GET /healthz, and the request-scoped
+sessions for history reads. No MongoDB needed. Run with:
+
+    python -m pytest test_database.py
+"""
+import asyncio
+from types import SimpleNamespace
+
+import database
+from database import PoolMonitor, request_session
+
+
+def test_pool_monitor_tracks_checkouts_per_server():
+    monitor = PoolMonitor()
+    a, b = SimpleNamespace(address=("a", 27017)), SimpleNamespace(address=("b", 27017))
+    for _ in range(3):
+        monitor.connection_created(a)
+    monitor.connection_created(b)
+    monitor.connection_check_out_started(a)
+    monitor.connection_checked_out(a)
+    monitor.connection_check_out_started(a)
+    monitor.connection_checked_out(a)
+    monitor.connection_check_out_started(a)
+
+    snapshot = monitor.snapshot()
+    assert snapshot["a:27017"]["open"] == 3 and snapshot["a:27017"]["checked_out"] == 2
+    assert snapshot["a:27017"]["waiting"] == 1
+    assert snapshot["a:27017"]["saturation"] == round(2 / database.MONGODB_MAX_POOL_SIZE, 3)
+    assert snapshot["b:27017"]["checked_out"] == 0
+
+    monitor.connection_checked_in(a)
+    monitor.connection_check_out_failed(a)
+    assert monitor.snapshot()["a:27017"]["checked_out"] == 1 and monitor.snapshot()["a:27017"]["waiting"] == 0
+    monitor.pool_closed(a)
+    assert list(monitor.snapshot()) == ["b:27017"]
+
+
+def test_no_session_outside_a_request():
+    assert asyncio.run(request_session()) is None
+
+
+def test_history_reads_use_their_read_preference():
+    connection = database.Mongo("mongodb://127.0.0.1:1")
+    try:
+        timelines = database.history_reads(connection.database.timelines)
+        assert timelines.read_preference == database.HISTORY_READ_PREFERENCE
+        # Everything else stays on the primary
+        assert connection.database.timelines.read_preference.mode == 0
+    finally:
+        connection.close()
+
+
+def test_health_reports_an_unreachable_server():
+    connection = database.Mongo("mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=100")
+
+    async def check():
+        try:
+            return await connection.health()
+        finally:
+            connection.close()
+
+    health = asyncio.run(check())
+    assert health["ok"] is False and health["ping_ms"] is None and health["error"]
+    assert health["max_pool_size"] == database.MONGODB_MAX_POOL_SIZE
+
+
+def test_unavailable_compressors_are_left_out(monkeypatch):
+    monkeypatch.setattr(database, "validate_compressors", lambda option, names: ["zlib"])
+    assert database.available_compressors("zstd,zlib") == ["zlib"]
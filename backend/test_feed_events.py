@@ -0,0 +1,129 @@
+"""
+Live feed events on the in-process source: routing, replay on reconnect and
+back-pressure. Run with:
+
+    python -m pytest test_feed_events.py
+"""
+import asyncio
+import json
+
+from bson import ObjectId
+
+from feed_events import FeedEventHub
+
+
+def _change(recipient_id: str, high: str = "h", operation: str = "insert") -> dict:
+    reflection_id = ObjectId()
+    if operation == "delete":
+        return {"operationType": "delete", "fullDocumentBeforeChange": {
+            "recipient_id": recipient_id, "reflection_id": reflection_id,
+        }}
+    return {"operationType": operation, "fullDocument": {
+        "recipient_id": recipient_id,
+        "item": {
+            "_id": reflection_id, "user_id": "author", "author_name": "Author",
+            "high": high, "low": "l", "buffalo": "b", "timestamp": "2026-01-01T00:00:00+00:00",
+        },
+        "my_reactions": [],
+    }}
+
+
+def _parse(chunk: bytes) -> tuple[str, str, dict]:
+    fields = dict(line.split(": ", 1) for line in chunk.decode().strip().split("\n"))
+    return fields["id"], fields["event"], json.loads(fields["data"])
+
+
+async def _started_hub(**options) -> FeedEventHub:
+    hub = FeedEventHub(backend="local", **options)
+    await hub.start()
+    return hub
+
+
+def test_events_reach_only_their_recipient():
+    async def run():
+        hub = await _started_hub()
+        stream = hub.stream("alice")
+        assert await anext(stream) == b"retry: 5000\n\n"
+        hub.publish(_change("bob"))
+        hub.publish(_change("alice", high="for alice"))
+        event_id, event, data = _parse(await anext(stream))
+        assert (event_id, event) == ("2", "upsert")
+        assert data["item"]["high"] == "for alice" and data["item"]["my_reactions"] == []
+        assert isinstance(data["item"]["id"], str)
+
+        hub.publish(_change("alice", operation="delete"))
+        assert _parse(await anext(stream))[1] == "remove"
+        await stream.aclose()
+        assert hub.stats()["streams"] == 0
+
+    asyncio.run(run())
+
+
+def test_reconnect_replays_missed_events_once():
+    async def run():
+        hub = await _started_hub()
+        for high in ("one", "two", "three"):
+            hub.publish(_change("alice", high=high))
+        hub.publish(_change("bob"))
+
+        stream = hub.stream("alice", last_event_id="1")
+        await anext(stream)
+        # Published after subscribing but before the replay: in the log and the queue
+        hub.publish(_change("alice", high="four"))
+        hub.publish(_change("alice", high="five"))
+        received = [_parse(await anext(stream)) for _ in range(4)]
+        assert [data["item"]["high"] for _, _, data in received] == ["two", "three", "four", "five"]
+        assert hub.stats()["delivered"] == 2
+        hub.publish(_change("alice", high="six"))
+        assert _parse(await anext(stream))[2]["item"]["high"] == "six"
+        await stream.aclose()
+
+    asyncio.run(run())
+
+
+def test_unknown_resume_position_asks_for_a_reload():
+    async def run():
+        hub = await _started_hub()
+        hub.publish(_change("alice"))
+        for last_event_id in ("not-a-number", "99"):
+            stream = hub.stream("alice", last_event_id=last_event_id)
+            await anext(stream)
+            event_id, event, _ = _parse(await anext(stream))
+            assert (event_id, event) == ("1", "reset")
+            await stream.aclose()
+
+    asyncio.run(run())
+
+
+def test_slow_client_gets_a_reset_instead_of_a_backlog():
+    async def run():
+        hub = await _started_hub(queue_size=3)
+        stream = hub.stream("alice")
+        await anext(stream)
+        for _ in range(10):
+            hub.publish(_change("alice"))
+        # Only the reset is left, carrying the id of the newest event, so a
+        # reconnect resumes after everything that was dropped
+        assert _parse(await anext(stream))[:2] == ("10", "reset")
+        assert hub.stats()["overflows"] == 3
+        await stream.aclose()
+
+    asyncio.run(run())
+
+
+def test_oldest_stream_is_closed_past_the_per_user_limit():
+    async def run():
+        hub = await _started_hub(max_streams_per_user=2)
+        streams = [hub.stream("alice") for _ in range(3)]
+        for stream in streams:
+            await anext(stream)
+        assert hub.stats()["streams"] == 2
+        try:
+            await anext(streams[0])
+            assert False, "oldest stream should have ended"
+        except StopAsyncIteration:
+            pass
+        for stream in streams[1:]:
+            await stream.aclose()
+
+    asyncio.run(run())
@@ -0,0 +1,145 @@
+"""
+Multi-worker harness for the cache invalidation bus.
+
+Starts several worker processes that each run a UnixSocketTransport bus,
+publishes invalidations from this process and checks that every worker
+evicts the entry within MAX_EVICTION_DELAY. Run with:
+
+    python -m pytest test_invalidation.py
+"""
+import asyncio
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+
+from invalidation import InvalidationBus
+
+WORKERS = 4
+MAX_EVICTION_DELAY = 0.5
+
+
+def _worker(socket_dir: str, results, ready, stop):
+    async def run():
+        bus = InvalidationBus(backend="unix", socket_dir=socket_dir)
+        cache = {"user-1": "cached", "user-2": "cached"}
+
+        def evict(user_id):
+            cache.pop(user_id, None)
+            results.put((os.getpid(), user_id, time.time()))
+
+        bus.subscribe("users", evict)
+        await bus.start()
+        ready.set()
+        while not stop.is_set():
+            await asyncio.sleep(0.01)
+        results.put((os.getpid(), "stats", bus.stats()))
+        await bus.stop()
+
+    asyncio.run(run())
+
+
+def _start_workers(socket_dir: str):
+    ctx = multiprocessing.get_context("spawn")
+    results, stop = ctx.Queue(), ctx.Event()
+    workers = []
+    for _ in range(WORKERS):
+        ready = ctx.Event()
+        process = ctx.Process(target=_worker, args=(socket_dir, results, ready, stop), daemon=True)
+        process.start()
+        workers.append((process, ready))
+    for _, ready in workers:
+        assert ready.wait(30), "worker did not start"
+    return [p for p, _ in workers], results, stop
+
+
+def _collect(results, expected: int, timeout: float) -> list:
+    received = []
+    deadline = time.time() + timeout
+    while len(received) < expected and time.time() < deadline:
+        try:
+            received.append(results.get(timeout=max(deadline - time.time(), 0.01)))
+        except Exception:
+            break
+    return received
+
+
+def test_publish_evicts_in_every_worker():
+    with tempfile.TemporaryDirectory() as socket_dir:
+        processes, results, stop = _start_workers(socket_dir)
+        try:
+            async def publish():
+                bus = InvalidationBus(backend="unix", socket_dir=socket_dir)
+                await bus.start()
+                sent_at = time.time()
+                bus.publish("users", "user-1")
+                bus.publish("herds", "herd-1")  # nobody subscribed: must be ignored
+                await bus.stop()
+                return sent_at
+
+            sent_at = asyncio.run(publish())
+            received = _collect(results, WORKERS, timeout=5)
+
+            assert sorted(pid for pid, _, _ in received) == sorted(p.pid for p in processes)
+            assert all(user_id == "user-1" for _, user_id, _ in received)
+            assert max(at for _, _, at in received) - sent_at < MAX_EVICTION_DELAY
+        finally:
+            stop.set()
+            stats = _collect(results, WORKERS, timeout=5)
+            for process in processes:
+                process.join(5)
+
+        assert len(stats) == WORKERS
+        for _, _, worker_stats in stats:
+            assert worker_stats["received"] == 2  # the users and the herds message
+            assert worker_stats["lag_max_seconds"] < MAX_EVICTION_DELAY
+        # Workers remove their sockets on shutdown
+        assert not [f for f in os.listdir(socket_dir) if f.endswith(".sock")]
+
+
+def test_stale_sockets_are_pruned():
+    with tempfile.TemporaryDirectory() as socket_dir:
+        async def run():
+            # A socket file left behind by a worker that crashed
+            stale_path = os.path.join(socket_dir, "worker-999999.sock")
+            stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            stale.bind(stale_path)
+            stale.close()
+
+            bus = InvalidationBus(backend="unix", socket_dir=socket_dir)
+            await bus.start()
+            bus.publish("users", "user-1")
+            await bus.stop()
+            return os.path.exists(stale_path)
+
+        assert asyncio.run(run()) is False
+
+
+def test_lag_is_exported_as_metrics():
+    from prometheus_client import REGISTRY
+
+    import metrics
+
+    def received() -> float:
+        return REGISTRY.get_sample_value("invalidation_lag_seconds_count", {"collection": "herds"}) or 0.0
+
+    with tempfile.TemporaryDirectory() as socket_dir:
+        async def run():
+            sender = InvalidationBus(backend="unix", socket_dir=socket_dir)
+            receiver = InvalidationBus(backend="unix", socket_dir=socket_dir)
+            evicted = asyncio.Event()
+            receiver.subscribe("herds", lambda herd_id: evicted.set())
+            await receiver.start()
+            # Both buses live in this process: move the first socket out of the second's way
+            os.rename(receiver.transport.path, os.path.join(socket_dir, "worker-receiver.sock"))
+            await sender.start()
+            sender.publish("herds", "herd-1")
+            await asyncio.wait_for(evicted.wait(), MAX_EVICTION_DELAY)
+            await sender.stop()
+            await receiver.stop()
+
+        before = received()
+        asyncio.run(run())
+        assert received() == before + 1
+        assert b"invalidation_lag_seconds_bucket" in metrics.render()[0]
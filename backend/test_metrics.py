@@ -0,0 +1,104 @@
+"""
+Request metrics: route templates as labels, status and in-flight tracking,
+and MongoDB commands attributed to the request that sent them. Run with:
+
+    python -m pytest test_metrics.py
+"""
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+from fastapi import FastAPI, HTTPException
+from prometheus_client import REGISTRY
+
+import metrics
+from cache import TTLCache
+
+
+def _sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def _app() -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(metrics.MetricsMiddleware)
+
+    @app.get("/items/{item_id}")
+    async def read_item(item_id: str):
+        # Stands in for MongoDB commands issued while handling the request
+        in_flight = _sample("http_requests_in_flight", method="GET", route="/items/{item_id}")
+        for _ in range(3):
+            metrics.command_metrics.started(SimpleNamespace(command_name="find"))
+            metrics.command_metrics.succeeded(
+                SimpleNamespace(command_name="find", duration_micros=1500, reply={"cursor": {"firstBatch": []}})
+            )
+        if item_id == "missing":
+            raise HTTPException(status_code=404)
+        return {"in_flight": in_flight}
+
+    return app
+
+
+async def _get(app: FastAPI, path: str) -> httpx.Response:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.get(path)
+
+
+def test_requests_are_labelled_by_route_template():
+    app = _app()
+    route = "/items/{item_id}"
+    before_ok = _sample("http_requests_total", method="GET", route=route, status="200")
+    before_missing = _sample("http_requests_total", method="GET", route=route, status="404")
+    before_count = _sample("http_request_duration_seconds_count", method="GET", route=route)
+
+    response = asyncio.run(_get(app, "/items/1"))
+    assert response.json()["in_flight"] >= 1
+    asyncio.run(_get(app, "/items/missing"))
+    asyncio.run(_get(app, "/nowhere"))
+
+    assert _sample("http_requests_total", method="GET", route=route, status="200") == before_ok + 1
+    assert _sample("http_requests_total", method="GET", route=route, status="404") == before_missing + 1
+    assert _sample("http_request_duration_seconds_count", method="GET", route=route) == before_count + 2
+    assert _sample("http_requests_total", method="GET", route=metrics.UNMATCHED_ROUTE, status="404") >= 1
+    assert _sample("http_requests_in_flight", method="GET", route=route) == 0
+
+
+def test_mongo_commands_are_attributed_to_the_request():
+    app = _app()
+    route = "/items/{item_id}"
+    before = _sample("mongo_commands_total", route=route, command="find", outcome="ok")
+    before_bytes = _sample("mongo_reply_bytes_total", route=route, command="find")
+    before_round_trips = _sample("http_request_mongo_commands_sum", route=route)
+
+    asyncio.run(_get(app, "/items/1"))
+
+    assert _sample("mongo_commands_total", route=route, command="find", outcome="ok") == before + 3
+    assert _sample("mongo_reply_bytes_total", route=route, command="find") > before_bytes
+    assert _sample("http_request_mongo_commands_sum", route=route) == before_round_trips + 3
+
+    # Outside a request, commands land under "-"
+    outside = _sample("mongo_commands_total", route=metrics.NO_REQUEST, command="ping", outcome="ok")
+    metrics.command_metrics.succeeded(SimpleNamespace(command_name="ping", duration_micros=10, reply={"ok": 1}))
+    assert _sample("mongo_commands_total", route=metrics.NO_REQUEST, command="ping", outcome="ok") == outside + 1
+
+
+def test_named_caches_count_hits_and_misses():
+    cache = TTLCache(max_entries=2, ttl=60, name="test-entries")
+    hits = _sample("cache_hits_total", cache="test-entries")
+    misses = _sample("cache_misses_total", cache="test-entries")
+
+    cache.get("a")
+    cache.set("a", 1)
+    cache.get("a")
+    cache.get("a")
+
+    assert _sample("cache_hits_total", cache="test-entries") == hits + 2
+    assert _sample("cache_misses_total", cache="test-entries") == misses + 1
+    assert cache.stats()["hits"] == 2
+
+
+def test_render_uses_the_prometheus_text_format():
+    content, content_type = metrics.render()
+    assert content_type.startswith("text/plain")
+    assert b"# TYPE http_requests_total counter" in content
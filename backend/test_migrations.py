@@ -0,0 +1,87 @@
+"""
+Migrations applied by several workers at once, against a scratch database
+on the MongoDB at MONGODB_URL. Skipped when no server is reachable. Run
+with:
+
+    python -m pytest test_migrations.py
+"""
+import asyncio
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+import migrations
+from database import MONGODB_URL
+from migrations import LEASE_ID, Migration
+
+
+def _mongo_available() -> bool:
+    try:
+        MongoClient(MONGODB_URL, serverSelectionTimeoutMS=500).admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+
+
+pytestmark = pytest.mark.skipif(not _mongo_available(), reason="MongoDB is not reachable")
+
+
+def _run(scenario):
+    async def wrapper():
+        client = AsyncIOMotorClient(MONGODB_URL)
+        name = f"migrations_{uuid.uuid4().hex[:8]}"
+        try:
+            await scenario(client[name])
+        finally:
+            await client.drop_database(name)
+            client.close()
+
+    asyncio.run(wrapper())
+
+
+def _counting_migrations(monkeypatch, runs: list[int]):
+    async def apply(version, database):
+        runs.append(version)
+        # Long enough for the other workers to find the lease taken
+        await asyncio.sleep(0.1)
+
+    monkeypatch.setattr(migrations, "MIGRATIONS", [
+        Migration(version, f"test {version}", lambda database, version=version: apply(version, database))
+        for version in (1, 2)
+    ])
+    monkeypatch.setattr(migrations, "INDEXES", {})
+    monkeypatch.setattr(migrations, "MIGRATION_POLL_SECONDS", 0.05)
+
+
+def test_concurrent_workers_apply_each_migration_once(monkeypatch):
+    runs: list[int] = []
+    _counting_migrations(monkeypatch, runs)
+
+    async def scenario(database):
+        results = await asyncio.gather(*(migrations.migrate(database) for _ in range(4)))
+        assert runs == [1, 2]
+        assert sorted(results) == [[], [], [], [1, 2]]
+        assert await migrations.applied_versions(database) == {1, 2}
+        assert await database.schema_migrations.count_documents({"_id": LEASE_ID}) == 0
+        await migrations.verify(database)
+
+    _run(scenario)
+
+
+def test_an_expired_lease_is_taken_over(monkeypatch):
+    runs: list[int] = []
+    _counting_migrations(monkeypatch, runs)
+
+    async def scenario(database):
+        # Left behind by a worker that died mid-migration
+        await database.schema_migrations.insert_one({
+            "_id": LEASE_ID, "holder": "dead", "expires_at": datetime.now(timezone.utc) - timedelta(seconds=1),
+        })
+        assert await migrations.migrate(database) == [1, 2]
+        assert runs == [1, 2]
+
+    _run(scenario)
@@ -0,0 +1,450 @@
+"""
+Query-plan regression gate: every query the Mongo repositories send
+(storage/mongo.py and the modules it calls) is explained with
+``executionStats`` against a generated dataset (benchmarks/dataset.py),
+using the heaviest users, herds and reflections as probes.
+
+A case fails when its winning plan:
+
+- doesn't use the index the case expects
+- contains a COLLSCAN, unless the query scans by design
+- sorts in memory more than PLAN_MAX_SORTED_DOCS documents
+- examines more than PLAN_MAX_EXAMINED_RATIO documents per document
+  returned (matched, for writes)
+
+By default a small dataset is generated into a scratch database and
+dropped afterwards. To gate on production scale, generate it once and
+point QUERY_PLAN_DATABASE at it:
+
+    python -m benchmarks.dataset --database hlb_dataset
+    QUERY_PLAN_DATABASE=hlb_dataset python -m pytest test_query_plans.py
+
+The plan checks themselves are tested on canned explain output; only the
+cases need a server and are skipped when none is reachable.
+"""
+import asyncio
+import os
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+import pytest
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+from benchmarks.dataset import DatasetSpec, generate, prepare_schema
+from database import MONGODB_URL
+from pagination import DEFAULT_PAGE_SIZE, encode_cursor, keyset_filter
+from reminders import due_users_pipeline
+from schemas import Herd, HerdMember, Reflection
+from serialization import projection
+from storage.mongo import readable_by
+
+QUERY_PLAN_DATABASE = os.getenv("QUERY_PLAN_DATABASE")
+PLAN_MAX_SORTED_DOCS = int(os.getenv("PLAN_MAX_SORTED_DOCS", 1000))
+PLAN_MAX_EXAMINED_RATIO = float(os.getenv("PLAN_MAX_EXAMINED_RATIO", 2))
+
+SMALL_DATASET = DatasetSpec(users=2000, herds=200, reflections=20_000, max_friends=100, max_herd_size=100)
+PAGE = DEFAULT_PAGE_SIZE + 1
+
+
+def _mongo_available() -> bool:
+    try:
+        MongoClient(MONGODB_URL, serverSelectionTimeoutMS=500).admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+
+
+async def _generate(name: str):
+    client = AsyncIOMotorClient(MONGODB_URL)
+    try:
+        await generate(client[name], SMALL_DATASET, log=lambda message: None)
+        await prepare_schema(client[name])
+    finally:
+        client.close()
+
+
+@pytest.fixture(scope="module")
+def dataset():
+    if not _mongo_available():
+        pytest.skip("MongoDB is not reachable")
+    client = MongoClient(MONGODB_URL)
+    name = QUERY_PLAN_DATABASE or f"hlb_query_plans_{uuid.uuid4().hex[:8]}"
+    if not QUERY_PLAN_DATABASE:
+        asyncio.run(_generate(name))
+    database = client[name]
+    info = database.dataset_info.find_one({"_id": "dataset"})
+    assert info, f"{name} has no dataset_info: generate it with benchmarks.dataset"
+    try:
+        yield database, Probes(database, info["probes"])
+    finally:
+        if not QUERY_PLAN_DATABASE:
+            client.drop_database(name)
+        client.close()
+
+
+class Probes:
+    """
+    The dataset_info probes, plus documents derived from them.
+    """
+
+    def __init__(self, database, probes: dict):
+        self.db = database
+        self.__dict__.update(probes)
+        self.most_shared_reflection = ObjectId(probes["most_shared_reflection"])
+        user = database.users.find_one({"_id": ObjectId(self.most_friends)}, {"settings": 1})
+        self.friends = user["settings"]["friends"]
+        user = database.users.find_one({"_id": ObjectId(self.most_herds)}, {"settings": 1})
+        self.herds = user["settings"]["herds"]
+        herd = database.herds.find_one({"_id": ObjectId(self.biggest_herd)})
+        self.herd_owner = herd["owner_id"]
+        member = database.herd_memberships.find_one({"herd_id": self.biggest_herd, "role": "member"})
+        self.herd_member = member["user_id"] if member else self.herd_owner
+        reflection = database.reflections.find_one({"_id": self.most_shared_reflection})
+        self.hot_author = reflection["user_id"]
+        self.hot_reader = (reflection["sharedWith"] or [self.busiest_feed])[0]
+
+
+def page_command(collection: str, query: dict, sort_field: Optional[str], id_field: str = "_id",
+                 cursor: Optional[str] = None, projection: Optional[dict] = None) -> dict:
+    """
+    The find that pagination.fetch_page sends.
+    """
+    if cursor:
+        query = {"$and": [query, keyset_filter(cursor, sort_field, id_field)]}
+    sort = {sort_field: -1, id_field: -1} if sort_field else {id_field: -1}
+    command = {"find": collection, "filter": query, "sort": sort, "limit": PAGE}
+    if projection:
+        command["projection"] = projection
+    return command
+
+
+def second_page(database, command: dict, sort_field: Optional[str], id_field: str = "_id") -> dict:
+    """
+    ``command`` continued from the cursor its first page hands out.
+    """
+    docs = list(database[command["find"]].find(command["filter"]).sort(list(command["sort"].items())).limit(PAGE))
+    cursor = encode_cursor(docs[DEFAULT_PAGE_SIZE - 1], sort_field, id_field) if len(docs) == PAGE else None
+    return page_command(command["find"], command["filter"], sort_field, id_field, cursor, command.get("projection"))
+
+
+def feed_page(p: Probes) -> dict:
+    return page_command(
+        "timelines", {"recipient_id": p.busiest_feed}, "timestamp", "reflection_id",
+        projection={**projection(Reflection, prefix="item."), "timestamp": 1, "reflection_id": 1, "my_reactions": 1},
+    )
+
+
+def author_page(p: Probes) -> dict:
+    return page_command("reflections", {"user_id": p.most_reflections}, "timestamp", projection=projection(Reflection))
+
+
+def update(collection: str, query: dict, change, multi: bool = False, upsert: bool = False) -> dict:
+    return {"update": collection, "updates": [{"q": query, "u": change, "multi": multi, "upsert": upsert}]}
+
+
+def delete(collection: str, query: dict, limit: int = 0) -> dict:
+    return {"delete": collection, "deletes": [{"q": query, "limit": limit}]}
+
+
+def aggregate(collection: str, pipeline: list[dict]) -> dict:
+    return {"aggregate": collection, "pipeline": pipeline, "cursor": {}}
+
+
+def bump_matching(collection: str, query: dict, user_field: str) -> dict:
+    # versions.bump_matching without its $merge, which explain can't execute
+    return aggregate(collection, [
+        {"$match": {"$and": [query, {user_field: {"$ne": None}}]}},
+        {"$group": {"_id": {"$toString": f"${user_field}"}}},
+    ])
+
+
+def now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+@dataclass
+class Case:
+    name: str
+    command: Callable[[Probes], dict]
+    # Indexes the winning plan may use; None for _id lookups, whose plan
+    # shape (IDHACK, EXPRESS) varies by server version
+    index: Optional[tuple[str, ...]] = None
+    collscan_ok: bool = False
+    # None: the query reads everything it examines, by design
+    max_examined_ratio: Optional[float] = PLAN_MAX_EXAMINED_RATIO
+
+
+CASES = [
+    # Users and friends
+    Case("users by email", lambda p: {"find": "users", "filter": {"email": "user1@dataset.example"}, "limit": 1},
+         index=("email_unique",)),
+    Case("users password rehash", lambda p: update(
+        "users", {"_id": ObjectId(p.most_friends), "hashed_password": "!dataset"}, {"$set": {"hashed_password": "x"}})),
+    Case("users add friend", lambda p: update(
+        "users", {"_id": ObjectId(p.most_friends)}, {"$addToSet": {"settings.friends": p.most_followed}})),
+    Case("friends page", lambda p: page_command(
+        "users", {"_id": {"$in": [ObjectId(f) for f in p.friends]}}, None, projection={"hashed_password": 0}),
+        index=("_id_",)),
+    Case("friends page 2", lambda p: second_page(p.db, page_command(
+        "users", {"_id": {"$in": [ObjectId(f) for f in p.friends]}}, None, projection={"hashed_password": 0}), None),
+        index=("_id_",)),
+    Case("bump followers", lambda p: bump_matching("users", {"settings.friends": {"$in": [p.most_followed]}}, "_id"),
+         index=("settings_friends",)),
+    Case("user version", lambda p: {"find": "user_versions", "filter": {"_id": p.busiest_feed}, "limit": 1}),
+    Case("bump versions", lambda p: update("user_versions", {"_id": p.busiest_feed}, {"$inc": {"feed": 1}}, upsert=True)),
+    Case("herd index lookup", lambda p: {
+        "find": "users", "filter": {"_id": {"$in": [ObjectId(p.herd_member)]}}, "projection": {"settings.herds": 1}}),
+    Case("herd index add", lambda p: update(
+        "users", {"_id": {"$in": [ObjectId(p.herd_member)]}}, {"$addToSet": {"settings.herds": p.biggest_herd}}, multi=True)),
+    Case("reflection stats record", lambda p: update(
+        "users", {"_id": ObjectId(p.most_reflections)}, [{"$set": {"last_reflection_at": now()}}])),
+    Case("reflection stats recompute", lambda p: {
+        "find": "reflections", "filter": {"user_id": p.most_reflections},
+        "projection": {"_id": 0, "timestamp": 1}, "sort": {"timestamp": -1, "_id": -1}},
+        index=("user_timestamp",)),
+
+    # Feed and reflections
+    Case("feed page", feed_page, index=("recipient_timestamp",)),
+    Case("feed page 2", lambda p: second_page(p.db, feed_page(p), "timestamp", "reflection_id"),
+         index=("recipient_timestamp",)),
+    Case("author page", author_page, index=("user_timestamp",)),
+    Case("author page 2", lambda p: second_page(p.db, author_page(p), "timestamp"), index=("user_timestamp",)),
+    Case("reflection update", lambda p: {
+        "findAndModify": "reflections", "query": {"_id": p.most_shared_reflection, "user_id": p.hot_author},
+        "update": {"$set": {"high": "h"}}, "new": True}),
+    Case("reflection delete", lambda p: {
+        "findAndModify": "reflections", "query": {"_id": p.most_shared_reflection, "user_id": p.hot_author},
+        "remove": True, "fields": {"timestamp": 1}}),
+    Case("reflection react", lambda p: {
+        "findAndModify": "reflections",
+        "query": {"_id": p.most_shared_reflection, **readable_by(p.hot_reader, p.herds)},
+        "update": {"$inc": {"reaction_counts.love": 1}}, "new": True}),
+    Case("reflection flag", lambda p: {
+        "findAndModify": "reflections", "query": {"_id": p.most_shared_reflection, "user_id": p.hot_author},
+        "update": [{"$set": {"isFlaggedForFollowUp": {"$not": [{"$ifNull": ["$isFlaggedForFollowUp", False]}]}}}],
+        "new": True}),
+    Case("reflection exists", lambda p: {"count": "reflections", "query": {"_id": p.most_shared_reflection}, "limit": 1}),
+    Case("image access", lambda p: {
+        "count": "reflections", "query": {"image_id": "a" * 64, **readable_by(p.hot_reader, p.herds)}, "limit": 1},
+        index=("image_id",)),
+    Case("recipients by herd", lambda p: {
+        "find": "herd_memberships", "filter": {"herd_id": {"$in": [p.biggest_herd]}}, "projection": {"_id": 0, "user_id": 1}},
+        index=("herd_user_unique", "herd_newest")),
+    Case("author rename", lambda p: update(
+        "reflections", {"user_id": p.most_reflections, "author_name": {"$ne": "renamed"}},
+        {"$set": {"author_name": "renamed"}}, multi=True),
+        index=("user_timestamp",)),
+    Case("author reflection ids", lambda p: {
+        "find": "reflections", "filter": {"user_id": p.most_reflections}, "projection": {"_id": 1}},
+        index=("user_timestamp",)),
+
+    # Reactions
+    Case("reaction remove", lambda p: delete("reactions", {
+        "reflection_id": p.most_shared_reflection, "user_id": p.hot_reader, "type": "love"}, limit=1),
+        index=("reflection_user_type_unique",)),
+    Case("my reactions", lambda p: {
+        "distinct": "reactions", "key": "type", "query": {"reflection_id": p.most_shared_reflection, "user_id": p.hot_reader}},
+        index=("reflection_user_type_unique",)),
+    Case("reactions by user", lambda p: {
+        "find": "reactions", "filter": {"reflection_id": p.most_shared_reflection}, "projection": {"_id": 0, "user_id": 1, "type": 1}},
+        index=("reflection_user_type_unique",)),
+    Case("reactions delete", lambda p: delete("reactions", {"reflection_id": p.most_shared_reflection}),
+         index=("reflection_user_type_unique",)),
+
+    # Timelines
+    Case("timeline readers", lambda p: {
+        "distinct": "timelines", "key": "recipient_id", "query": {"reflection_id": p.most_shared_reflection}},
+        index=("reflection_id",)),
+    Case("timeline upsert", lambda p: update(
+        "timelines", {"recipient_id": p.busiest_feed, "reflection_id": p.most_shared_reflection},
+        {"$set": {"timestamp": now()}}, upsert=True),
+        index=("recipient_reflection_unique", "recipient_timestamp")),
+    Case("timeline refresh", lambda p: update(
+        "timelines", {"reflection_id": p.most_shared_reflection}, {"$set": {"timestamp": now()}}, multi=True),
+        index=("reflection_id",)),
+    Case("timeline reaction", lambda p: update(
+        "timelines", {"reflection_id": p.most_shared_reflection},
+        [{"$set": {"my_reactions": {"$cond": [{"$eq": ["$recipient_id", p.hot_reader]}, ["love"], "$my_reactions"]}}}],
+        multi=True),
+        index=("reflection_id",)),
+    Case("timeline remove", lambda p: delete("timelines", {"reflection_id": p.most_shared_reflection}),
+         index=("reflection_id",)),
+    Case("timeline revoke", lambda p: delete("timelines", {
+        "recipient_id": p.herd_member, "reflection_id": {"$in": [p.most_shared_reflection]}}),
+        index=("recipient_reflection_unique", "recipient_timestamp", "reflection_id")),
+    Case("timeline author rename", lambda p: update(
+        "timelines", {"reflection_id": {"$in": [p.most_shared_reflection]}, "item.author_name": {"$ne": "renamed"}},
+        {"$set": {"item.author_name": "renamed"}}, multi=True),
+        index=("reflection_id",)),
+    Case("bump readers", lambda p: bump_matching("timelines", {"reflection_id": p.most_shared_reflection}, "recipient_id"),
+         index=("reflection_id",)),
+    Case("herd access grant", lambda p: {"find": "reflections", "filter": {"sharedHerds": p.biggest_herd}},
+         index=("shared_herds",)),
+    Case("herd access revoke", lambda p: {
+        "find": "reflections", "projection": {"_id": 1}, "filter": {"$and": [
+            {"sharedHerds": p.biggest_herd},
+            {"sharedHerds": {"$nin": [h for h in p.herds if h != p.biggest_herd]}},
+            {"sharedWith": {"$ne": p.herd_member}},
+        ]}},
+        index=("shared_herds",)),
+
+    # Herds and members
+    # A user's herds are looked up by id and sorted in memory: bounded by
+    # how many herds one user is in, not by the collection
+    Case("herds page", lambda p: page_command(
+        "herds", {"_id": {"$in": [ObjectId(h) for h in p.herds]}}, "created_at", projection=projection(Herd)),
+        max_examined_ratio=None,
+        index=("_id_",)),
+    Case("herd by id", lambda p: {"find": "herds", "filter": {"_id": ObjectId(p.biggest_herd)}, "limit": 1}),
+    Case("herd update", lambda p: {
+        "findAndModify": "herds", "query": {"_id": ObjectId(p.biggest_herd), "owner_id": p.herd_owner},
+        "update": {"$set": {"updated_at": now()}}, "new": True}),
+    Case("herd remove member", lambda p: {
+        "findAndModify": "herds",
+        "query": {"_id": ObjectId(p.biggest_herd), "owner_id": {"$ne": p.herd_member, "$eq": p.herd_owner}},
+        "update": {"$inc": {"member_count": -1}}, "new": True}),
+    Case("members page", lambda p: page_command(
+        "herd_memberships", {"herd_id": p.biggest_herd}, None, projection=projection(HerdMember)),
+        index=("herd_newest",)),
+    Case("members page 2", lambda p: second_page(p.db, page_command(
+        "herd_memberships", {"herd_id": p.biggest_herd}, None, projection=projection(HerdMember)), None),
+        index=("herd_newest",)),
+    Case("member ids", lambda p: {"distinct": "herd_memberships", "key": "user_id", "query": {"herd_id": p.biggest_herd}},
+         index=("herd_user_unique", "herd_newest")),
+    Case("member remove", lambda p: delete(
+        "herd_memberships", {"herd_id": p.biggest_herd, "user_id": p.herd_member}, limit=1),
+        index=("herd_user_unique", "herd_newest")),
+    Case("members delete", lambda p: delete("herd_memberships", {"herd_id": p.biggest_herd}),
+         index=("herd_user_unique", "herd_newest")),
+    Case("bump members", lambda p: bump_matching("herd_memberships", {"herd_id": p.biggest_herd}, "user_id"),
+         index=("herd_user_unique", "herd_newest")),
+
+    # Reminders read every user with a cadence once per dispatch
+    Case("reminders due", lambda p: aggregate("users", due_users_pipeline(datetime.now(timezone.utc))),
+         collscan_ok=True, max_examined_ratio=None),
+]
+
+
+def _find_plans(explain) -> list[dict]:
+    """
+    The dicts holding ``queryPlanner``: the top level for finds and writes,
+    nested under ``$cursor`` stages for aggregations.
+    """
+    if isinstance(explain, list):
+        return [plan for item in explain for plan in _find_plans(item)]
+    if not isinstance(explain, dict):
+        return []
+    if "queryPlanner" in explain:
+        return [explain]
+    return [plan for value in explain.values() for plan in _find_plans(value)]
+
+
+def _stages(node) -> list[str]:
+    """
+    Every stage name in a plan tree, classic or slot-based.
+    """
+    if isinstance(node, list):
+        return [stage for item in node for stage in _stages(item)]
+    if not isinstance(node, dict):
+        return []
+    own = [node["stage"]] if isinstance(node.get("stage"), str) else []
+    return own + [stage for key, value in node.items() if key != "stage" for stage in _stages(value)]
+
+
+def _index_names(node) -> set[str]:
+    if isinstance(node, list):
+        return {name for item in node for name in _index_names(item)}
+    if not isinstance(node, dict):
+        return set()
+    own = {node["indexName"]} if isinstance(node.get("indexName"), str) else set()
+    return own.union(*(_index_names(value) for value in node.values()))
+
+
+def _counter(node, key: str) -> int:
+    """
+    The largest ``key`` counter anywhere in the execution stages.
+    """
+    if isinstance(node, list):
+        return max((_counter(item, key) for item in node), default=0)
+    if not isinstance(node, dict):
+        return 0
+    own = node.get(key, 0) if isinstance(node.get(key), int) else 0
+    return max([own] + [_counter(value, key) for value in node.values()])
+
+
+def check_plan(case: Case, explain: dict) -> list[str]:
+    plans = _find_plans(explain)
+    assert plans, f"no query plan in {explain}"
+    problems = []
+    for plan in plans:
+        winning = plan["queryPlanner"]["winningPlan"]
+        stages = _stages(winning)
+        stats = plan.get("executionStats", {})
+        examined = stats.get("totalDocsExamined", 0)
+        keys = stats.get("totalKeysExamined", 0)
+        execution = stats.get("executionStages", {})
+        returned = max(
+            stats.get("nReturned", 0),
+            _counter(execution, "nMatched"),
+            _counter(execution, "nWouldDelete"),
+        )
+
+        if case.index and not _index_names(winning) & set(case.index):
+            used = ", ".join(sorted(_index_names(winning))) or "no index"
+            problems.append(f"uses {used}, expected {' or '.join(case.index)}")
+        if "COLLSCAN" in stages and not case.collscan_ok:
+            problems.append(f"COLLSCAN over {examined} documents")
+        if "SORT" in stages and max(examined, keys) > PLAN_MAX_SORTED_DOCS:
+            problems.append(f"in-memory SORT of up to {max(examined, keys)} documents")
+        if case.max_examined_ratio is not None and examined / max(returned, 1) > case.max_examined_ratio:
+            problems.append(f"examined {examined} documents for {returned}")
+    return problems
+
+
+@pytest.mark.parametrize("case", CASES, ids=[case.name for case in CASES])
+def test_query_plan(dataset, case: Case):
+    database, probes = dataset
+    explain = database.command("explain", case.command(probes), verbosity="executionStats")
+    problems = check_plan(case, explain)
+    assert not problems, f"{case.name}: {'; '.join(problems)}"
+
+
+def test_checks_catch_bad_plans(dataset):
+    database, _ = dataset
+    unindexed = {"find": "reflections", "filter": {"high": "high 1"}}
+    explain = database.command("explain", unindexed, verbosity="executionStats")
+    assert any("COLLSCAN" in problem for problem in check_plan(Case("unindexed", lambda p: unindexed), explain))
+
+
+def test_checks_read_every_explain_shape():
+    # Classic find: in-memory sort over a collection scan
+    find = {
+        "queryPlanner": {"winningPlan": {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}},
+        "executionStats": {"nReturned": 21, "totalDocsExamined": 5000, "totalKeysExamined": 0, "executionStages": {}},
+    }
+    problems = check_plan(Case("find", lambda p: {}, index=("user_timestamp",)), find)
+    assert len(problems) == 4, problems
+
+    # Aggregation: the plan sits under the $cursor stage
+    pipeline = {"stages": [{"$cursor": {
+        "queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": "reflection_id"}}},
+        "executionStats": {"nReturned": 40, "totalDocsExamined": 40, "totalKeysExamined": 40, "executionStages": {}},
+    }}, {"$group": {}}]}
+    assert check_plan(Case("aggregate", lambda p: {}, index=("reflection_id",)), pipeline) == []
+
+    # Slot-based update: matched documents count as returned
+    update = {
+        "queryPlanner": {"winningPlan": {"queryPlan": {"stage": "UPDATE", "inputStage": {
+            "stage": "IXSCAN", "indexName": "reflection_id"}}}},
+        "executionStats": {"nReturned": 0, "totalDocsExamined": 30, "totalKeysExamined": 30,
+                           "executionStages": {"stage": "UPDATE", "nMatched": 30}},
+    }
+    assert check_plan(Case("update", lambda p: {}, index=("reflection_id",)), update) == []
+    assert check_plan(Case("update", lambda p: {}, index=("recipient_timestamp",)), update) == [
+        "uses reflection_id, expected recipient_timestamp"
+    ]
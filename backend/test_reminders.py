@@ -0,0 +1,57 @@
+"""
+Reminder dispatch when MongoDB writes fail, against a stand-in database.
+No MongoDB needed. Run with:
+
+    python -m pytest test_reminders.py
+"""
+import asyncio
+from types import SimpleNamespace
+
+from reminders import dispatch_reminders
+from utils.email import EmailSender
+
+
+class Sender(EmailSender):
+    def __init__(self):
+        self.sent: list[str] = []
+
+    async def send(self, to, subject, body):
+        self.sent.append(to)
+
+
+class Deliveries:
+    """
+    Claims fail for every other user, as on a flaky connection.
+    """
+
+    def __init__(self):
+        self.claims = 0
+
+    async def insert_one(self, doc):
+        self.claims += 1
+        if self.claims % 2:
+            raise ConnectionError("connection reset")
+
+    async def update_one(self, query, update):
+        pass
+
+    async def delete_one(self, query):
+        pass
+
+
+class Users:
+    def __init__(self, count: int):
+        self.count = count
+
+    async def aggregate(self, pipeline, batchSize=None):
+        for i in range(self.count):
+            yield {"user_id": str(i), "email": f"user{i}@example.com", "cadence": "daily", "delivery_key": f"{i}:daily"}
+
+
+def test_failed_writes_are_counted_without_stalling_the_dispatcher():
+    # Far more users than workers and queue slots, so dead workers would block the cursor
+    database = SimpleNamespace(users=Users(40), reminder_deliveries=Deliveries())
+    sender = Sender()
+    stats = asyncio.run(asyncio.wait_for(dispatch_reminders(database, sender, workers=2), timeout=5))
+    assert stats.due == 40 and stats.sent == 20 and stats.failed == 20
+    assert len(sender.sent) == 20 and len(stats.errors) == 10
@@ -0,0 +1,191 @@
+"""
+Round-trip budgets for the write endpoints.
+
+Drives the app in-process against the MongoDB at MONGODB_URL and counts the
+commands each request sends (database.command_counter). Skipped when no
+server is reachable. Run with:
+
+    python -m pytest test_round_trips.py
+"""
+import asyncio
+import uuid
+
+import httpx
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+from database import MONGODB_URL, command_counter, supports_transactions
+
+
+def _mongo_available() -> bool:
+    try:
+        MongoClient(MONGODB_URL, serverSelectionTimeoutMS=500).admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+
+
+pytestmark = pytest.mark.skipif(not _mongo_available(), reason="MongoDB is not reachable")
+
+
+@pytest.fixture(autouse=True)
+def no_rate_limits():
+    from admission import limiter
+
+    backend = limiter.backend
+    limiter.configure("off")
+    yield
+    limiter.configure(backend)
+
+
+class Session:
+    def __init__(self, client: httpx.AsyncClient):
+        self.client = client
+        self.headers = {}
+        self.user = None
+
+    async def signup(self, email: str):
+        response = await self.client.post("/api/v1/auth/signup", json={"email": email, "password": "secret123", "full_name": email})
+        assert response.status_code == 200, response.text
+        self.user = response.json()
+        response = await self.client.post("/api/v1/auth/token", data={"username": email, "password": "secret123"})
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    async def request(self, method: str, url: str, **kwargs) -> tuple[httpx.Response, int]:
+        """
+        Sends a request and returns it along with the number of MongoDB
+        commands it made. The user cache is warmed first, so authentication
+        doesn't count against the endpoint.
+        """
+        await self.client.get("/api/v1/users/me", headers=self.headers)
+        before = command_counter.total()
+        headers = {**self.headers, **kwargs.pop("headers", {})}
+        response = await self.client.request(method, url, headers=headers, **kwargs)
+        return response, command_counter.total() - before
+
+
+async def _scenario():
+    from main import app
+    from database import db
+
+    tag = uuid.uuid4().hex[:8]
+    emails = [f"budget-{tag}-a@example.com", f"budget-{tag}-b@example.com"]
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        alice, bob = Session(client), Session(client)
+        try:
+            before = command_counter.total()
+            await alice.signup(emails[0])
+            await bob.signup(emails[1])
+            # signup: email check + insert; token: user lookup
+            assert command_counter.total() - before == 2 * (2 + 1)
+
+            budgets = []
+            # Herd membership changes commit a transaction when the server supports them
+            commit = 1 if await supports_transactions() else 0
+
+            def spend(name: str, response: httpx.Response, ops: int, budget: int, expected_status: int = 200):
+                assert response.status_code == expected_status, f"{name}: {response.text}"
+                budgets.append((name, ops, budget))
+
+            # insert + timeline upsert + feed versions + user stats update + followers' versions
+            r, ops = await alice.request("POST", "/api/v1/reflections/", json={
+                "high": "h", "low": "l", "buffalo": "b", "sharedWith": [bob.user["id"]],
+            })
+            spend("create reflection", r, ops, 5, 201)
+            reflection_id = r.json()["id"]
+
+            # edge insert + counter (with access check) + timeline refresh + feed versions
+            # + my reactions; herds come from the user's herd index
+            r, ops = await bob.request("POST", f"/api/v1/reflections/{reflection_id}/react", json={"type": "curious"})
+            spend("react", r, ops, 5)
+            assert r.json()["reaction_counts"] == {"curious": 1}
+            assert r.json()["my_reactions"] == ["curious"]
+            # feed version + one timeline range scan; author names are snapshotted, so no user lookup
+            r, ops = await bob.request("GET", "/api/v1/reflections/feed")
+            spend("feed", r, ops, 2)
+            assert r.json()["items"][0]["my_reactions"] == ["curious"]
+            assert r.json()["items"][0]["author_name"] == emails[0]
+            # an unchanged feed is answered from the version alone
+            etag = r.headers["etag"]
+            r, ops = await bob.request("GET", "/api/v1/reflections/feed", headers={"If-None-Match": etag})
+            spend("feed (not modified)", r, ops, 1, 304)
+            # ... plus the edge delete when the insert hits the unique index
+            r, ops = await bob.request("POST", f"/api/v1/reflections/{reflection_id}/react", json={"type": "curious"})
+            spend("unreact", r, ops, 6)
+            assert r.json()["reaction_counts"] == {"curious": 0}
+            assert r.json()["my_reactions"] == []
+
+            # findAndModify + timeline refresh + feed versions
+            r, ops = await alice.request("POST", f"/api/v1/reflections/{reflection_id}/flag")
+            spend("flag", r, ops, 3)
+            assert r.json()["isFlaggedForFollowUp"] is True
+            r, ops = await bob.request("POST", f"/api/v1/reflections/{reflection_id}/flag")
+            spend("flag (not author)", r, ops, 2, 403)
+
+            r, ops = await alice.request("PUT", f"/api/v1/reflections/{reflection_id}", json={"high": "higher"})
+            spend("update reflection", r, ops, 3)
+            assert r.json()["high"] == "higher"
+            r, ops = await bob.request("GET", "/api/v1/reflections/feed", headers={"If-None-Match": etag})
+            spend("feed (modified)", r, ops, 2)
+            assert r.json()["items"][0]["high"] == "higher"
+
+            # herd insert + owner membership + owner's herd index + herds versions (members,
+            # owner, followers)
+            r, ops = await alice.request("POST", "/api/v1/herds/", json={"name": f"herd-{tag}"})
+            spend("create herd", r, ops, 6 + commit, 201)
+            herd_id = r.json()["id"]
+
+            # user lookup + member count + membership insert + herd index + backfill of herd
+            # reflections + herds versions
+            r, ops = await alice.request("POST", f"/api/v1/herds/{herd_id}/members", json={"email": emails[1]})
+            spend("add member", r, ops, 8 + commit)
+            assert r.json()["member_count"] == 2
+            r, ops = await alice.request("POST", f"/api/v1/herds/{herd_id}/members", json={"email": emails[1]})
+            spend("add member (duplicate)", r, ops, 5 + commit, 400)
+
+            r, ops = await bob.request("GET", f"/api/v1/herds/{herd_id}/members", params={"limit": 1})
+            spend("list members", r, ops, 1)
+            assert len(r.json()["items"]) == 1 and r.json()["next_cursor"]
+            me = await client.get("/api/v1/users/me", headers=bob.headers)
+            assert me.json()["settings"]["herds"] == [herd_id]
+
+            r, ops = await alice.request("GET", "/api/v1/herds/")
+            herds_etag = r.headers["etag"]
+            r, ops = await alice.request("PUT", f"/api/v1/herds/{herd_id}", json={"name": f"renamed-{tag}"})
+            spend("update herd", r, ops, 2)
+            assert r.json()["name"] == f"renamed-{tag}"
+            r, ops = await alice.request("GET", "/api/v1/herds/", headers={"If-None-Match": herds_etag})
+            spend("list herds (modified)", r, ops, 2)
+            assert r.json()["items"][0]["name"] == f"renamed-{tag}"
+
+            # member count + membership delete + herd index + revoke (remaining herds + revoked
+            # reflections) + herds versions
+            r, ops = await bob.request("DELETE", f"/api/v1/herds/{herd_id}/members/{bob.user['id']}")
+            spend("leave herd", r, ops, 8 + commit)
+            assert r.json()["member_count"] == 1
+
+            # herd delete + member ids + memberships delete + herd index + revoke + herds versions
+            r, ops = await alice.request("DELETE", f"/api/v1/herds/{herd_id}")
+            spend("delete herd", r, ops, 9 + commit, 204)
+
+            # findAndDelete + timeline readers, cleanup and feed versions + reactions cleanup
+            # + stats recompute (read user, scan, write) + followers' versions
+            r, ops = await alice.request("DELETE", f"/api/v1/reflections/{reflection_id}")
+            spend("delete reflection", r, ops, 9, 204)
+
+            over = [f"{name}: {ops} > {budget}" for name, ops, budget in budgets if ops > budget]
+            assert not over, "Round-trip budget exceeded: " + "; ".join(over)
+        finally:
+            user_ids = [s.user["id"] for s in (alice, bob) if s.user]
+            await db.reflections.delete_many({"user_id": {"$in": user_ids}})
+            await db.timelines.delete_many({"recipient_id": {"$in": user_ids}})
+            await db.herds.delete_many({"owner_id": {"$in": user_ids}})
+            await db.herd_memberships.delete_many({"user_id": {"$in": user_ids}})
+            await db.users.delete_many({"email": {"$in": emails}})
+            await db.user_versions.delete_many({"_id": {"$in": user_ids}})
+
+
+def test_write_endpoints_stay_within_round_trip_budget():
+    asyncio.run(_scenario())
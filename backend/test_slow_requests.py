@@ -0,0 +1,94 @@
+"""
+Slow-request log and admin-triggered profiles. Run with:
+
+    python -m pytest test_slow_requests.py
+"""
+import asyncio
+import json
+import os
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+import deps
+import metrics
+import slow_requests
+from slow_requests import LogBudget, SlowRequestMiddleware
+
+
+def _app(threshold_ms: float, profile_dir: str) -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(SlowRequestMiddleware, threshold_ms=threshold_ms, profile_dir=profile_dir)
+    app.add_middleware(metrics.MetricsMiddleware)
+
+    @app.get("/items/{item_id}")
+    async def read_item(item_id: str):
+        metrics.record_user("user-1")
+        metrics.command_metrics.started(SimpleNamespace(command_name="find"))
+        metrics.command_metrics.succeeded(SimpleNamespace(command_name="find", duration_micros=2000, reply={}))
+        metrics.record_serialization(0.003)
+        await asyncio.sleep(0.01)
+        return {"id": item_id}
+
+    return app
+
+
+async def _get(app: FastAPI, path: str, headers: dict = None) -> httpx.Response:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.get(path, headers=headers or {})
+
+
+def _slow_records(caplog) -> list[dict]:
+    return [json.loads(r.getMessage()) for r in caplog.records if r.name == "slow_requests" and r.getMessage().startswith("{")]
+
+
+def test_slow_requests_are_logged_with_their_commands(caplog, tmp_path):
+    caplog.set_level("WARNING", logger="slow_requests")
+    asyncio.run(_get(_app(threshold_ms=1, profile_dir=str(tmp_path)), "/items/1"))
+
+    [record] = _slow_records(caplog)
+    assert record["route"] == "/items/{item_id}" and record["status"] == 200
+    assert record["user_id"] == "user-1"
+    assert record["commands"] == [["find", 2.0, True]]
+    assert record["mongo_commands"] == 1 and record["serialization_ms"] == 3.0
+    assert record["duration_ms"] >= 10
+
+
+def test_fast_requests_are_not_logged(caplog, tmp_path):
+    caplog.set_level("WARNING", logger="slow_requests")
+    asyncio.run(_get(_app(threshold_ms=60_000, profile_dir=str(tmp_path)), "/items/1"))
+    assert _slow_records(caplog) == []
+
+
+def test_log_budget_reports_what_it_suppressed():
+    budget = LogBudget(per_second=2)
+    assert [budget.take() for _ in range(5)] == [True, True, False, False, False]
+    assert budget.suppressed == 3
+
+
+def test_profile_header_needs_the_admin_token(monkeypatch, tmp_path):
+    monkeypatch.setattr(deps, "ADMIN_TOKEN", "secret")
+    app = _app(threshold_ms=60_000, profile_dir=str(tmp_path))
+    response = asyncio.run(_get(app, "/items/1", {"X-Profile": "html", "X-Admin-Token": "wrong"}))
+    assert "x-profile-file" not in response.headers
+    assert not os.listdir(tmp_path)
+
+
+def test_admin_can_profile_a_request(monkeypatch, tmp_path):
+    pytest.importorskip("pyinstrument")
+    monkeypatch.setattr(deps, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(slow_requests, "PROFILE_MAX_FILES", 2)
+    app = _app(threshold_ms=60_000, profile_dir=str(tmp_path))
+
+    names = []
+    for format in ("html", "speedscope", "speedscope"):
+        response = asyncio.run(_get(app, "/items/1", {"X-Profile": format, "X-Admin-Token": "secret"}))
+        names.append(response.headers["x-profile-file"])
+    assert names[0].endswith(".html") and names[1].endswith(".speedscope.json")
+    # Rotation keeps the newest PROFILE_MAX_FILES
+    assert len(os.listdir(tmp_path)) == 2
+    with open(tmp_path / names[2]) as f:
+        assert "shared" in json.load(f)
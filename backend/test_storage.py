@@ -0,0 +1,289 @@
+"""
+The full API in-process on the in-memory storage engine: no MongoDB
+needed. Run with:
+
+    python -m pytest test_storage.py
+"""
+import asyncio
+import uuid
+
+import httpx
+import pytest
+
+import metrics
+import storage
+from admission import limiter
+from storage import RoundTripBudgetExceeded, round_trips, store
+
+
+@pytest.fixture
+def memory_store():
+    backend, admission = store.backend, limiter.backend
+    store.configure("memory")
+    # Fresh buckets, so earlier runs can't have spent this test's signups
+    limiter.configure("memory")
+    yield store
+    store.configure(backend)
+    limiter.configure(admission)
+
+
+async def _client_session(scenario):
+    from main import app
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            await scenario(client)
+
+
+async def _signup(client: httpx.AsyncClient, email: str) -> tuple[dict, dict]:
+    response = await client.post("/api/v1/auth/signup", json={"email": email, "password": "secret123"})
+    assert response.status_code == 200, response.text
+    token = await client.post("/api/v1/auth/token", data={"username": email, "password": "secret123"})
+    return response.json(), {"Authorization": f"Bearer {token.json()['access_token']}"}
+
+
+def test_api_runs_on_the_memory_engine(memory_store):
+    tag = uuid.uuid4().hex[:8]
+
+    async def scenario(client: httpx.AsyncClient):
+        alice, as_alice = await _signup(client, f"alice-{tag}@example.com")
+        bob, as_bob = await _signup(client, f"bob-{tag}@example.com")
+        response = await client.post("/api/v1/auth/signup", json={"email": alice["email"], "password": "x"})
+        assert response.status_code == 400
+
+        r = await client.post("/api/v1/reflections/", headers=as_alice, json={
+            "high": "h", "low": "l", "buffalo": "b", "sharedWith": [bob["id"]],
+        })
+        assert r.status_code == 201
+        reflection_id = r.json()["id"]
+        assert r.json()["author_name"] == alice["email"]
+
+        r = await client.get("/api/v1/reflections/feed", headers=as_bob)
+        etag = r.headers["etag"]
+        assert [item["id"] for item in r.json()["items"]] == [reflection_id]
+        r = await client.get("/api/v1/reflections/feed", headers={**as_bob, "If-None-Match": etag})
+        assert r.status_code == 304
+
+        r = await client.post(f"/api/v1/reflections/{reflection_id}/react", headers=as_bob, json={"type": "curious"})
+        assert r.json()["reaction_counts"] == {"curious": 1} and r.json()["my_reactions"] == ["curious"]
+        r = await client.get("/api/v1/reflections/feed", headers={**as_bob, "If-None-Match": etag})
+        assert r.status_code == 200 and r.json()["items"][0]["my_reactions"] == ["curious"]
+        r = await client.post(f"/api/v1/reflections/{reflection_id}/react", headers=as_bob, json={"type": "curious"})
+        assert r.json()["reaction_counts"] == {"curious": 0} and r.json()["my_reactions"] == []
+
+        r = await client.post(f"/api/v1/reflections/{reflection_id}/flag", headers=as_bob)
+        assert r.status_code == 403
+        r = await client.post(f"/api/v1/reflections/{'0' * 24}/flag", headers=as_bob)
+        assert r.status_code == 404
+
+        r = await client.get("/healthz")
+        assert r.status_code == 200 and r.json()["storage"] == "memory"
+
+        me = (await client.get("/api/v1/users/me", headers=as_alice)).json()
+        assert me["reflection_streak"] == 1 and me["last_reflection_at"]
+
+        # Herds: membership backfills the feed, leaving revokes it
+        r = await client.post("/api/v1/herds/", headers=as_alice, json={"name": "herd"})
+        herd_id = r.json()["id"]
+        r = await client.post("/api/v1/reflections/", headers=as_alice, json={
+            "high": "h2", "low": "l2", "buffalo": "b2", "sharedHerds": [herd_id],
+        })
+        herd_reflection_id = r.json()["id"]
+        r = await client.post(f"/api/v1/herds/{herd_id}/members", headers=as_alice, json={"email": bob["email"]})
+        assert r.json()["member_count"] == 2
+        r = await client.post(f"/api/v1/herds/{herd_id}/members", headers=as_alice, json={"email": bob["email"]})
+        assert r.status_code == 400
+        r = await client.get("/api/v1/reflections/feed", headers=as_bob)
+        assert [item["id"] for item in r.json()["items"]] == [herd_reflection_id, reflection_id]
+        r = await client.get(f"/api/v1/herds/{herd_id}/members", headers=as_bob, params={"limit": 1})
+        assert len(r.json()["items"]) == 1 and r.json()["next_cursor"]
+        r = await client.get(f"/api/v1/herds/{herd_id}/members", headers=as_bob, params={"cursor": r.json()["next_cursor"]})
+        assert len(r.json()["items"]) == 1 and r.json()["next_cursor"] is None
+
+        r = await client.delete(f"/api/v1/herds/{herd_id}/members/{alice['id']}", headers=as_alice)
+        assert r.status_code == 400
+        r = await client.delete(f"/api/v1/herds/{herd_id}/members/{bob['id']}", headers=as_bob)
+        assert r.json()["member_count"] == 1
+        r = await client.get("/api/v1/reflections/feed", headers=as_bob)
+        assert [item["id"] for item in r.json()["items"]] == [reflection_id]
+
+        r = await client.post("/api/v1/users/friends", headers=as_bob, json={"email": alice["email"]})
+        assert r.status_code == 200
+        r = await client.get("/api/v1/users/friends", headers=as_bob)
+        assert [friend["id"] for friend in r.json()["items"]] == [alice["id"]]
+        assert "hashed_password" not in r.json()["items"][0]
+
+        r = await client.delete(f"/api/v1/reflections/{reflection_id}", headers=as_alice)
+        assert r.status_code == 204
+        r = await client.get("/api/v1/reflections/feed", headers=as_bob)
+        assert r.json()["items"] == []
+
+    asyncio.run(_client_session(scenario))
+
+
+def test_signup_cannot_forge_herd_membership(memory_store):
+    tag = uuid.uuid4().hex[:8]
+
+    async def scenario(client: httpx.AsyncClient):
+        alice, as_alice = await _signup(client, f"alice-{tag}@example.com")
+        herd_id = (await client.post("/api/v1/herds/", headers=as_alice, json={"name": "private"})).json()["id"]
+        r = await client.post("/api/v1/reflections/", headers=as_alice, json={
+            "high": "secret", "low": "l", "buffalo": "b", "sharedHerds": [herd_id],
+        })
+        reflection_id = r.json()["id"]
+
+        email = f"mallory-{tag}@example.com"
+        r = await client.post("/api/v1/auth/signup", json={
+            "email": email, "password": "secret123", "settings": {"herds": [herd_id]},
+        })
+        assert r.status_code == 200 and r.json()["settings"]["herds"] == []
+        token = await client.post("/api/v1/auth/token", data={"username": email, "password": "secret123"})
+        as_mallory = {"Authorization": f"Bearer {token.json()['access_token']}"}
+
+        assert (await client.get(f"/api/v1/herds/{herd_id}", headers=as_mallory)).status_code == 403
+        assert (await client.get(f"/api/v1/herds/{herd_id}/members", headers=as_mallory)).status_code == 403
+        assert (await client.get("/api/v1/herds/", headers=as_mallory)).json()["items"] == []
+        r = await client.post(f"/api/v1/reflections/{reflection_id}/react", headers=as_mallory, json={"type": "curious"})
+        assert r.status_code == 403
+
+    asyncio.run(_client_session(scenario))
+
+
+def test_me_is_not_revalidated_from_a_stale_cache(memory_store):
+    tag = uuid.uuid4().hex[:8]
+
+    async def scenario(client: httpx.AsyncClient):
+        alice, as_alice = await _signup(client, f"alice-{tag}@example.com")
+        r = await client.get("/api/v1/users/me", headers=as_alice)
+        etag = r.headers["etag"]
+        assert (await client.get("/api/v1/users/me", headers={**as_alice, "If-None-Match": etag})).status_code == 304
+
+        # Written by another worker: this one's cached copy hasn't been invalidated yet
+        await store.users.update_profile(alice["id"], {"full_name": "Alice"})
+        r = await client.get("/api/v1/users/me", headers={**as_alice, "If-None-Match": etag})
+        assert r.status_code == 200 and r.json()["full_name"] == "Alice"
+        assert r.headers["etag"] != etag
+
+    asyncio.run(_client_session(scenario))
+
+
+def test_images_are_served_to_their_readers_only(memory_store, monkeypatch, tmp_path):
+    from blobstore import LocalBlobStore
+    import routers.images
+    import routers.reflections
+
+    blobs = LocalBlobStore(str(tmp_path))
+    monkeypatch.setattr(routers.images, "blob_store", blobs)
+    monkeypatch.setattr(routers.reflections, "blob_store", blobs)
+    tag = uuid.uuid4().hex[:8]
+
+    async def scenario(client: httpx.AsyncClient):
+        alice, as_alice = await _signup(client, f"alice-{tag}@example.com")
+        bob, as_bob = await _signup(client, f"bob-{tag}@example.com")
+        carol, as_carol = await _signup(client, f"carol-{tag}@example.com")
+        image = await blobs.put_bytes(b"pixels", "image/png", owner_id=alice["id"])
+        url = f"/api/v1/images/{image.id}"
+
+        assert (await client.get(url)).status_code == 401
+        r = await client.get(url, headers=as_alice)
+        assert r.status_code == 200 and r.content == b"pixels"
+        assert r.headers["cache-control"].startswith("private")
+        assert (await client.get(url, headers=as_bob)).status_code == 404
+
+        # Someone else's upload can't be attached to a reflection
+        r = await client.post("/api/v1/reflections/", headers=as_bob, json={
+            "high": "h", "low": "l", "buffalo": "b", "image_id": image.id,
+        })
+        assert r.status_code == 400
+
+        r = await client.post("/api/v1/reflections/", headers=as_alice, json={
+            "high": "h", "low": "l", "buffalo": "b", "image_id": image.id, "sharedWith": [bob["id"]],
+        })
+        assert r.status_code == 201
+        # <img> can't send headers: the token comes in the query string
+        token = as_bob["Authorization"].split()[1]
+        assert (await client.get(url, params={"access_token": token})).status_code == 200
+        assert (await client.get(url, headers=as_carol)).status_code == 404
+
+        # Uploading the same bytes makes Carol an owner of the stored blob too
+        assert (await blobs.put_bytes(b"pixels", "image/png", owner_id=carol["id"])).id == image.id
+        assert (await client.get(url, headers=as_carol)).status_code == 200
+
+    asyncio.run(_client_session(scenario))
+
+
+def test_thumbnails_run_on_the_memory_engine(memory_store, monkeypatch, tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    from io import BytesIO
+
+    from PIL import Image
+
+    from blobstore import LocalBlobStore
+    import routers.images
+    from thumbnails import pipeline
+
+    blobs = LocalBlobStore(str(tmp_path))
+    monkeypatch.setattr(routers.images, "blob_store", blobs)
+    monkeypatch.setattr(pipeline, "store", blobs)
+    # Threads instead of spawned processes keep the test quick; shutdown() closes it
+    monkeypatch.setattr(pipeline, "_executor", ThreadPoolExecutor(1))
+    photo = BytesIO()
+    Image.new("RGB", (640, 480), "orange").save(photo, "JPEG")
+
+    async def scenario(client: httpx.AsyncClient):
+        _, as_alice = await _signup(client, f"alice-{uuid.uuid4().hex[:8]}@example.com")
+        r = await client.post("/api/v1/images/", headers=as_alice, files={"file": ("photo.jpg", photo.getvalue(), "image/jpeg")})
+        assert r.status_code == 201, r.text
+        url = f"/api/v1/images/{r.json()['id']}"
+        await pipeline.drain()
+
+        r = await client.get(url, headers={**as_alice, "Accept": "image/webp"}, params={"size": "sm"})
+        assert r.status_code == 200 and r.headers["content-type"] == "image/webp"
+        assert Image.open(BytesIO(r.content)).width == 320
+
+    asyncio.run(_client_session(scenario))
+
+
+def test_memory_engine_paginates_like_fetch_page(memory_store):
+    from pagination import PageParams
+
+    class Author:
+        def __init__(self, user: dict):
+            self.id, self.email, self.full_name = user["_id"], user["email"], None
+
+    async def scenario():
+        user = await store.users.create({"email": "pages@example.com", "hashed_password": "x", "settings": {}})
+        author = Author(user)
+        created = [await store.reflections.create(author, {"high": str(i), "low": "", "buffalo": ""}) for i in range(5)]
+
+        seen, cursor = [], None
+        while True:
+            page, cursor = await store.reflections.list_by_author(str(user["_id"]), PageParams(cursor=cursor, limit=2))
+            seen.extend(r["_id"] for r in page)
+            if cursor is None:
+                break
+        assert seen == [r["_id"] for r in reversed(created)]
+
+    asyncio.run(scenario())
+
+
+def test_round_trip_budgets_are_enforced(monkeypatch):
+    monkeypatch.setattr(storage, "ROUND_TRIP_BUDGETS", "strict")
+
+    @round_trips(1)
+    async def two_commands():
+        stats = metrics.current_request.get()
+        stats.count_command()
+        stats.count_command()
+
+    async def in_request():
+        token = metrics.current_request.set(metrics.RequestStats("/test"))
+        try:
+            await two_commands()
+        finally:
+            metrics.current_request.reset(token)
+
+    with pytest.raises(RoundTripBudgetExceeded):
+        asyncio.run(in_request())
+    assert two_commands.round_trip_budget == 1
@@ -0,0 +1,79 @@
+"""
+The thumbnail pipeline on the memory engine's variant index, with a
+stand-in blob store. No MongoDB needed. Run with:
+
+    python -m pytest test_thumbnails.py
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from types import SimpleNamespace
+
+from PIL import Image
+
+from storage.memory import MemoryEngine, MemoryImageVariantRepository
+from thumbnails import ThumbnailPipeline
+
+IMAGE_ID = "a" * 64
+
+
+class FailingVariants(MemoryImageVariantRepository):
+    async def mark_ready(self, image_id, variants):
+        raise ConnectionError("image_variants is unreachable")
+
+
+class Store:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+
+    async def put_bytes(self, data, content_type, owner_id=None):
+        if self.fail:
+            raise OSError("disk full")
+        return SimpleNamespace(id=f"{len(data):064x}")
+
+
+def _photo() -> bytes:
+    out = BytesIO()
+    Image.new("RGB", (64, 48), "orange").save(out, "JPEG")
+    return out.getvalue()
+
+
+def _process(store: Store, engine: MemoryEngine) -> ThumbnailPipeline:
+    pipeline = ThumbnailPipeline(store, engine)
+    # Threads instead of spawned processes keep the test quick
+    pipeline._executor = ThreadPoolExecutor(1)
+    pipeline.reserve()
+    try:
+        asyncio.run(pipeline._process(IMAGE_ID, _photo()))
+    finally:
+        pipeline._executor.shutdown()
+    return pipeline
+
+
+def test_variants_are_indexed_when_ready():
+    engine = MemoryEngine()
+    pipeline = _process(Store(), engine)
+    assert engine.data.image_variants[IMAGE_ID]["status"] == "ready"
+    assert pipeline.pending == 0
+    assert asyncio.run(pipeline.variant_id(IMAGE_ID, "sm", "image/webp"))
+    assert asyncio.run(pipeline.variant_id(IMAGE_ID, "xl")) is None
+
+
+def test_failures_after_rendering_mark_the_image_failed():
+    failing_index = MemoryEngine()
+    failing_index.image_variants = FailingVariants(failing_index.data)
+    for store, engine in [(Store(fail=True), MemoryEngine()), (Store(), failing_index)]:
+        pipeline = _process(store, engine)
+        assert engine.data.image_variants[IMAGE_ID]["status"] == "failed"
+        assert pipeline.pending == 0
+        assert asyncio.run(pipeline.variant_id(IMAGE_ID, "sm")) is None
+
+
+def test_the_pipeline_leaves_the_client_closed_until_used(monkeypatch):
+    import database
+    from storage.mongo import MongoEngine
+
+    connection = database.Mongo("mongodb://127.0.0.1:1")
+    monkeypatch.setattr(database, "mongo", connection)
+    ThumbnailPipeline(Store(), MongoEngine(database.db)).variants
+    assert connection._client is None
@@ -0,0 +1,198 @@
+"""
+Thumbnail pipeline for uploaded reflection images.
+
+After an image is stored, its bytes are handed to a ProcessPoolExecutor that
+decodes, resizes to the widths in imaging.THUMBNAIL_WIDTHS and re-encodes
+to WebP and JPEG, so the event loop never does image work. Each variant is
+stored in the blob store like any other image and indexed in the
+configured storage engine's ``image_variants`` repository (see
+storage/__init__.py), so the memory engine needs no MongoDB here either.
+
+The number of images queued or in flight is bounded by THUMBNAIL_QUEUE_SIZE;
+uploads beyond it are refused with PipelineSaturatedError (a 503 upstream).
+
+Run ``python thumbnails.py backfill`` to generate variants for images that
+were stored before the pipeline existed.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import imaging
+from blobstore import BlobStore, blob_store, get_blob_store
+from database import db
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", 2))
+THUMBNAIL_QUEUE_SIZE = int(os.getenv("THUMBNAIL_QUEUE_SIZE", 32))
+FEED_THUMBNAIL_SIZE = os.getenv("FEED_THUMBNAIL_SIZE", "md")
+
+
+class PipelineSaturatedError(RuntimeError):
+    pass
+
+
+def thumbnail_url(image_id: str, size: str = FEED_THUMBNAIL_SIZE) -> str:
+    return f"/api/v1/images/{image_id}?size={size}"
+
+
+class ThumbnailPipeline:
+    """
+    ``storage`` is anything with an ``image_variants`` repository: a storage
+    engine, or by default the configured ``storage.store``.
+    """
+
+    def __init__(self, store: BlobStore, storage=None, workers: int = THUMBNAIL_WORKERS, queue_size: int = THUMBNAIL_QUEUE_SIZE):
+        self.store = store
+        self.storage = storage
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pending = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def variants(self):
+        # Looked up on use: the store's engine can be swapped (storage.Storage.configure),
+        # and storage imports this module through timelines.py
+        if self.storage is None:
+            from storage import store
+            return store.image_variants
+        return self.storage.image_variants
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn keeps the workers free of the parent's Mongo client and event loop
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    def reserve(self):
+        """
+        Claims a queue slot before an upload is stored. Raises
+        PipelineSaturatedError if the queue is full.
+        """
+        if self.pending >= self.queue_size:
+            raise PipelineSaturatedError("Thumbnail queue is full")
+        self.pending += 1
+
+    def release(self):
+        self.pending -= 1
+
+    def submit(self, image_id: str, data: bytes):
+        """
+        Schedules variant generation for a stored image. The caller must
+        hold a slot from reserve(); it is released when the job finishes.
+        """
+        task = asyncio.create_task(self._process(image_id, data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, image_id: str, data: bytes):
+        try:
+            if await self.variants.is_ready(image_id):
+                return
+
+            loop = asyncio.get_running_loop()
+            # Rendering, storing the variants and indexing them can all fail;
+            # either way the image is left marked failed, not pending forever
+            try:
+                rendered = await loop.run_in_executor(self.executor, imaging.render_variants, data)
+                variants = {}
+                for name, encodings in rendered.items():
+                    variants[name] = {}
+                    for fmt, encoded in encodings.items():
+                        info = await self.store.put_bytes(encoded, imaging.OUTPUT_FORMATS[fmt][1])
+                        variants[name][fmt] = info.id
+
+                await self.variants.mark_ready(image_id, variants)
+            except Exception:
+                logger.exception("Failed to generate thumbnails for image %s", image_id)
+                await self._mark_failed(image_id)
+        finally:
+            self.release()
+
+    async def _mark_failed(self, image_id: str):
+        try:
+            await self.variants.mark_failed(image_id)
+        except Exception:
+            # Typically the same outage that failed the job; downloads fall back to the original
+            logger.exception("Failed to record thumbnail failure for image %s", image_id)
+
+    async def variant_id(self, image_id: str, size: str, accept: str = "") -> Optional[str]:
+        """
+        Returns the blob id of the requested variant, preferring WebP when
+        the client accepts it, or None if variants are not ready yet.
+        """
+        formats = await self.variants.get(image_id, size)
+        if not formats:
+            return None
+        if "image/webp" in accept and "webp" in formats:
+            return formats["webp"]
+        return formats.get("jpeg")
+
+    async def drain(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def shutdown(self):
+        await self.drain()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+pipeline = ThumbnailPipeline(blob_store)
+
+
+async def backfill(database=db) -> int:
+    """
+    Renders variants for every image referenced by a reflection that has none yet.
+    """
+    from storage.mongo import MongoEngine
+
+    store = get_blob_store(database)
+    backfill_pipeline = ThumbnailPipeline(store, MongoEngine(database))
+    done = {doc["_id"] async for doc in database.image_variants.find({"status": "ready"}, {"_id": 1})}
+    image_ids = await database.reflections.distinct("image_id", {"image_id": {"$type": "string"}})
+
+    queued = 0
+    for image_id in image_ids:
+        if image_id in done:
+            continue
+        info = await store.stat(image_id)
+        if info is None:
+            continue
+        data = b"".join([chunk async for chunk in store.iter_range(image_id, 0, info.length - 1)])
+
+        # Wait for a free slot rather than failing like an upload would
+        while backfill_pipeline.pending >= backfill_pipeline.queue_size:
+            await asyncio.sleep(0.05)
+        backfill_pipeline.reserve()
+        backfill_pipeline.submit(image_id, data)
+        queued += 1
+
+    await backfill_pipeline.shutdown()
+    return queued
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Manage image thumbnails.")
+    parser.add_argument("command", choices=["backfill"])
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        count = await backfill()
+        print(f"Rendered thumbnails for {count} images")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,256 @@
+"""
+Fan-out-on-write feed timelines.
+
+Every reflection shared with a user (directly or through one of their herds)
+gets a copy in that user's timeline in the ``timelines`` collection. Reading
+the feed is then a single indexed range scan on (recipient_id, timestamp)
+instead of an aggregation over every reflection in the database.
+
+Every function here that changes timeline entries bumps the ``feed``
+version of the recipients afterwards (see versions.py), which is what lets
+GET /reflections/feed answer If-None-Match without reading the timeline.
+
+Run ``python timelines.py rebuild`` to backfill timelines for existing data.
+The indexes it relies on are created by migrations.py.
+"""
+import argparse
+import asyncio
+from typing import Iterable, Optional
+
+from bson import ObjectId
+from pymongo import DeleteMany, UpdateOne
+
+from database import db
+import herd_index
+import versions
+from thumbnails import thumbnail_url
+
+
+def _valid_user_ids(ids: Iterable[str]) -> set[str]:
+    # sharedWith can contain placeholders such as "self"; only real user ids get a timeline
+    return {i for i in ids if isinstance(i, str) and ObjectId.is_valid(i)}
+
+
+async def get_recipient_ids(reflection: dict) -> set[str]:
+    """
+    Returns the ids of every user who should see this reflection in their feed.
+    """
+    recipients = _valid_user_ids(reflection.get("sharedWith", []))
+
+    herd_ids = [h_id for h_id in reflection.get("sharedHerds", []) if ObjectId.is_valid(h_id)]
+    if herd_ids:
+        # Covered by the unique (herd_id, user_id) index
+        async for membership in db.herd_memberships.find(
+            {"herd_id": {"$in": herd_ids}}, {"_id": 0, "user_id": 1}
+        ):
+            recipients.add(membership["user_id"])
+
+    return recipients
+
+
+def _upsert_entry(recipient_id: str, reflection: dict, my_reactions: Optional[list[str]] = None) -> UpdateOne:
+    fields = {"timestamp": reflection["timestamp"], "item": reflection}
+    if my_reactions is not None:
+        fields["my_reactions"] = my_reactions
+    return UpdateOne(
+        {"recipient_id": recipient_id, "reflection_id": reflection["_id"]},
+        {"$set": fields},
+        upsert=True,
+    )
+
+
+def feed_item(entry: dict) -> dict:
+    """
+    The feed item for a timeline entry, as GET /reflections/feed and the
+    live feed events (see feed_events.py) return it.
+    """
+    item = {**entry["item"], "my_reactions": entry.get("my_reactions", [])}
+    if item.get("image_id"):
+        item["thumbnail_url"] = thumbnail_url(item["image_id"])
+    return item
+
+
+async def fan_out_reflection(reflection: dict, new: bool = False):
+    """
+    Makes the timelines match the reflection's current sharing settings:
+    adds or refreshes an entry for every recipient and removes the entries
+    of users it is no longer shared with. ``new`` reflections have no
+    entries to remove yet.
+    """
+    if new:
+        recipients, previous = await get_recipient_ids(reflection), []
+    else:
+        # Users dropped from the sharing settings lose their entry, so their feeds change too
+        recipients, previous = await asyncio.gather(
+            get_recipient_ids(reflection),
+            db.timelines.distinct("recipient_id", {"reflection_id": reflection["_id"]}),
+        )
+
+    ops = [] if new else [DeleteMany({"reflection_id": reflection["_id"], "recipient_id": {"$nin": list(recipients)}})]
+    ops.extend(_upsert_entry(recipient_id, reflection) for recipient_id in recipients)
+    if ops:
+        await db.timelines.bulk_write(ops, ordered=False)
+    await versions.bump(recipients | set(previous), "feed")
+
+
+async def bump_readers(reflection_id: ObjectId):
+    """
+    Bumps the feed version of everyone holding an entry for the reflection.
+    """
+    await versions.bump_matching(db.timelines, {"reflection_id": reflection_id}, "recipient_id", "feed")
+
+
+async def refresh_reflection(reflection: dict):
+    """
+    Rewrites the copy held in existing timeline entries after a change
+    that does not affect who the reflection is shared with.
+    """
+    await db.timelines.update_many(
+        {"reflection_id": reflection["_id"]},
+        {"$set": {"timestamp": reflection["timestamp"], "item": reflection}},
+    )
+    await bump_readers(reflection["_id"])
+
+
+async def record_reaction(reflection: dict, user_id: str, reaction_type: str, added: bool):
+    """
+    Refreshes the timeline copies after a reaction toggle and updates the
+    reacting user's own ``my_reactions`` flag, all in one update.
+    """
+    mine = {"$ifNull": ["$my_reactions", []]}
+    toggled = {"$setUnion": [mine, [reaction_type]]} if added else {"$setDifference": [mine, [reaction_type]]}
+    await db.timelines.update_many(
+        {"reflection_id": reflection["_id"]},
+        [{"$set": {
+            "timestamp": reflection["timestamp"],
+            # $literal: reflection text must never be evaluated as an expression
+            "item": {"$literal": reflection},
+            "my_reactions": {"$cond": [{"$eq": ["$recipient_id", user_id]}, toggled, mine]},
+        }}],
+    )
+    await bump_readers(reflection["_id"])
+
+
+async def _reactions_by_user(reflection_id: ObjectId) -> dict[str, list[str]]:
+    by_user: dict[str, list[str]] = {}
+    async for reaction in db.reactions.find({"reflection_id": reflection_id}, {"_id": 0, "user_id": 1, "type": 1}):
+        by_user.setdefault(reaction["user_id"], []).append(reaction["type"])
+    return by_user
+
+
+async def remove_reflection(reflection_id: ObjectId):
+    # The readers are gone with their entries, so collect them first
+    readers = await db.timelines.distinct("recipient_id", {"reflection_id": reflection_id})
+    if readers:
+        await db.timelines.delete_many({"reflection_id": reflection_id})
+        await versions.bump(readers, "feed")
+
+
+async def grant_herd_access(herd_id: str, user_ids: Iterable[str]):
+    """
+    Backfills the timelines of users who just joined a herd with the
+    reflections already shared with that herd.
+    """
+    user_ids = _valid_user_ids(user_ids)
+    if not user_ids:
+        return
+
+    ops, granted = [], False
+    async for reflection in db.reflections.find({"sharedHerds": herd_id}):
+        ops.extend(_upsert_entry(user_id, reflection) for user_id in user_ids)
+        granted = True
+        if len(ops) >= 1000:
+            await db.timelines.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await db.timelines.bulk_write(ops, ordered=False)
+    if granted:
+        await versions.bump(user_ids, "feed")
+
+
+async def revoke_herd_access(herd_id: str, user_ids: Iterable[str]):
+    """
+    Removes reflections shared with a herd from the timelines of users who
+    left it, unless they can still see them directly or through another herd.
+    Must be called after the herd's member list and the users' herd index
+    have been updated.
+    """
+    user_ids = _valid_user_ids(user_ids)
+    if not user_ids:
+        return
+
+    herds_by_user = await herd_index.herd_ids_by_user(user_ids)
+    revoked_from = []
+    for user_id in user_ids:
+        remaining_herd_ids = [h for h in herds_by_user.get(user_id, []) if h != herd_id]
+
+        revoked = db.reflections.find(
+            {
+                "$and": [
+                    {"sharedHerds": herd_id},
+                    {"sharedHerds": {"$nin": remaining_herd_ids}},
+                    {"sharedWith": {"$ne": user_id}},
+                ]
+            },
+            {"_id": 1},
+        )
+        revoked_ids = [r["_id"] async for r in revoked]
+        if revoked_ids:
+            await db.timelines.delete_many({"recipient_id": user_id, "reflection_id": {"$in": revoked_ids}})
+            revoked_from.append(user_id)
+    await versions.bump(revoked_from, "feed")
+
+
+async def rebuild_timelines(user_id: Optional[str] = None) -> int:
+    """
+    Recomputes timelines from the reflections collection. With ``user_id``
+    only that user's timeline is rebuilt. Returns the number of reflections
+    processed.
+    """
+    if user_id:
+        herds_by_user = await herd_index.herd_ids_by_user([user_id])
+        query = {
+            "$or": [
+                {"sharedWith": user_id},
+                {"sharedHerds": {"$in": herds_by_user.get(user_id, [])}},
+            ]
+        }
+        await db.timelines.delete_many({"recipient_id": user_id})
+    else:
+        query = {}
+        await db.timelines.delete_many({})
+
+    processed = 0
+    async for reflection in db.reflections.find(query):
+        recipients = await get_recipient_ids(reflection)
+        if user_id:
+            recipients &= {user_id}
+        if recipients:
+            reactions = await _reactions_by_user(reflection["_id"])
+            await db.timelines.bulk_write(
+                [_upsert_entry(r, reflection, reactions.get(r, [])) for r in recipients],
+                ordered=False,
+            )
+        processed += 1
+    if user_id:
+        await versions.bump([user_id], "feed")
+    else:
+        # Including users whose timeline is now empty
+        await versions.bump_matching(db.users, {}, "_id", "feed")
+    return processed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Manage precomputed feed timelines.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild = subparsers.add_parser("rebuild", help="Backfill timelines from existing reflections")
+    rebuild.add_argument("--user", help="Only rebuild the timeline of this user id")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        processed = await rebuild_timelines(args.user)
+        print(f"Rebuilt timelines from {processed} reflections")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
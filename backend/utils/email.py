@@ -0,0 +1,127 @@
+"""
+Pluggable email senders for reminders.
+
+EMAIL_SENDER selects the implementation:
+
+- ``smtp``: deliver through SMTP_HOST:SMTP_PORT. For local debugging point
+  it at ``python -m aiosmtpd -n -l localhost:1025`` (the default port).
+- ``file``: append one JSON line per message to EMAIL_SINK_FILE.
+- ``log``: only log the message (the default when SMTP_HOST is unset).
+"""
+import asyncio
+import json
+import logging
+import os
+import smtplib
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from email.message import EmailMessage
+
+logger = logging.getLogger(__name__)
+
+SMTP_HOST = os.getenv("SMTP_HOST")
+SMTP_PORT = int(os.getenv("SMTP_PORT", 1025))
+SMTP_USER = os.getenv("SMTP_USER")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "false").lower() == "true"
+EMAILS_FROM_EMAIL = os.getenv("EMAILS_FROM_EMAIL", "noreply@highlowbuffalo.com")
+EMAIL_SINK_FILE = os.getenv("EMAIL_SINK_FILE", "sent_emails.jsonl")
+EMAIL_SENDER = os.getenv("EMAIL_SENDER", "smtp" if SMTP_HOST else "log")
+
+
+class EmailSender(ABC):
+    @abstractmethod
+    async def send(self, to: str, subject: str, body: str):
+        """Sends one message. Raises on failure."""
+
+    async def close(self):
+        pass
+
+
+class LogSender(EmailSender):
+    async def send(self, to, subject, body):
+        logger.info("Email to %s: %s", to, subject)
+
+
+class FileSender(EmailSender):
+    def __init__(self, path: str = EMAIL_SINK_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _append(self, line: str):
+        with self._lock, open(self.path, "a") as f:
+            f.write(line + "\n")
+
+    async def send(self, to, subject, body):
+        line = json.dumps({
+            "to": to,
+            "subject": subject,
+            "body": body,
+            "sent_at": datetime.now(timezone.utc).isoformat(),
+        })
+        await asyncio.to_thread(self._append, line)
+
+
+class SMTPSender(EmailSender):
+    """
+    smtplib is blocking, so each send runs in a thread. Connections are
+    kept open and reused, one per thread, instead of reconnecting for every
+    message.
+    """
+
+    def __init__(self, host: str = SMTP_HOST or "localhost", port: int = SMTP_PORT):
+        self.host = host
+        self.port = port
+        self._local = threading.local()
+        self._connections: list[smtplib.SMTP] = []
+        self._connections_lock = threading.Lock()
+
+    def _connection(self) -> smtplib.SMTP:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = smtplib.SMTP(self.host, self.port, timeout=30)
+            if SMTP_STARTTLS:
+                conn.starttls()
+            if SMTP_USER and SMTP_PASSWORD:
+                conn.login(SMTP_USER, SMTP_PASSWORD)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _send(self, message: EmailMessage):
+        try:
+            self._connection().send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            # Stale pooled connection: reconnect once
+            self._local.conn = None
+            self._connection().send_message(message)
+
+    async def send(self, to, subject, body):
+        message = EmailMessage()
+        message["From"] = EMAILS_FROM_EMAIL
+        message["To"] = to
+        message["Subject"] = subject
+        message.set_content(body)
+        await asyncio.to_thread(self._send, message)
+
+    def _close_all(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                try:
+                    conn.quit()
+                except smtplib.SMTPException:
+                    pass
+            self._connections.clear()
+
+    async def close(self):
+        await asyncio.to_thread(self._close_all)
+
+
+def get_sender(kind: str = EMAIL_SENDER) -> EmailSender:
+    if kind == "smtp":
+        return SMTPSender()
+    if kind == "file":
+        return FileSender()
+    return LogSender()
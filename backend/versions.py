@@ -0,0 +1,103 @@
+"""
+Per-user version counters for conditional GETs.
+
+``user_versions`` holds one document per user with a counter per cached
+resource:
+
+- ``feed``: the user's timeline. Bumped by timelines.py (and authors.py)
+  for every recipient whose entries change.
+- ``herds``: GET /herds/. Bumped for every member of a herd that is
+  created, renamed, deleted or gains or loses a member.
+- ``friends``: GET /users/friends. Bumped when the user's friend list
+  changes, and for every user who lists someone as a friend when that
+  someone's user document changes (see ``bump_followers``).
+
+deps.conditional_get turns a counter into a weak ETag, so answering
+If-None-Match costs one ``_id`` lookup instead of the underlying query.
+Counters only ever grow and a missing document reads as 0.
+
+Bumps must run *after* the write they cover. A read that lands between the
+write and the bump then pairs new content with the old version, which only
+costs the client one extra full response. A bump before the write could
+pair old content with the new version and serve it stale until the next
+bump. For the same reason, history reads routed to a secondary share a
+causally consistent session with the version lookup (see database.py).
+"""
+import hashlib
+import os
+from typing import Iterable
+
+from pymongo import UpdateOne
+
+from database import db
+
+SCOPES = ("feed", "herds", "friends")
+
+# Change to invalidate every ETag handed out so far, e.g. when a response schema changes
+ETAG_SALT = os.getenv("ETAG_SALT", "")
+
+
+async def get_version(user_id: str, scope: str, database=db, session=None) -> int:
+    doc = await database.user_versions.find_one({"_id": user_id}, {scope: 1}, session=session)
+    return (doc or {}).get(scope, 0)
+
+
+async def bump(user_ids: Iterable[str], *scopes: str, database=db):
+    """
+    Bumps ``scopes`` for each of ``user_ids`` in one round trip.
+    """
+    user_ids = {u for u in user_ids if u}
+    if not user_ids:
+        return
+    inc = {scope: 1 for scope in scopes}
+    await database.user_versions.bulk_write(
+        [UpdateOne({"_id": user_id}, {"$inc": inc}, upsert=True) for user_id in user_ids],
+        ordered=False,
+    )
+
+
+async def bump_matching(collection, query: dict, user_field: str, *scopes: str, database=db):
+    """
+    Bumps ``scopes`` for every user id found in ``user_field`` of the
+    documents in ``collection`` matching ``query``. Runs server-side in one
+    round trip, so callers don't have to read the ids first.
+    """
+    await collection.aggregate([
+        {"$match": {"$and": [query, {user_field: {"$ne": None}}]}},
+        {"$group": {"_id": {"$toString": f"${user_field}"}}},
+        {"$project": {scope: {"$literal": 1} for scope in scopes}},
+        {"$merge": {
+            "into": "user_versions",
+            "on": "_id",
+            "whenMatched": [{"$set": {scope: {"$add": [{"$ifNull": [f"${scope}", 0]}, 1]} for scope in scopes}}],
+            "whenNotMatched": "insert",
+        }},
+    ]).to_list(None)
+
+
+async def bump_followers(user_ids: Iterable[str], database=db):
+    """
+    Call after changing user documents: everyone who lists one of these
+    users as a friend gets a full GET /users/friends next time.
+    """
+    user_ids = [u for u in set(user_ids) if u]
+    if user_ids:
+        await bump_matching(database.users, {"settings.friends": {"$in": user_ids}}, "_id", "friends", database=database)
+
+
+def etag(user_id: str, scope: str, version, variant: str = "") -> str:
+    """
+    Weak ETag for a user's view of ``scope`` at ``version``. ``variant``
+    covers everything else the response depends on, such as the query
+    string of a paginated request.
+    """
+    digest = hashlib.blake2b(f"{user_id}|{variant}|{ETAG_SALT}".encode(), digest_size=6).hexdigest()
+    return f'W/"{scope}-{version}-{digest}"'
+
+
+def etag_matches(if_none_match: str, current: str) -> bool:
+    # If-None-Match uses weak comparison: W/ prefixes are ignored
+    if if_none_match.strip() == "*":
+        return True
+    strip = lambda tag: tag.strip().removeprefix("W/")
+    return strip(current) in {strip(tag) for tag in if_none_match.split(",")}
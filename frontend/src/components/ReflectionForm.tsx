@@ -5,7 +5,7 @@ import { Textarea } from '@/components/ui/textarea';
 import { Card, CardContent, CardDescription, CardHeader, CardTitle } from '@/components/ui/card';
 import { Label } from '@/components/ui/label';
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '@/components/ui/select';
-import { createReflection, getUser, getFriends, getHerds } from '@/lib/api';
+import { createReflection, getUser, getFriends, getHerds, uploadImage } from '@/lib/api';
 import { ReflectionCreate, UserSettings, Friend, Herd } from '@/types';
 import { showSuccess, showError } from '@/utils/toast';
 import { Frown, Smile, Sparkles, Loader2, Image as ImageIcon, X } from 'lucide-react';
@@ -14,7 +14,8 @@ const ReflectionForm = () => {
   const [high, setHigh] = useState('');
   const [low, setLow] = useState('');
   const [buffalo, setBuffalo] = useState('');
-  const [image, setImage] = useState<string | null>(null);
+  const [image, setImage] = useState<string | null>(null); // Local preview URL
+  const [imageFile, setImageFile] = useState<File | null>(null);
   const [sharedWith, setSharedWith] = useState<string>('self'); // 'self', 'friendId', 'herdId'
   const [userSettings, setUserSettings] = useState<UserSettings>({
     notificationCadence: 'daily',
@@ -48,16 +49,16 @@ const ReflectionForm = () => {
         showError("Image size must be less than 5MB");
         return;
       }
-      const reader = new FileReader();
-      reader.onloadend = () => {
-        setImage(reader.result as string);
-      };
-      reader.readAsDataURL(file);
+      if (image) URL.revokeObjectURL(image);
+      setImage(URL.createObjectURL(file));
+      setImageFile(file);
     }
   };
 
   const removeImage = () => {
+    if (image) URL.revokeObjectURL(image);
     setImage(null);
+    setImageFile(null);
   };
 
   const handleSubmit = async (e: React.FormEvent) => {
@@ -70,12 +71,15 @@ const ReflectionForm = () => {
 
     setIsSubmitting(true);
     try {
+      // Images are uploaded separately; the reflection only stores a reference
+      const uploadedImage = imageFile ? await uploadImage(imageFile) : null;
+
       const newReflection: ReflectionCreate = {
         high: high.trim(),
         low: low.trim(),
         buffalo: buffalo.trim(),
         sharedWith: [sharedWith],
-        image: image || undefined,
+        image_id: uploadedImage?.id,
       };
 
       await createReflection(newReflection);
@@ -84,7 +88,7 @@ const ReflectionForm = () => {
       setHigh('');
       setLow('');
       setBuffalo('');
-      setImage(null);
+      removeImage();
       setSharedWith('self');
     } catch (error) {
       console.error("Failed to create reflection:", error);
@@ -0,0 +1,27 @@
+import * as React from "react";
+
+// Calls onLoadMore whenever the returned sentinel element scrolls into view.
+// Observers only report changes, so a sentinel still in view after a page loads
+// (a short page, a tall screen) would stall: the observer is recreated for each
+// cursor, and a new observer reports whether the sentinel is visible right away.
+export function useInfiniteScroll(onLoadMore: () => void, enabled: boolean, cursor?: string | null) {
+  const sentinelRef = React.useRef<HTMLDivElement | null>(null);
+  const onLoadMoreRef = React.useRef(onLoadMore);
+  onLoadMoreRef.current = onLoadMore;
+
+  React.useEffect(() => {
+    const sentinel = sentinelRef.current;
+    if (!enabled || !sentinel) return;
+
+    const observer = new IntersectionObserver(
+      (entries) => {
+        if (entries[0].isIntersecting) onLoadMoreRef.current();
+      },
+      { rootMargin: "200px" },
+    );
+    observer.observe(sentinel);
+    return () => observer.disconnect();
+  }, [enabled, cursor]);
+
+  return sentinelRef;
+}
@@ -1,5 +1,5 @@
-import axios from 'axios';
-import { Reflection, ReflectionCreate, ReflectionUpdate, User, UserSettings, Friend, Herd, HerdUpdate } from '@/types';
+import axios, { InternalAxiosRequestConfig } from 'axios';
+import { Reflection, ReflectionCreate, ReflectionUpdate, User, UserSettings, Friend, Herd, HerdMember, HerdUpdate, Page, UploadedImage, FeedEvent } from '@/types';
 
 const api = axios.create({
   baseURL: import.meta.env.PROD
@@ -15,13 +15,88 @@ api.interceptors.request.use((config) => {
   return config;
 });
 
+// Conditional GETs: the feed, herds, friends and /users/me answer with an ETag and
+// "Cache-Control: private, no-cache". We keep the last body per URL and token, send
+// If-None-Match, and reuse that body when the server says 304 Not Modified.
+type CachedResponse = { etag: string; data: unknown };
+const etagCache = new Map<string, CachedResponse>();
+const MAX_ETAG_ENTRIES = 100;
+
+const etagKey = (config: InternalAxiosRequestConfig): string | null => {
+  if ((config.method ?? 'get').toLowerCase() !== 'get') return null;
+  const params = new URLSearchParams();
+  Object.entries(config.params ?? {}).forEach(([key, value]) => {
+    if (value !== undefined && value !== null) params.append(key, String(value));
+  });
+  // From storage rather than the Authorization header: axios runs request interceptors
+  // last-registered first, so the header isn't set yet when the one below runs
+  return `${localStorage.getItem('token') ?? ''} ${config.url}?${params.toString()}`;
+};
+
+api.interceptors.request.use((config) => {
+  const key = etagKey(config);
+  const cached = key ? etagCache.get(key) : undefined;
+  if (cached) {
+    config.headers['If-None-Match'] = cached.etag;
+    // A 304 is a successful response here, not an error
+    config.validateStatus = (status) => (status >= 200 && status < 300) || status === 304;
+  }
+  return config;
+});
+
+api.interceptors.response.use((response) => {
+  const key = etagKey(response.config);
+  if (!key) {
+    // Writes change what the cached GETs would return; the server's ETags catch
+    // that too, but dropping our copies saves holding on to stale bodies
+    etagCache.clear();
+    return response;
+  }
+  if (response.status === 304) {
+    const cached = etagCache.get(key);
+    if (cached) return { ...response, status: 200, data: cached.data };
+    return response;
+  }
+  const etag = response.headers['etag'];
+  if (etag) {
+    etagCache.delete(key);
+    etagCache.set(key, { etag, data: response.data });
+    if (etagCache.size > MAX_ETAG_ENTRIES) {
+      // Maps iterate in insertion order: evict the oldest entry
+      etagCache.delete(etagCache.keys().next().value as string);
+    }
+  }
+  return response;
+});
+
 export default api;
 
-export const getReflections = async (): Promise<Reflection[]> => {
-  const response = await api.get<Reflection[]>('/reflections/');
+// List endpoints are cursor-paginated: pass the previous page's next_cursor to get the next one.
+const getPage = async <T>(url: string, cursor?: string | null, limit?: number): Promise<Page<T>> => {
+  const response = await api.get<Page<T>>(url, { params: { cursor: cursor || undefined, limit } });
   return response.data;
 };
 
+// Walks every page of a list endpoint. Only for small lists such as friends and herds.
+const getAllPages = async <T>(url: string): Promise<T[]> => {
+  const items: T[] = [];
+  let cursor: string | null = null;
+  do {
+    const page: Page<T> = await getPage<T>(url, cursor, 100);
+    items.push(...page.items);
+    cursor = page.next_cursor;
+  } while (cursor);
+  return items;
+};
+
+export const getReflections = async (cursor?: string | null, limit?: number): Promise<Page<Reflection>> => {
+  return getPage<Reflection>('/reflections/', cursor, limit);
+};
+
+export const getAllReflections = async (): Promise<Reflection[]> => {
+  return getAllPages<Reflection>('/reflections/');
+};
+
 export const createReflection = async (data: ReflectionCreate): Promise<Reflection> => {
   const response = await api.post<Reflection>('/reflections/', data);
   return response.data;
@@ -36,6 +111,27 @@ export const deleteReflection = async (id: string): Promise<void> => {
   await api.delete(`/reflections/${id}`);
 };
 
+export const uploadImage = async (file: File): Promise<UploadedImage> => {
+  const formData = new FormData();
+  formData.append('file', file);
+  const response = await api.post<UploadedImage>('/images/', formData);
+  return response.data;
+};
+
+export type ImageSize = 'sm' | 'md' | 'lg';
+
+// Images are only served to users who may see them, and <img> can't send headers either:
+// like the event stream, image URLs carry the token in the query string.
+// Resolves a server-relative path such as a feed item's thumbnail_url against the API host.
+export const resolveImageUrl = (path: string): string => {
+  const url = new URL(path, api.defaults.baseURL);
+  url.searchParams.set('access_token', localStorage.getItem('token') ?? '');
+  return url.toString();
+};
+
+export const imageUrl = (imageId: string, size?: ImageSize): string =>
+  resolveImageUrl(`${api.defaults.baseURL}/images/${imageId}${size ? `?size=${size}` : ''}`);
+
 export const getUser = async (): Promise<User> => {
   const response = await api.get<User>('/users/me');
   return response.data;
@@ -55,13 +151,24 @@ export const deleteFriend = async (friendId: string): Promise<void> => {
 };
 
 export const getFriends = async (): Promise<Friend[]> => {
-  const response = await api.get<Friend[]>('/users/friends');
-  return response.data;
+  return getAllPages<Friend>('/users/friends');
 };
 
-export const getFeed = async (): Promise<Reflection[]> => {
-  const response = await api.get<Reflection[]>('/reflections/feed');
-  return response.data;
+export const getFeed = async (cursor?: string | null, limit?: number): Promise<Page<Reflection>> => {
+  return getPage<Reflection>('/reflections/feed', cursor, limit);
+};
+
+// Live feed updates over Server-Sent Events. EventSource can't send headers, so the
+// token goes in the query string; it reconnects by itself and sends Last-Event-ID,
+// so the server replays whatever was missed meanwhile.
+export const subscribeToFeed = (onEvent: (event: FeedEvent) => void): (() => void) => {
+  const token = localStorage.getItem('token');
+  const url = `${api.defaults.baseURL}/reflections/feed/events?access_token=${encodeURIComponent(token ?? '')}`;
+  const source = new EventSource(url);
+  source.addEventListener('upsert', (e) => onEvent({ type: 'upsert', ...JSON.parse((e as MessageEvent).data) }));
+  source.addEventListener('remove', (e) => onEvent({ type: 'remove', ...JSON.parse((e as MessageEvent).data) }));
+  source.addEventListener('reset', () => onEvent({ type: 'reset' }));
+  return () => source.close();
 };
 
 export const reactToReflection = async (id: string, type: string): Promise<Reflection> => {
@@ -74,7 +181,7 @@ export const flagReflection = async (id: string): Promise<Reflection> => {
   return response.data;
 };
 
-export const getNotificationStatus = async (): Promise<{ reminder_needed: boolean; message: string }> => {
+export const getNotificationStatus = async (): Promise<{ reminder_needed: boolean; message: string; streak: number }> => {
   const response = await api.get('/notifications/status');
   return response.data;
 };
@@ -82,8 +189,7 @@ export const getNotificationStatus = async (): Promise<{ reminder_needed: boolea
 // Herds API
 
 export const getHerds = async (): Promise<Herd[]> => {
-  const response = await api.get<Herd[]>('/herds/');
-  return response.data;
+  return getAllPages<Herd>('/herds/');
 };
 
 export const createHerd = async (name: string, description?: string): Promise<Herd> => {
@@ -106,6 +212,10 @@ export const deleteHerd = async (id: string): Promise<void> => {
   return;
 };
 
+export const getHerdMembers = async (id: string, cursor?: string | null, limit?: number): Promise<Page<HerdMember>> => {
+  return getPage<HerdMember>(`/herds/${id}/members`, cursor, limit);
+};
+
 export const addHerdMember = async (id: string, email: string): Promise<void> => {
   await api.post(`/herds/${id}/members`, { email });
 };
@@ -1,27 +1,53 @@
 import React, { useEffect, useState } from 'react';
-import { getFeed, reactToReflection, getUser } from '@/lib/api';
-import { Reflection, User } from '@/types';
+import { getFeed, reactToReflection, imageUrl, resolveImageUrl, subscribeToFeed } from '@/lib/api';
+import { FeedEvent, Reflection } from '@/types';
 import { Card, CardContent, CardHeader, CardTitle } from '@/components/ui/card';
 import { Button } from '@/components/ui/button';
 import { format } from 'date-fns';
 import { Frown, Smile, Sparkles, Lightbulb, Loader2, Share2 } from 'lucide-react';
 import { showSuccess, showError } from '@/utils/toast';
+import { useInfiniteScroll } from '@/hooks/use-infinite-scroll';
+
+// Replaces the reflection if it is loaded, otherwise inserts it in timestamp order.
+// Older ones than the last loaded reflection arrive with the next page instead.
+const upsertByTimestamp = (reflections: Reflection[], item: Reflection): Reflection[] => {
+  if (reflections.some(r => r.id === item.id)) {
+    return reflections.map(r => r.id === item.id ? item : r);
+  }
+  const index = reflections.findIndex(r => r.timestamp < item.timestamp);
+  if (index === -1) return reflections.length === 0 ? [item] : reflections;
+  return [...reflections.slice(0, index), item, ...reflections.slice(index)];
+};
 
 const Feed = () => {
   const [reflections, setReflections] = useState<Reflection[]>([]);
-  const [currentUser, setCurrentUser] = useState<User | null>(null);
   const [isLoading, setIsLoading] = useState(true);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [isLoadingMore, setIsLoadingMore] = useState(false);
 
   useEffect(() => {
     loadData();
   }, []);
 
+  // Apply pushed changes in place instead of refetching the feed
+  useEffect(() => {
+    return subscribeToFeed((event: FeedEvent) => {
+      if (event.type === 'reset') {
+        loadData();
+      } else if (event.type === 'remove') {
+        setReflections(prev => prev.filter(r => r.id !== event.reflection_id));
+      } else {
+        setReflections(prev => upsertByTimestamp(prev, event.item));
+      }
+    });
+  }, []);
+
   const loadData = async () => {
     setIsLoading(true);
     try {
-      const [feedData, userData] = await Promise.all([getFeed(), getUser()]);
-      setReflections(feedData.sort((a, b) => new Date(b.timestamp).getTime() - new Date(a.timestamp).getTime()));
-      setCurrentUser(userData);
+      const feedPage = await getFeed();
+      setReflections(feedPage.items);
+      setNextCursor(feedPage.next_cursor);
     } catch (error) {
       console.error("Failed to load feed:", error);
       showError("Failed to load feed.");
@@ -30,10 +56,27 @@ const Feed = () => {
     }
   };
 
+  const loadMore = async () => {
+    if (!nextCursor || isLoadingMore) return;
+    setIsLoadingMore(true);
+    try {
+      const feedPage = await getFeed(nextCursor);
+      setReflections(prev => [...prev, ...feedPage.items]);
+      setNextCursor(feedPage.next_cursor);
+    } catch (error) {
+      console.error("Failed to load more of the feed:", error);
+      showError("Failed to load more reflections.");
+    } finally {
+      setIsLoadingMore(false);
+    }
+  };
+
+  const sentinelRef = useInfiniteScroll(loadMore, !isLoading && !!nextCursor, nextCursor);
+
   const handleReact = async (reflectionId: string) => {
     try {
       const updatedReflection = await reactToReflection(reflectionId, 'curious');
-      setReflections(prev => prev.map(r => r.id === reflectionId ? updatedReflection : r));
+      setReflections(prev => prev.map(r => r.id === reflectionId ? { ...r, ...updatedReflection } : r));
     } catch (error) {
       console.error("Failed to react:", error);
       showError("Failed to update reaction.");
@@ -60,13 +103,11 @@ const Feed = () => {
   };
 
   const getReactionCount = (reflection: Reflection) => {
-     if (!reflection.curiosityReactions) return 0;
-     return Object.values(reflection.curiosityReactions).reduce((acc, userIds) => acc + userIds.length, 0);
+     return Object.values(reflection.reaction_counts || {}).reduce((acc, count) => acc + count, 0);
   };
 
   const hasUserReacted = (reflection: Reflection) => {
-    if (!currentUser || !reflection.curiosityReactions) return false;
-    return Object.values(reflection.curiosityReactions).some(userIds => userIds.includes(currentUser.id));
+    return (reflection.my_reactions || []).length > 0;
   };
 
   return (
@@ -93,10 +134,10 @@ const Feed = () => {
                 </p>
               </CardHeader>
               <CardContent className="flex-1 flex flex-col gap-4">
-                {reflection.image && (
+                {reflection.image_id && (
                   <div className="mb-2">
                     <img
-                      src={reflection.image}
+                      src={reflection.thumbnail_url ? resolveImageUrl(reflection.thumbnail_url) : imageUrl(reflection.image_id, 'md')}
                       alt="Reflection attachment"
                       className="rounded-md w-full object-cover max-h-64"
                     />
@@ -146,6 +187,13 @@ const Feed = () => {
           ))}
         </div>
       )}
+
+      <div ref={sentinelRef} />
+      {isLoadingMore && (
+        <div className="flex justify-center p-4">
+          <Loader2 className="h-6 w-6 animate-spin" />
+        </div>
+      )}
     </div>
   );
 };
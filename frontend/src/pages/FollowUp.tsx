@@ -1,5 +1,5 @@
 import React, { useEffect, useState } from 'react';
-import { getReflections, updateReflection, getUser, getFriends, getHerds } from '@/lib/api';
+import { getAllReflections, updateReflection, getUser, getFriends, getHerds } from '@/lib/api';
 import { Reflection, UserSettings, Friend, Herd } from '@/types';
 import { Card, CardContent, CardHeader, CardTitle, CardDescription } from '@/components/ui/card';
 import { Badge } from '@/components/ui/badge';
@@ -29,9 +29,9 @@ const FollowUp = () => {
   const loadFollowUpReflections = async () => {
     setIsLoading(true);
     try {
-      const allStoredReflections = await getReflections();
+      const allStoredReflections = await getAllReflections();
       const filtered = allStoredReflections
-        .filter(r => r.isFlaggedForFollowUp || Object.values(r.curiosityReactions).reduce((sum, userIds) => sum + userIds.length, 0) > 0)
+        .filter(r => r.isFlaggedForFollowUp || Object.values(r.reaction_counts || {}).reduce((sum, count) => sum + count, 0) > 0)
         .sort((a, b) => new Date(b.timestamp).getTime() - new Date(a.timestamp).getTime());
       setFollowUpReflections(filtered);
     } catch (error) {
@@ -122,10 +122,10 @@ const FollowUp = () => {
                 </div>
                 <div className="mt-auto flex justify-between items-center pt-4 border-t">
                   <div className="flex gap-2">
-                    {Object.values(reflection.curiosityReactions).reduce((sum, userIds) => sum + userIds.length, 0) > 0 && (
+                    {Object.values(reflection.reaction_counts || {}).reduce((sum, count) => sum + count, 0) > 0 && (
                       <span className="text-sm text-muted-foreground flex items-center">
                         <Lightbulb className="h-4 w-4 mr-1" />
-                        {Object.values(reflection.curiosityReactions).reduce((sum, userIds) => sum + userIds.length, 0)} taps
+                        {Object.values(reflection.reaction_counts || {}).reduce((sum, count) => sum + count, 0)} taps
                       </span>
                     )}
                     <Button
@@ -1,5 +1,5 @@
 import React, { useEffect, useState } from 'react';
-import { getReflections, updateReflection, deleteReflection, getUser, flagReflection, getFriends, getHerds } from '@/lib/api';
+import { getReflections, updateReflection, deleteReflection, getUser, flagReflection, getFriends, getHerds, imageUrl } from '@/lib/api';
 import { Reflection, UserSettings, ReflectionUpdate, Friend, Herd } from '@/types';
 import { Card, CardContent, CardHeader, CardTitle } from '@/components/ui/card';
 import { Badge } from '@/components/ui/badge';
@@ -11,6 +11,7 @@ import { format } from 'date-fns';
 import { Frown, Smile, Sparkles, Flag, Lightbulb, Edit, Trash2, Loader2, Share2 } from 'lucide-react';
 import { showSuccess, showError } from '@/utils/toast';
 import EditReflectionDialog from '@/components/EditReflectionDialog'; // Import the new component
+import { useInfiniteScroll } from '@/hooks/use-infinite-scroll';
 
 const History = () => {
   const [allReflections, setAllReflections] = useState<Reflection[]>([]);
@@ -22,6 +23,8 @@ const History = () => {
   const [herdsList, setHerdsList] = useState<Herd[]>([]);
   const [filterBy, setFilterBy] = useState<string>('all'); // 'all', 'self', friendId, herdId
   const [isLoading, setIsLoading] = useState(true);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [isLoadingMore, setIsLoadingMore] = useState(false);
 
   const [isEditDialogOpen, setIsEditDialogOpen] = useState(false);
   const [reflectionToEdit, setReflectionToEdit] = useState<Reflection | null>(null);
@@ -48,8 +51,9 @@ const History = () => {
   const loadReflections = async () => {
     setIsLoading(true);
     try {
-      const storedReflections = await getReflections();
-      setAllReflections(storedReflections.sort((a, b) => new Date(b.timestamp).getTime() - new Date(a.timestamp).getTime()));
+      const page = await getReflections();
+      setAllReflections(page.items);
+      setNextCursor(page.next_cursor);
     } catch (error) {
       console.error("Failed to load reflections:", error);
       showError("Failed to load reflections.");
@@ -58,6 +62,23 @@ const History = () => {
     }
   };
 
+  const loadMoreReflections = async () => {
+    if (!nextCursor || isLoadingMore) return;
+    setIsLoadingMore(true);
+    try {
+      const page = await getReflections(nextCursor);
+      setAllReflections(prev => [...prev, ...page.items]);
+      setNextCursor(page.next_cursor);
+    } catch (error) {
+      console.error("Failed to load more reflections:", error);
+      showError("Failed to load more reflections.");
+    } finally {
+      setIsLoadingMore(false);
+    }
+  };
+
+  const sentinelRef = useInfiniteScroll(loadMoreReflections, !isLoading && !!nextCursor, nextCursor);
+
   const handleFlagForFollowUp = async (reflectionId: string) => {
     const reflection = allReflections.find(r => r.id === reflectionId);
     if (!reflection) return;
@@ -181,10 +202,10 @@ const History = () => {
                 </p>
               </CardHeader>
               <CardContent className="flex-1 flex flex-col gap-4">
-                {reflection.image && (
+                {reflection.image_id && (
                   <div className="mb-2">
                     <img
-                      src={reflection.image}
+                      src={imageUrl(reflection.image_id, 'md')}
                       alt="Reflection attachment"
                       className="rounded-md w-full object-cover max-h-64"
                     />
@@ -219,10 +240,10 @@ const History = () => {
                     >
                       <Share2 className="h-4 w-4" />
                     </Button>
-                    {Object.values(reflection.curiosityReactions).reduce((sum, userIds) => sum + userIds.length, 0) > 0 && (
+                    {Object.values(reflection.reaction_counts || {}).reduce((sum, count) => sum + count, 0) > 0 && (
                       <span className="text-sm text-muted-foreground flex items-center">
                         <Lightbulb className="h-4 w-4 mr-1" />
-                        {Object.values(reflection.curiosityReactions).reduce((sum, userIds) => sum + userIds.length, 0)} taps
+                        {Object.values(reflection.reaction_counts || {}).reduce((sum, count) => sum + count, 0)} taps
                       </span>
                     )}
                     <Button
@@ -268,6 +289,13 @@ const History = () => {
         </div>
       )}
 
+      <div ref={sentinelRef} />
+      {isLoadingMore && (
+        <div className="flex justify-center p-4">
+          <Loader2 className="h-6 w-6 animate-spin" />
+        </div>
+      )}
+
       {reflectionToEdit && (
         <EditReflectionDialog
           reflection={reflectionToEdit}
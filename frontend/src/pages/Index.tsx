@@ -28,9 +28,9 @@ const Index = () => {
   const fetchReflections = async () => {
     setIsLoading(true);
     try {
-      const data = await getReflections();
       // Show only the most recent 3 reflections on the home page
-      setReflections(data.sort((a, b) => new Date(b.timestamp).getTime() - new Date(a.timestamp).getTime()).slice(0, 3));
+      const page = await getReflections(null, 3);
+      setReflections(page.items);
     } catch (error) {
       console.error("Failed to fetch reflections:", error);
     } finally {
@@ -159,9 +159,9 @@ const Index = () => {
                         Flag
                       </Button>
                     </div>
-                    {(reflection.curiosityReactions['curious']?.length || 0) > 0 && (
+                    {(reflection.reaction_counts?.['curious'] || 0) > 0 && (
                       <span className="text-sm text-muted-foreground">
-                        {reflection.curiosityReactions['curious']?.length || 0} taps
+                        {reflection.reaction_counts?.['curious'] || 0} taps
                       </span>
                     )}
                   </div>
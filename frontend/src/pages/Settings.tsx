@@ -10,9 +10,10 @@ import {
   deleteHerd,
   addHerdMember,
   removeHerdMember,
+  getHerdMembers,
   updateHerd
 } from '@/lib/api';
-import { UserSettings, Herd, Friend, User } from '@/types';
+import { UserSettings, Herd, HerdMember, Friend, User } from '@/types';
 import { Card, CardContent, CardDescription, CardHeader, CardTitle } from '@/components/ui/card';
 import { Label } from '@/components/ui/label';
 import { RadioGroup, RadioGroupItem } from '@/components/ui/radio-group';
@@ -36,6 +37,8 @@ const Settings = () => {
   const [newHerdName, setNewHerdName] = useState('');
   const [selectedHerd, setSelectedHerd] = useState<Herd | null>(null);
   const [newMemberEmail, setNewMemberEmail] = useState('');
+  const [members, setMembers] = useState<HerdMember[]>([]);
+  const [membersCursor, setMembersCursor] = useState<string | null>(null);
 
   useEffect(() => {
     const fetchData = async () => {
@@ -103,6 +106,25 @@ const Settings = () => {
 
   // --- HERD MANAGMENT ---
 
+  // Members are paginated: large herds can have thousands
+  const loadMembers = async (herdId: string, cursor: string | null = null) => {
+    try {
+      const page = await getHerdMembers(herdId, cursor);
+      setMembers(prev => (cursor ? [...prev, ...page.items] : page.items));
+      setMembersCursor(page.next_cursor);
+    } catch (error) {
+      console.error('Failed to load herd members:', error);
+    }
+  };
+
+  useEffect(() => {
+    setMembers([]);
+    setMembersCursor(null);
+    if (selectedHerd) {
+      loadMembers(selectedHerd.id);
+    }
+  }, [selectedHerd?.id]);
+
   const refreshHerds = async () => {
     const herds = await getHerds();
     setHerdsList(herds);
@@ -149,6 +171,7 @@ const Settings = () => {
     try {
       await addHerdMember(selectedHerd.id, newMemberEmail.trim());
       await refreshHerds();
+      await loadMembers(selectedHerd.id);
       setNewMemberEmail('');
       showSuccess('Member invited.');
     } catch (error) {
@@ -163,6 +186,7 @@ const Settings = () => {
     try {
       await removeHerdMember(selectedHerd.id, userId);
       await refreshHerds();
+      await loadMembers(selectedHerd.id);
       showSuccess('Member removed.');
     } catch (error) {
       console.error('Failed to remove member:', error);
@@ -184,7 +208,7 @@ const Settings = () => {
     }
   };
   
-  const isOwner = selectedHerd && currentUser && selectedHerd.created_by === currentUser.id;
+  const isOwner = selectedHerd && currentUser && selectedHerd.owner_id === currentUser.id;
 
   return (
     <div className="container mx-auto py-8 space-y-8 max-w-4xl">
@@ -288,7 +312,7 @@ const Settings = () => {
                             <Users className="h-5 w-5 text-muted-foreground" />
                             <div>
                                 <div className="font-medium">{herd.name}</div>
-                                <div className="text-xs text-muted-foreground">{herd.members.length} members</div>
+                                <div className="text-xs text-muted-foreground">{herd.member_count} members</div>
                             </div>
                         </div>
                         <Button variant="ghost" size="sm">Manage</Button>
@@ -322,9 +346,9 @@ const Settings = () => {
                 <Separator />
 
                 <div className="space-y-3">
-                    <h4 className="font-medium text-sm">Members</h4>
+                    <h4 className="font-medium text-sm">Members ({selectedHerd.member_count})</h4>
                     <div className="space-y-2 max-h-48 overflow-y-auto">
-                        {selectedHerd.members.map((member) => (
+                        {members.map((member) => (
                             <div key={member.user_id} className="flex items-center justify-between text-sm p-2 bg-secondary/20 rounded-md">
                                 <div>
                                     <div className="font-medium">{member.full_name || member.email}</div>
@@ -342,6 +366,11 @@ const Settings = () => {
                                 </div>
                             </div>
                         ))}
+                        {membersCursor && (
+                            <Button variant="ghost" size="sm" className="w-full" onClick={() => loadMembers(selectedHerd.id, membersCursor)}>
+                                Load more
+                            </Button>
+                        )}
                     </div>
                 </div>
 
@@ -7,18 +7,20 @@ export interface Reflection {
   buffalo: string;
   timestamp: string; // ISO date string
   sharedWith: string[]; // IDs of herds/friends
-  image?: string; // Base64 string of the image
-  curiosityReactions: Record<string, string[]>; // Mapping reaction type to list of user IDs
+  image_id?: string; // Id of an image uploaded via POST /images/
+  reaction_counts?: Record<string, number>; // Mapping reaction type to number of users
+  my_reactions?: string[]; // Feed only: reaction types the current user left
   isFlaggedForFollowUp?: boolean; // New: Flag to remind user to ask for more detail
   user_id?: string;
   author_name?: string;
+  thumbnail_url?: string; // Feed only: server-relative URL of a resized image
 }
 
 export interface ReflectionCreate {
   high: string;
   low: string;
   buffalo: string;
-  image?: string;
+  image_id?: string;
   sharedWith: string[];
 }
 
@@ -26,12 +28,28 @@ export interface ReflectionUpdate {
   high?: string;
   low?: string;
   buffalo?: string;
-  image?: string;
+  image_id?: string;
   sharedWith?: string[];
-  curiosityReactions?: Record<string, string[]>;
   isFlaggedForFollowUp?: boolean;
 }
 
+export interface UploadedImage {
+  id: string;
+  content_type: string;
+  length: number;
+}
+
+export interface Page<T> {
+  items: T[];
+  next_cursor: string | null;
+}
+
+// Pushed by GET /reflections/feed/events
+export type FeedEvent =
+  | { type: 'upsert'; item: Reflection }
+  | { type: 'remove'; reflection_id: string }
+  | { type: 'reset' };
+
 export interface HerdMember {
   user_id: string;
   email: string;
@@ -44,9 +62,9 @@ export interface Herd {
   id: string;
   name: string;
   description?: string;
-  created_by: string;
+  owner_id: string;
   created_at: string;
-  members: HerdMember[];
+  member_count: number;
 }
 
 export interface HerdUpdate {
@@ -67,6 +85,8 @@ export interface User {
   email: string;
   full_name?: string;
   settings?: UserSettings;
+  last_reflection_at?: string | null;
+  reflection_streak?: number;
 }
 
 export interface Friend {